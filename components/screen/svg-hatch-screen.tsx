@@ -1,6 +1,6 @@
 "use client";
 
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import { Button } from "@/components/ui/button";
 import { nodeToDocument } from "@/lib/svg-utils";
 import { setStrokeToFillColor } from "@/lib/svg-color";
@@ -32,6 +32,15 @@ export const SvgHatchScreen: React.FC<SvgHatchScreenProps> = ({
     hatchSpacing: 0.7, // Default to felt tip pen width
   });
 
+  // Identifies this screen's requests, so that the server drops one superseded by the next
+  const [sessionId] = useState(() => crypto.randomUUID());
+  const pendingRequest = useRef<AbortController | null>(null);
+  // The hatches streamed by /api/hatch-svg-preview while /api/hatch-svg is still working
+  const [streamedPreview, setStreamedPreview] = useState<string | null>(null);
+
+  // Abort a request still running when the screen closes
+  useEffect(() => () => pendingRequest.current?.abort(), []);
+
   // Update hatch spacing when tool changes
   useEffect(() => {
     const selectedToolObj = TOOL_CATEGORIES.find(t => t.key === hatchConfig.selectedTool);
@@ -58,7 +67,45 @@ export const SvgHatchScreen: React.FC<SvgHatchScreenProps> = ({
     }));
   };
 
+  // Draw the preview stream as it arrives: each element is a whole <g>, so the text up to the
+  // last </g> read, closed with </svg>, is a document of its own
+  const streamPreview = async (url: string, formData: FormData, signal: AbortSignal) => {
+    try {
+      const response = await fetch(url, { method: 'POST', body: formData, signal });
+      if (!response.ok || !response.body) {
+        return;
+      }
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let text = "";
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) {
+          break;
+        }
+        text += decoder.decode(value, { stream: true });
+        const groupsEnd = text.lastIndexOf("</g>");
+        const headerEnd = text.indexOf(">", text.indexOf("<svg"));
+        if (groupsEnd >= 0) {
+          setStreamedPreview(text.slice(0, groupsEnd + "</g>".length) + "</svg>");
+        } else if (headerEnd >= 0) {
+          setStreamedPreview(text.slice(0, headerEnd + 1) + "</svg>");
+        }
+      }
+    } catch (error) {
+      // The preview is only a courtesy; the hatch-svg request reports failures
+      if (!(error instanceof DOMException && error.name === 'AbortError')) {
+        console.error('Error streaming hatching preview:', error);
+      }
+    }
+  };
+
   const handleApplyHatching = async () => {
+    // Only the latest request counts
+    pendingRequest.current?.abort();
+    const controller = new AbortController();
+    pendingRequest.current = controller;
+
     try {
       const formData = new FormData();
       const doc = nodeToDocument(svg);
@@ -82,11 +129,21 @@ export const SvgHatchScreen: React.FC<SvgHatchScreenProps> = ({
         hatch_scope: "3.0", // Default
         tolerance: "20.0", // Default
         unit: "mm", // Default
+        session: sessionId,
       });
 
+      // The preview is a session of its own, so that it does not supersede the hatching itself
+      const previewParams = new URLSearchParams(params);
+      previewParams.set("session", `${sessionId}-preview`);
+      const previewController = new AbortController();
+      controller.signal.addEventListener("abort", () => previewController.abort());
+      setStreamedPreview(null);
+      streamPreview(`${API_URL}/api/hatch-svg-preview?${previewParams.toString()}`, formData, previewController.signal);
+
       const response = await fetch(`${API_URL}/api/hatch-svg?${params.toString()}`, {
         method: 'POST',
         body: formData,
+        signal: controller.signal,
       });
 
       if (!response.ok) {
@@ -94,11 +151,17 @@ export const SvgHatchScreen: React.FC<SvgHatchScreenProps> = ({
       }
 
       const newSvg = await response.text();
+      previewController.abort();
       const parser = new DOMParser();
       const responseDoc = parser.parseFromString(newSvg, 'image/svg+xml');
       setSvg?.(responseDoc);
       onClose?.();
     } catch (error) {
+      if (error instanceof DOMException && error.name === 'AbortError') {
+        return;
+      }
+      controller.abort();
+      setStreamedPreview(null);
       console.error('Error applying hatching:', error);
       // You might want to show an error message to the user here
     }
@@ -135,7 +198,13 @@ export const SvgHatchScreen: React.FC<SvgHatchScreenProps> = ({
           {/* Left Panel - SVG Preview */}
           <div className="flex-1 border rounded bg-white p-4">
             <div className="w-full h-full min-h-[400px] flex items-center justify-center">
-              {previewSVG ? (
+              {streamedPreview ? (
+                <div
+                  dangerouslySetInnerHTML={{ __html: streamedPreview }}
+                  className="object-contain border-2 border-dashed border-muted-foreground rounded"
+                  style={{ width: 'auto', height: 'auto', maxWidth: '100%', maxHeight: '100%' }}
+                />
+              ) : previewSVG ? (
                 <div
                   dangerouslySetInnerHTML={{ __html: (() => {
                     const serializer = new XMLSerializer();
@@ -0,0 +1,259 @@
+"""
+Benchmark for hatch_fill.py, timing the work /api/hatch-svg does.
+
+Each case hatches one document with one set of HatchParams in a freshly
+spawned process, so that every run starts with cold caches and its peak
+memory is its own.  Recorded per case:
+
+    wall_time      seconds to hatch and build the vpype Document
+    hatch_time     seconds spent in Hatch_Fill alone
+    peak_rss_kb    peak resident memory of the process
+    n_paths        hatch paths (one per filled element)
+    n_moves        pen lifts, one per run of joined hatch segments
+    n_lines        hatch segments
+    n_curves       curves joining hatch segments without a pen lift
+
+The cases are the checked-in SVGs under every combination of crossHatch,
+reducePenLifts and holdBackHatchFromEdges, followed by synthetic
+documents scaling shape count, vertices per shape and hatch spacing in
+turn.
+
+    python benchmark_hatch.py --output bench.json
+    python benchmark_hatch.py --baseline bench.json
+
+Against a baseline, a case regresses when its time or memory grows by
+more than --threshold, or when its segment counts change.  The exit
+status is 1 if any case regressed.
+
+benchmark_baseline.json is the stored baseline, the fastest of three runs
+of every case on the machine it records (python, machine, cpus):
+
+    python benchmark_hatch.py --quick --baseline benchmark_baseline.json
+
+Its segment counts hold anywhere; its times and memory only on similar
+hardware, so elsewhere raise --threshold or regenerate it there first.
+Regenerate and commit it whenever a change is meant to alter the counts
+or the timings:
+
+    python benchmark_hatch.py --repeat 3 --output benchmark_baseline.json
+"""
+
+import argparse
+import concurrent.futures
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+CORPUS = ["ellie_simplified.svg", "wimbledon_figma.svg", "test.svg", "example.svg"]
+
+FLAGS = ["cross_hatch", "reduce_pen_lifts", "hold_back_hatch_from_edges"]
+
+COLOURS = ["#000000", "#ff0000", "#00a000", "#0000ff", "#808080"]
+
+# Synthetic scaling sweeps: (shapes, vertices per shape, hatch spacing in mm)
+SHAPE_SWEEP = [(n, 16, 1.0) for n in (50, 200, 800)]
+VERTEX_SWEEP = [(100, n, 1.0) for n in (8, 64, 512)]
+SPACING_SWEEP = [(200, 16, s) for s in (4.0, 2.0, 1.0, 0.5)]
+
+# Time differences below this many seconds are taken to be noise
+MIN_TIME_DELTA = 0.05
+
+
+def synthetic_svg(n_shapes, n_vertices, seed=1, size=200.0):
+    """
+    A size x size mm document of n_shapes filled star polygons of
+    n_vertices vertices each, laid out on a grid so that neighbours
+    overlap a little.  Every other shape is drawn with cubic Beziers
+    rather than lines, and one in five has a hole.
+    """
+
+    rng = random.Random(seed)
+    n_columns = max(1, math.ceil(math.sqrt(n_shapes)))
+    cell = size / n_columns
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}mm" height="{0}mm" '
+           'viewBox="0 0 {0} {0}">'.format(size)]
+    for i in range(n_shapes):
+        cx = (i % n_columns + 0.5) * cell
+        cy = (i // n_columns + 0.5) * cell
+        radius = 0.6 * cell
+        points = []
+        for j in range(n_vertices):
+            angle = 2 * math.pi * j / n_vertices
+            r = radius * rng.uniform(0.5, 1.0)
+            points.append((cx + r * math.cos(angle), cy + r * math.sin(angle)))
+        if i % 2:
+            d = "M {0:.3f},{1:.3f} ".format(*points[0])
+            for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+                d += "C {0:.3f},{1:.3f} {2:.3f},{3:.3f} {4:.3f},{5:.3f} ".format(
+                    x0 + (x1 - x0) / 3 + (cy - y0) * 0.1, y0 + (y1 - y0) / 3 + (x0 - cx) * 0.1,
+                    x1 - (x1 - x0) / 3 + (cy - y1) * 0.1, y1 - (y1 - y0) / 3 + (x1 - cx) * 0.1,
+                    x1, y1)
+        else:
+            d = "M " + " L ".join("{0:.3f},{1:.3f}".format(x, y) for x, y in points) + " "
+        d += "Z"
+        if i % 5 == 0:
+            h = 0.15 * cell
+            d += " M {0:.3f},{1:.3f} l 0,{2:.3f} l {2:.3f},0 l 0,{3:.3f} Z".format(cx - h, cy - h, 2 * h, -2 * h)
+        out.append('<path d="{0}" fill="{1}" fill-rule="evenodd"/>'.format(d, rng.choice(COLOURS)))
+    out.append("</svg>")
+    return "\n".join(out).encode()
+
+
+def cases(quick=False):
+    """
+    The benchmark cases as (name, document, HatchParams keyword arguments)
+    where document is a corpus file name or a synthetic_svg() argument
+    tuple
+    """
+
+    combinations = [dict(zip(FLAGS, values)) for values in itertools.product([False, True], repeat=len(FLAGS))]
+    if quick:
+        combinations = [{"cross_hatch": False, "reduce_pen_lifts": True, "hold_back_hatch_from_edges": True}]
+    for filename in CORPUS:
+        for flags in combinations:
+            name = "{0}[{1}]".format(filename, ",".join(flag for flag in FLAGS if flags.get(flag)))
+            yield name, filename, dict(flags)
+
+    sweeps = SHAPE_SWEEP + VERTEX_SWEEP + SPACING_SWEEP
+    if quick:
+        sweeps = sweeps[:2]
+    for n_shapes, n_vertices, spacing in dict.fromkeys(sweeps):
+        name = "synthetic[shapes={0},vertices={1},spacing={2}]".format(n_shapes, n_vertices, spacing)
+        yield name, (n_shapes, n_vertices), {"hatch_spacing": spacing, "reduce_pen_lifts": True}
+
+
+def runCase(document, params):
+    """
+    Hatch one document as hatch_document() would, timing Hatch_Fill apart
+    from building the Document.  Runs in its own process.
+    """
+
+    import numpy as np
+    import vpype
+    from hatch_fill import PathData, addHatchLayers, runHatchFill
+
+    if isinstance(document, str):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), document), "rb") as f:
+            svg = f.read()
+    else:
+        svg = synthetic_svg(*document)
+
+    quantization = vpype.convert_length("0.1mm")
+    start = time.perf_counter()
+    effect = runHatchFill(svg, params, join_fills=False)
+    hatched = time.perf_counter()
+    doc = vpype.read_svg_by_attributes(io.BytesIO(svg), ["stroke"], quantization)
+    addHatchLayers(doc, effect, quantization)
+    end = time.perf_counter()
+
+    counts = np.zeros(3, dtype=np.int64)
+    for node, path, transformed_hatch_spacing in effect.hatch_paths:
+        counts += np.bincount(path.codes[:path.n_codes], minlength=3)
+    return {
+        "wall_time": end - start,
+        "hatch_time": hatched - start,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "n_paths": len(effect.hatch_paths),
+        "n_moves": int(counts[PathData.MOVE]),
+        "n_lines": int(counts[PathData.LINE]),
+        "n_curves": int(counts[PathData.CURVE]),
+    }
+
+
+def benchmark(quick=False, repeat=1, engine="numpy", pattern=None):
+    """
+    Run the benchmark cases, each repeat times in fresh processes, keeping
+    the fastest run of each
+    """
+
+    from hatch_fill import HatchParams
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, document, kwargs in cases(quick):
+        if pattern and pattern not in name:
+            continue
+        params = HatchParams(hatch_engine=engine, **kwargs)
+        best = None
+        for _ in range(repeat):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(runCase, document, params).result()
+            if best is None or result["wall_time"] < best["wall_time"]:
+                best = result
+        best["params"] = kwargs
+        results[name] = best
+        print("{0:<60} {1:8.3f}s {2:8d}kB {3:8d} segments".format(
+            name, best["wall_time"], best["peak_rss_kb"], best["n_lines"]), file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "engine": engine,
+        "cases": results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against baseline and return the list of regressions
+    as human readable lines
+    """
+
+    regressions = []
+    for name, case in results["cases"].items():
+        reference = baseline["cases"].get(name)
+        if reference is None or reference["params"] != case["params"]:
+            continue
+        if case["wall_time"] > reference["wall_time"] * (1 + threshold) and \
+                case["wall_time"] - reference["wall_time"] > MIN_TIME_DELTA:
+            regressions.append("{0}: wall time {1:.3f}s, was {2:.3f}s".format(
+                name, case["wall_time"], reference["wall_time"]))
+        if case["peak_rss_kb"] > reference["peak_rss_kb"] * (1 + threshold):
+            regressions.append("{0}: peak memory {1}kB, was {2}kB".format(
+                name, case["peak_rss_kb"], reference["peak_rss_kb"]))
+        for key in ("n_paths", "n_moves", "n_lines", "n_curves"):
+            if case[key] != reference[key]:
+                regressions.append("{0}: {1} {2}, was {3}".format(name, key, case[key], reference[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hatch_fill.py")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare the results against this earlier output")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative growth in time or memory counted as a regression")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--engine", default="numpy", choices=["numpy", "python"])
+    parser.add_argument("--quick", action="store_true", help="one flag combination and two synthetic cases")
+    parser.add_argument("--filter", help="only run the cases whose name contains this")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.quick, args.repeat, args.engine, args.filter)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Cooperative cancellation of long running work.
+
+A CancelToken is handed to the work when it starts; the work calls
+check() at points where it can stop cleanly, between elements, batches
+of hatch lines and pipeline stages, and check() raises Cancelled once
+the token has been cancelled or its deadline has passed.  Tokens may be
+cancelled from any thread.
+"""
+
+import contextlib
+import threading
+import time
+
+
+class Cancelled(Exception):
+    """
+    Raised by CancelToken.check() when the work is to stop; reason is
+    one of the CancelToken reasons
+    """
+
+    def __init__(self, reason):
+        super().__init__("cancelled: {0}".format(reason))
+        self.reason = reason
+
+
+class CancelToken(object):
+    """
+    Cancellation flag of one piece of work, with an optional deadline
+    in seconds from now
+    """
+
+    DEADLINE = "deadline"
+    DISCONNECTED = "disconnected"
+    SUPERSEDED = "superseded"
+
+    def __init__(self, seconds=None):
+        self.deadline = time.monotonic() + seconds if seconds is not None else None
+        self.reason = None
+        self.event = threading.Event()
+
+    def cancel(self, reason):
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    @property
+    def cancelled(self):
+        if not self.event.is_set() and self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel(CancelToken.DEADLINE)
+        return self.event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+
+class Sessions(object):
+    """
+    The token of the work running for each client session, so that a
+    newer request of a session supersedes the one still running
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def running(self, key, token):
+        """
+        Run the work of token as the current work of session key,
+        cancelling the work it replaces.  A key of None is no session.
+        """
+
+        if key is None:
+            yield token
+            return
+        with self.lock:
+            previous = self.tokens.get(key)
+            self.tokens[key] = token
+        if previous is not None and previous is not token:
+            previous.cancel(CancelToken.SUPERSEDED)
+        try:
+            yield token
+        finally:
+            with self.lock:
+                if self.tokens.get(key) is token:
+                    del self.tokens[key]
@@ -108,14 +108,29 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import copy
+import collections
+import contextlib
+import functools
+import hashlib
+import io
 import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from xml.sax.saxutils import quoteattr
 
 import inkex
+import numpy as np
 
 from inkex.transforms import Transform
-from inkex import bezier
 from lxml import etree
 
+from cancellation import Cancelled, CancelToken
+
 __version__ = '4.1'
 
 N_PAGE_WIDTH = 3200
@@ -139,16 +154,87 @@ RADIAN_TOLERANCE_FOR_COLINEAR = 0.1
 RADIAN_TOLERANCE_FOR_ALTERNATING_DIRECTION = 0.1  
 # Pragmatic adjustment again, as with colinearity tolerance
 
-RECURSION_LIMIT = 500  
-# Pragmatic - if too high, risk runtime python error; 
-# if too low, miss some chances for reducing pen lifts
-
 EXTREME_POS = 1.0E70 # Extremely large positive number
 EXTREME_NEG = -1.0E70 # Extremely large negative number
 
 MIN_HATCH_FRACTION = 0.25  
 # Minimum hatch length, as a fraction of the hatch spacing.
 
+N_MAX_PAIRS_PER_BATCH = 1 << 20
+# Upper bound on the number of (hatch line, polygon edge) pairs the batched
+# engine evaluates at once; keeps the temporary arrays at a few tens of MB.
+
+N_MAX_JOIN_ENDS_PER_BATCH = 1 << 14
+# Upper bound on the number of hatch segment ends whose neighbours the pen
+# lift reduction sizes up at once, for the same reason.
+
+F_ENGINE_TOLERANCE = 1.0E-9
+# Distance, in user units, within which the hatch segments of the numpy and
+# python engines agree.  The batched engine takes its trigonometry from numpy,
+# whose arctan2, sin and hypot may differ from the math module's in the last
+# bit, so a hold back length can too.
+
+HATCH_ENGINES = ("numpy", "python")
+# The --hatchEngine choices: the batched numpy engine and the line by line
+# python reference.
+
+HOLD_BACK_MODES = ("trim", "inset")
+# The --holdBackMode choices: trimming each hatch at the edge it meets, or
+# insetting the polygons once.
+
+HOLD_BACK_PARALLEL_EXCISE = 123456.0
+# Hold back length used to mark a hatch end for complete excision when the
+# hatch is parallel to the polygon segment it meets.  Just a number guaranteed
+# large enough to be longer than any hatch length.
+
+N_MAX_SUBDIVISION_DEPTH = 48
+# Bezier curves are split in half at most this many times when flattening;
+# far beyond any useful tolerance, it only guards against runaway input.
+
+N_FLATTEN_CACHE_BYTES = 256 << 20
+# Memory allowed for flattened polygons kept between documents, see FlattenCache.
+
+N_STAGE_CACHE_BYTES = 64 << 20
+# Memory allowed for the results of each later stage of the hatch pipeline
+# kept between documents, see StageCache.
+
+N_MIN_BAND_VERTICES = 5000
+# Elements with at least this many vertices are split into bands of hatch
+# lines when hatching on the process pool, see Hatch_Fill.hatchBands().
+
+N_MIN_BAND_LINES = 32
+# Fewest hatch lines worth sending to a worker as a band of their own.
+
+N_MAX_PROCESSES = int(os.environ.get("HATCH_MAX_PROCESSES") or os.cpu_count() or 1)
+# Workers of the one process pool every run hatching in parallel shares, see
+# processPool(): HATCH_MAX_PROCESSES from the environment, else every core.
+
+F_CANCEL_POLL_SECONDS = 0.1
+# How often the cancel token is checked while waiting on the process pool.
+
+PREVIEW_TRUNCATED = '<!-- hatch-preview truncated: {0} -->\n'
+# Ends a hatch_preview() stopped early, before its closing tag; {0} is the
+# CancelToken reason, or error.
+
+F_SECONDS_PER_RUN = 0.1
+F_SECONDS_PER_ELEMENT = 4.0E-3
+F_SECONDS_PER_EDGE = 8.0E-5
+F_SECONDS_PER_GRID_LINE = 2.4E-5
+F_SECONDS_PER_INTERSECTION = 1.6E-5
+F_SECONDS_PER_SEGMENT = 1.0E-4
+# Cost model of HatchEstimate: seconds taken by a serial /api/hatch-svg
+# request, from hatching through writing the SVG out with vpype, and per
+# unit of its work.  Fitted on the benchmark_hatch.py corpus at spacings
+# of 4mm down to 0.05mm; writing the document out dominates at the finest.
+
+N_BYTES_PER_EDGE = 100
+N_BYTES_PER_SEGMENT = 66
+N_BYTES_PER_JOIN_MM = 300
+# Output size model of HatchEstimate: bytes of SVG that vpype writes per
+# polygon edge of the original document, per hatch segment and, when
+# reducing pen lifts, per millimetre of hatch spacing for the curve
+# joining each segment to the next.
+
 """
 Geometry 101: Determining if two lines intersect
 
@@ -398,8 +484,7 @@ def interstices(self, p1, p2, paths, hatches, b_hold_back_hatches, f_hold_back_s
 
                             d_and_a.append((s, path, length_remove_starting_hatch, length_remove_ending_hatch))
                         else:
-                            d_and_a.append((s, path, 123456.0, 123456.0))  # Mark for complete hatch excision, hatch is parallel to segment
-                            # Just a random number guaranteed large enough to be longer than any hatch length
+                            d_and_a.append((s, path, HOLD_BACK_PARALLEL_EXCISE, HOLD_BACK_PARALLEL_EXCISE))  # Mark for complete hatch excision, hatch is parallel to segment
                     else:
                         d_and_a.append((s, path, 0, 0))  # zero length to be removed from hatch
 
@@ -408,6 +493,7 @@ def interstices(self, p1, p2, paths, hatches, b_hold_back_hatches, f_hold_back_s
     # Return now if there were no intersections
     if len(d_and_a) == 0:
         return None
+    self.stats.count("intersections", len(d_and_a))
 
     d_and_a.sort()
 
@@ -502,380 +588,2405 @@ def interstices(self, p1, p2, paths, hatches, b_hold_back_hatches, f_hold_back_s
         i += 2
 
 
-def subdivideCubicPath(sp, flat, i=1):
+def edgeArrays(paths):
     """
-    Break up a bezier curve into smaller curves, each of which
-    is approximately a straight line within a given tolerance
-    (the "smoothness" defined by [flat]).
+    Flatten the polygons stored in "paths", a dictionary of SubpathArray,
+    into one array of edges.
 
-    This is a modified version of cspsubdiv.cspsubdiv() rewritten
-    to avoid recurrence.
+    Returns a tuple (edges, edge_path_index, keys) where edges is an
+    (n, 4) float array of (x3, y3, x4, y4) rows, edge_path_index gives
+    for each edge the position in keys of the path it belongs to, and
+    keys lists the dictionary keys of "paths" in iteration order.
     """
 
-    while True:
-        while True:
-            if i >= len(sp):
-                return
+    keys = list(paths)
+    edge_blocks = []
+    index_blocks = []
+    for n_path, path in enumerate(keys):
+        edges = paths[path].edges()
+        if len(edges):
+            edge_blocks.append(edges)
+            index_blocks.append(np.full(len(edges), n_path, dtype=np.intp))
 
-            p0 = sp[i - 1][1]
-            p1 = sp[i - 1][2]
-            p2 = sp[i][0]
-            p3 = sp[i][1]
+    if not edge_blocks:
+        return np.empty((0, 4)), np.empty(0, dtype=np.intp), keys
+    return np.vstack(edge_blocks), np.concatenate(index_blocks), keys
 
-            b = (p0, p1, p2, p3)
 
-            if bezier.maxdist(b) > flat:
-                break
+def intersectBatched(lines, edges, line_index, edge_index):
+    """
+    Vectorized form of intersect() for the (hatch line, polygon edge) pairs
+    given by the parallel index arrays line_index and edge_index.
+
+    Returns the positions (into the pair arrays) of the pairs which do
+    intersect together with the fractional point of intersection "sa"
+    along the hatch line for each of them.  The arithmetic is performed in
+    the same order as intersect() so both engines agree to the last bit.
+    """
 
-            i += 1
+    p1x = lines[line_index, 0]
+    p1y = lines[line_index, 1]
+    d21x = lines[line_index, 2] - p1x
+    d21y = lines[line_index, 3] - p1y
+    p3x = edges[edge_index, 0]
+    p3y = edges[edge_index, 1]
+    d43x = edges[edge_index, 2] - p3x
+    d43y = edges[edge_index, 3] - p3y
 
-        one, two = bezier.beziersplitatt(b, 0.5)
-        sp[i - 1][2] = one[1]
-        sp[i][0] = two[2]
-        p = [one[2], one[3], two[1]]
-        sp[i:1] = [p]
+    d = d21x * d43y - d21y * d43x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sb = ((p1y - p3y) * d21x - (p1x - p3x) * d21y) / d
+    hit = np.flatnonzero((d != 0) & (sb >= 0) & (sb <= 1))
 
+    sa = ((p1y[hit] - p3y[hit]) * d43x[hit] - (p1x[hit] - p3x[hit]) * d43y[hit]) / d[hit]
+    on_line = (sa >= 0) & (sa <= 1)
 
-def distanceSquared(p1, p2):
+    return hit[on_line], sa[on_line]
+
+
+def holdBackLengths(lines, edges, line_index, edge_index, s, f_hold_back_steps):
     """
-    Pythagorean distance formula WITHOUT the square root.  Since
-    we just want to know if the distance is less than some fixed
-    fudge factor, we can just square the fudge factor once and run
-    with it rather than compute square roots over and over.
+    Vectorized form of the hold back computation in interstices(): for each
+    intersection, the length to remove from a hatch starting at it and the
+    length to remove from a hatch ending at it.  Hatches parallel to the
+    polygon segment are marked with HOLD_BACK_PARALLEL_EXCISE.
     """
 
-    dx = p2[0] - p1[0]
-    dy = p2[1] - p1[1]
+    p1x = lines[line_index, 0]
+    p1y = lines[line_index, 1]
+    p2x = lines[line_index, 2]
+    p2y = lines[line_index, 3]
+    p3x = edges[edge_index, 0]
+    p3y = edges[edge_index, 1]
+    p4x = edges[edge_index, 2]
+    p4y = edges[edge_index, 3]
+
+    angle_hatch_radians = np.arctan2(-(p2y - p1y), (p2x - p1x))
+    angle_segment_radians = np.arctan2(-(p4y - p3y), (p4x - p3x))
+    angle_difference_radians = angle_hatch_radians - angle_segment_radians
+    angle_difference_radians = np.where(angle_difference_radians > math.pi,
+                                        angle_difference_radians - 2 * math.pi,
+                                        np.where(angle_difference_radians < -math.pi,
+                                                 angle_difference_radians + 2 * math.pi,
+                                                 angle_difference_radians))
+    f_abs_sin_of_join_angle = np.abs(np.sin(angle_difference_radians))
+    b_parallel = f_abs_sin_of_join_angle == 0.0
+    with np.errstate(divide='ignore'):
+        prelim_length_to_be_removed = f_hold_back_steps / f_abs_sin_of_join_angle
+
+    intersection_x = p1x + s * (p2x - p1x)
+    intersection_y = p1y + s * (p2y - p1y)
+    b_near_p3 = np.abs(angle_difference_radians) < math.pi / 2
+    dist_to_p3 = np.hypot(p3x - intersection_x, p3y - intersection_y)
+    dist_to_p4 = np.hypot(p4x - intersection_x, p4y - intersection_y)
+    dist_intersection_to_relevant_end = np.where(b_near_p3, dist_to_p3, dist_to_p4)
+    dist_intersection_to_irrelevant_end = np.where(b_near_p3, dist_to_p4, dist_to_p3)
+
+    # Limit excessive holdback at either end, see issue 22 in interstices()
+    length_remove_starting_hatch = np.minimum(prelim_length_to_be_removed,
+                                              dist_intersection_to_relevant_end + f_hold_back_steps)
+    length_remove_ending_hatch = np.minimum(prelim_length_to_be_removed,
+                                            dist_intersection_to_irrelevant_end + f_hold_back_steps)
+
+    length_remove_starting_hatch[b_parallel] = HOLD_BACK_PARALLEL_EXCISE
+    length_remove_ending_hatch[b_parallel] = HOLD_BACK_PARALLEL_EXCISE
+
+    return length_remove_starting_hatch, length_remove_ending_hatch
+
+
+def dedupSortedIntersections(line_index, s):
+    """
+    Given intersections sorted by hatch line and then by "s", return a
+    boolean mask of those which survive the duplicate removal performed in
+    interstices(): an intersection is dropped when it lies within
+    F_MINGAP_SMALL_VALUE of the last intersection kept on the same line.
+    """
 
-    return dx * dx + dy * dy
+    n = len(s)
+    keep = np.ones(n, dtype=bool)
+    if n < 2:
+        return keep
+    keep[1:] = (line_index[1:] != line_index[:-1]) | (np.abs(s[1:] - s[:-1]) > F_MINGAP_SMALL_VALUE)
+
+    # Comparing against the previous intersection is only exact when that one
+    # was kept.  Within runs of two or more dropped intersections, fall back
+    # to comparing against the last kept one, as interstices() does.
+    dropped = ~keep
+    suspect = np.flatnonzero(dropped[1:] & dropped[:-1]) + 1
+    i_done = -1
+    for i in suspect.tolist():
+        if i <= i_done:
+            continue
+        i_last_kept = i - 1
+        while not keep[i_last_kept]:
+            i_last_kept -= 1
+        k = i
+        while k < n and not keep[k]:
+            if abs(s[k] - s[i_last_kept]) > F_MINGAP_SMALL_VALUE:
+                keep[k] = True
+                i_last_kept = k
+            k += 1
+        i_done = k
+    return keep
+
+
+def hatchLineAngles(lines):
+    """
+    Recover the hatch angle, in degrees and as passed to makeHatchGrid(),
+    of each row of an (n, 4) array of hatch lines.  Lines of the same
+    grid pass share the same value.
+    """
 
+    return np.round(180.0 - np.degrees(np.arctan2(lines[:, 3] - lines[:, 1], lines[:, 2] - lines[:, 0])), 6)
 
-class Hatch_Fill(inkex.Effect):
 
-    def __init__(self):
+class EdgeIndex(object):
+    """
+    Scanline index over the edges of a collection of polygons.
+
+    All the hatch lines of a grid are parallel, so each line is fully
+    described by its offset along the hatch normal.  Projecting every
+    polygon edge onto that normal gives the span of offsets the edge
+    covers; a hatch line can only cross the edges whose span contains its
+    offset.  Sorting the lines by offset turns finding those "active"
+    edges into a pair of binary searches per edge, so the intersection
+    work becomes proportional to the number of crossings rather than to
+    lines x edges.
+
+    The projections are cached per hatch angle, so the second pass that
+    crossHatch adds at hatchAngle + 90 re-projects the edges only once.
+    """
 
-        inkex.Effect.__init__(self)
+    def __init__(self, paths, edges=None, f_margin=None):
+        if edges is None:
+            self.edges, self.edge_path_index, self.keys = edgeArrays(paths)
+        else:
+            # The given edges of a single polygon, keyed 0
+            self.edges, self.edge_path_index, self.keys = edges, np.zeros(len(edges), dtype=np.intp), [0]
+        self.projections = {}
+        # Slack added to every span so that rounding in the projections
+        # can never hide an intersection which intersect() would report
+        if f_margin is not None:
+            self.f_margin = f_margin
+        elif len(self.edges):
+            self.f_margin = 1.0E-9 * (1.0 + float(np.max(np.abs(self.edges))))
+        else:
+            self.f_margin = 0.0
 
-        self.xmin, self.ymin = (0.0, 0.0)
-        self.xmax, self.ymax = (0.0, 0.0)
-        self.paths = {}
-        self.grid = []
-        self.hatches = {}
-        self.transforms = {}
+    def __len__(self):
+        return len(self.edges)
 
-        # For handling an SVG viewbox attribute, we will need to know the
-        # values of the document's <svg> width and height attributes as well
-        # as establishing a transform from the viewbox to the display.
-        self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+    @staticmethod
+    def normal(angle):
+        # Same rotation as makeHatchGrid(): lines run along (sa, -ca)
+        return math.cos(math.radians(90 - angle)), math.sin(math.radians(90 - angle))
 
-        self.arg_parser.add_argument(
-                '--unit', type = str,
-                default = 'mm',
-                help = 'Unit')
-        self.arg_parser.add_argument(
-                "--holdBackSteps", type=float,
-                default=3.0,
-                help="How far hatch strokes stay from boundary (steps)")
-        self.arg_parser.add_argument(
-                "--hatchScope", type=float,
-                default=3.0,
-                help="Radius searched for segments to join (units of hatch width)")
-        self.arg_parser.add_argument(
-                "--holdBackHatchFromEdges",
-                type=inkex.Boolean, default=True,
-                help="Stay away from edges, so no need for inset")
-        self.arg_parser.add_argument(
-                "--reducePenLifts",
-                type=inkex.Boolean, default=True,
-                help="Reduce plotting time by joining some hatches")
-        self.arg_parser.add_argument(
-                "--crossHatch",
-                type=inkex.Boolean, default=False,
-                help="Generate a cross hatch pattern")
-        self.arg_parser.add_argument(
-                "--hatchAngle", type=float,
-                default=90.0,
-                help="Angle of inclination for hatch lines")
-        self.arg_parser.add_argument(
-                "--hatchSpacing", type=float,
-                default=10.0,
-                help="Spacing between hatch lines")
-        self.arg_parser.add_argument(
-                "--tolerance", type=float,
-                default=20.0,
-                help="Allowed deviation from original paths")
+    def project(self, angle):
+        """
+        Return the (low, high) offsets spanned by every edge along the
+        normal of hatch lines at the given angle.
+        """
 
-    def handleViewBox(self):
+        if angle not in self.projections:
+            nx, ny = self.normal(angle)
+            o3 = self.edges[:, 0] * nx + self.edges[:, 1] * ny
+            o4 = self.edges[:, 2] * nx + self.edges[:, 3] * ny
+            self.projections[angle] = (np.minimum(o3, o4), np.maximum(o3, o4))
+        return self.projections[angle]
 
+    def bandEdges(self, lines, angle):
         """
-        Set up the document-wide transform in the event that the document has an SVG viewbox
+        Return the positions of the edges which may intersect any of the
+        hatch lines, all at the given angle: those whose span reaches the
+        offsets of the lines, widened by the margin candidatePairs() uses.
         """
 
-        self.docTransform = Transform(f"scale({self.svg.scale},{self.svg.scale}")
+        nx, ny = self.normal(angle)
+        low, high = self.project(angle)
+        o1 = lines[:, 0] * nx + lines[:, 1] * ny
+        o2 = lines[:, 2] * nx + lines[:, 3] * ny
+        centre = (o1 + o2) / 2
+        margin = float(np.max(np.abs(o1 - o2))) / 2 + self.f_margin
+        return np.flatnonzero((high + margin >= centre.min()) & (low - margin <= centre.max()))
 
-    def addPathVertices(self, node):
+    def candidatePairs(self, lines, angles=None):
+        """
+        Generate the (line index, edge index) pairs of hatch lines and the
+        edges active at their offsets, as chunks of two parallel arrays of
+        at most roughly N_MAX_PAIRS_PER_BATCH pairs each.
+        """
 
+        n_edges = len(self.edges)
+        if n_edges == 0 or len(lines) == 0:
+            return
+        if angles is None:
+            angles = hatchLineAngles(lines)
+        angles = np.asarray(angles, dtype=float)
+
+        for angle in dict.fromkeys(angles.tolist()):
+            group = np.flatnonzero(angles == angle)
+            nx, ny = self.normal(angle)
+            low, high = self.project(angle)
+
+            o1 = lines[group, 0] * nx + lines[group, 1] * ny
+            o2 = lines[group, 2] * nx + lines[group, 3] * ny
+            centre = (o1 + o2) / 2
+            order = np.argsort(centre, kind='stable')
+            centre = centre[order]
+            margin = float(np.max(np.abs(o1 - o2))) / 2 + self.f_margin
+
+            first = np.searchsorted(centre, low - margin, 'left')
+            counts = np.searchsorted(centre, high + margin, 'right') - first
+            cumulative = np.cumsum(counts)
+
+            start = 0
+            while start < n_edges:
+                base = cumulative[start - 1] if start else 0
+                stop = max(start + 1, int(np.searchsorted(cumulative, base + N_MAX_PAIRS_PER_BATCH, 'right')))
+                chunk_counts = counts[start:stop]
+                total = int(cumulative[stop - 1] - base)
+                if total:
+                    edge_index = np.repeat(np.arange(start, stop), chunk_counts)
+                    step = np.arange(total) - np.repeat(cumulative[start:stop] - base - chunk_counts, chunk_counts)
+                    line_position = np.repeat(first[start:stop], chunk_counts) + step
+                    yield group[order[line_position]], edge_index
+                start = stop
+
+    def activePaths(self, lines, angles=None):
         """
-        Decompose the path data from an SVG element into individual
-        subpaths, each starting with an absolute move-to (x, y)
-        coordinate followed by one or more absolute line-to (x, y)
-        coordinates.  Each subpath is stored as a list of (x, y)
-        coordinates, with the first entry understood to be a
-        move-to coordinate and the rest line-to coordinates.  A list
-        is then made of all the subpath lists and then stored in the
-        self.paths dictionary using the path's lxml.etree node pointer
-        as the dictionary key.
+        For each hatch line, in order, return a dictionary shaped like
+        Hatch_Fill.paths holding only the edges active at that line's
+        offset, each edge as a two vertex subpath.  This lets the line by
+        line interstices() benefit from the index unchanged.
         """
 
-        transform = node.composed_transform()
+        lines = np.asarray(lines, dtype=float)
+        active = [{} for _ in range(len(lines))]
+        pairs = list(self.candidatePairs(lines, angles))
+        if not pairs:
+            return active
+        line_index = np.concatenate([p[0] for p in pairs])
+        edge_index = np.concatenate([p[1] for p in pairs])
+        order = np.lexsort((edge_index, line_index))
+        edges = self.edges.tolist()
+        for n_line, n_edge in zip(line_index[order].tolist(), edge_index[order].tolist()):
+            x3, y3, x4, y4 = edges[n_edge]
+            key = self.keys[self.edge_path_index[n_edge]]
+            active[n_line].setdefault(key, []).append([[x3, y3], [x4, y4]])
+        return active
+
+
+def interstices_batched(self, grid, paths, hatches, b_hold_back_hatches, f_hold_back_steps,
+                        grid_angles=None, edge_index=None):
+    """
+    Batched equivalent of calling interstices() once for every hatch line
+    of "grid".  All grid lines and all polygon edges are held in arrays and
+    the intersection parameters, hold back lengths, sorting, duplicate
+    removal and odd/even pairing are all computed on whole arrays.  The
+    hatch segments produced, and the order in which they are added to
+    "hatches", are those of the line by line version, their ends to within
+    F_ENGINE_TOLERANCE.  Where two ends are equally close candidates for a
+    pen lift join, that difference may pick the other one, so the joined
+    paths may run in another order.
+
+    Only the edges an EdgeIndex reports as active for a line are tested
+    against it.  Pass the index built for "paths" to reuse its cached
+    projections, and the hatch angle of each grid line if known.
+    """
 
-        if node.tag in [
-                inkex.addNS('rect', 'svg'), 'rect', 
-                inkex.addNS('line', 'svg'), 'line', 
-                inkex.addNS('polyline', 'svg'), 'polyline', 
-                inkex.addNS('polygon', 'svg'), 'polygon', 
-                inkex.addNS('ellipse', 'svg'), 'ellipse',
-                inkex.addNS('circle', 'svg'), 'circle']:
-            # We use a copy for the shapes, don't want to convert everything to a path
-            node_as_path = node.to_path_element()
-            p = node_as_path.path
-        else:
-            p = node.path
+    if edge_index is None:
+        edge_index = EdgeIndex(paths)
+    intersections = gridIntersections(self, grid, grid_angles, edge_index)
+    if intersections is None:
+        return
+    lines, line_index, hit_edge_index, s = intersections
+    addBatchedHatches(self, lines, edge_index.edges, edge_index.edge_path_index, edge_index.keys,
+                      line_index, hit_edge_index, s, hatches, b_hold_back_hatches, f_hold_back_steps)
 
-        # Get a cubic super duper path  
-        p = p.transform(transform).to_superpath()
-        
-        # Now traverse the simplified path
-        subpaths = []
-        subpath_vertices = []
-        for sp in p:
-            # We've started a new subpath
-            # See if there is a prior subpath and whether we should keep it
-            if len(subpath_vertices):
-                if distanceSquared(subpath_vertices[0], subpath_vertices[-1]) < 1:
-                    # Keep the prior subpath: it appears to be a closed path
-                    subpaths.append(subpath_vertices)
-            subpath_vertices = []
-            subdivideCubicPath(sp, float(self.options.tolerance / 100))
-            for csp in sp:
-                # Add this vertex to the list of vertices
-                subpath_vertices.append(csp[1])
 
-        # Handle final subpath
-        if len(subpath_vertices):
-            if distanceSquared(subpath_vertices[0], subpath_vertices[-1]) < 1:
-                # Path appears to be closed so let's keep it
-                subpaths.append(subpath_vertices)
+def gridIntersections(self, grid, grid_angles, edge_index):
+    """
+    The raw intersections of the hatch lines of "grid" with the edges of
+    edge_index, as the arrays (lines, line_index, edge_index, s): the
+    lines, and for each intersection the line and edge crossing and the
+    parameter along the line.  None if there are none.
+    """
 
-        # Empty path?
-        if len(subpaths) == 0:
-            return
+    if len(grid) == 0 or len(edge_index) == 0:
+        return None
+    lines = np.asarray(grid, dtype=float)
+
+    hit_lines = []
+    hit_edges = []
+    hit_s = []
+    for pair_lines, pair_edges in edge_index.candidatePairs(lines, grid_angles):
+        self.cancel_token.check()
+        hit, s = intersectBatched(lines, edge_index.edges, pair_lines, pair_edges)
+        hit_lines.append(pair_lines[hit])
+        hit_edges.append(pair_edges[hit])
+        hit_s.append(s)
+    if not hit_s:
+        return None
+    self.stats.count("intersections", sum(len(s) for s in hit_s))
+    return lines, np.concatenate(hit_lines), np.concatenate(hit_edges), np.concatenate(hit_s)
 
-        # And add this path to our dictionary of paths
-        self.paths[node] = subpaths
 
-        # And save the transform for this element in a dictionary keyed
-        # by the element's lxml node pointer
-        self.transforms[node] = transform
+def addBatchedHatches(self, lines, edges, edge_path_index, keys, line_index, edge_index, s,
+                      hatches, b_hold_back_hatches, f_hold_back_steps):
+    """
+    Turn the raw intersections found by the batched engine into hatch
+    segments: compute hold back lengths, sort and remove duplicates per
+    hatch line, apply the odd/even rule and store the resulting segments
+    in "hatches" keyed by the path of the starting intersection, as
+    (n, 4) arrays of (x1, y1, x2, y2) rows.
+    """
 
-    def getBoundingBox(self):
+    if len(s) == 0:
+        return
+    path_index = edge_path_index[edge_index]
+
+    if b_hold_back_hatches:
+        length_start, length_end = holdBackLengths(lines, edges, line_index, edge_index, s, f_hold_back_steps)
+    else:
+        length_start = np.zeros(len(s))
+        length_end = np.zeros(len(s))
+
+    # Same ordering as sorting the (s, path, start, end) tuples line by line
+    order = np.lexsort((length_end, length_start, path_index, s, line_index))
+    line_index = line_index[order]
+    s = s[order]
+    path_index = path_index[order]
+    length_start = length_start[order]
+    length_end = length_end[order]
+
+    keep = dedupSortedIntersections(line_index, s)
+    line_index = line_index[keep]
+    s = s[keep]
+    path_index = path_index[keep]
+    length_start = length_start[keep]
+    length_end = length_end[keep]
+
+    # Odd/even rule: within each line, intersections 0 & 1, 2 & 3, ... bound a hatch
+    n = len(s)
+    b_line_start = np.ones(n, dtype=bool)
+    b_line_start[1:] = line_index[1:] != line_index[:-1]
+    first_of_line = np.maximum.accumulate(np.where(b_line_start, np.arange(n), 0))
+    position_in_line = np.arange(n) - first_of_line
+    b_next_on_same_line = np.zeros(n, dtype=bool)
+    b_next_on_same_line[:-1] = line_index[1:] == line_index[:-1]
+    starts = np.flatnonzero((position_in_line % 2 == 0) & b_next_on_same_line)
+    if len(starts) == 0:
+        return
+    ends = starts + 1
+
+    # Create the hatch arrays in the order interstices() would
+    for n_path in dict.fromkeys(path_index[starts].tolist()):
+        if keys[n_path] not in hatches:
+            hatches[keys[n_path]] = np.empty((0, 4))
+
+    hatch_lines = lines[line_index[starts]]
+    p1x = hatch_lines[:, 0]
+    p1y = hatch_lines[:, 1]
+    p2x = hatch_lines[:, 2]
+    p2y = hatch_lines[:, 3]
+    x1 = p1x + s[starts] * (p2x - p1x)
+    y1 = p1y + s[starts] * (p2y - p1y)
+    x2 = p1x + s[ends] * (p2x - p1x)
+    y2 = p1y + s[ends] * (p2y - p1y)
+    segment_path_index = path_index[starts]
+
+    if b_hold_back_hatches:
+        f_min_allowed_hatch_length = self.options.hatchSpacing * MIN_HATCH_FRACTION
+        f_initial_hatch_length = np.hypot(x2 - x1, y2 - y1)
+        f_length_to_be_removed_from_pt1 = length_end[starts]
+        f_length_to_be_removed_from_pt2 = length_start[ends]
+        long_enough = (f_initial_hatch_length - (f_length_to_be_removed_from_pt1 + f_length_to_be_removed_from_pt2)) > f_min_allowed_hatch_length
+        x1, y1, x2, y2 = x1[long_enough], y1[long_enough], x2[long_enough], y2[long_enough]
+        segment_path_index = segment_path_index[long_enough]
+        pt1x, pt1y = relativeControlPointPositions(f_length_to_be_removed_from_pt1[long_enough], x2 - x1, y2 - y1, x1, y1)
+        pt2x, pt2y = relativeControlPointPositions(f_length_to_be_removed_from_pt2[long_enough], x1 - x2, y1 - y2, x2, y2)
+        x1, y1, x2, y2 = pt1x, pt1y, pt2x, pt2y
+
+    if len(segment_path_index) == 0:
+        return
+    segments = np.column_stack((x1, y1, x2, y2))
+    order = np.argsort(segment_path_index, kind='stable')
+    path_order = segment_path_index[order]
+    boundaries = np.flatnonzero(path_order[1:] != path_order[:-1]) + 1
+    for n_path, block in zip(path_order[np.r_[0, boundaries]].tolist(), np.split(order, boundaries)):
+        appendHatches(hatches, keys[n_path], segments[block])
 
-        """
-        Determine the bounding box for our collection of polygons
-        """
 
-        self.xmin, self.xmax = EXTREME_POS, EXTREME_NEG
-        self.ymin, self.ymax = EXTREME_POS, EXTREME_NEG
-        for path in self.paths:
-            for subpath in self.paths[path]:
-                for vertex in subpath:
-                    if vertex[0] < self.xmin:
-                        self.xmin = vertex[0]
-                    if vertex[0] > self.xmax:
-                        self.xmax = vertex[0]
-                    if vertex[1] < self.ymin:
-                        self.ymin = vertex[1]
-                    if vertex[1] > self.ymax:
-                        self.ymax = vertex[1]
+def relativeControlPointPositions(distance, f_delta_x, f_delta_y, delta_x, delta_y):
+    """
+    Vectorized form of Hatch_Fill.RelativeControlPointPosition(): the points,
+    offset by delta_x, delta_y, which extend a distance of "distance" at the
+    slopes defined by f_delta_x and f_delta_y.
+    """
 
-    def recursivelyTraverseSvg(self, a_node_list):
-        """
-        Recursively walk the SVG document, building polygon vertex lists
-        for each graphical element we support.
+    f_slope = np.arctan2(f_delta_y, f_delta_x)
+    x = np.where(f_delta_x == 0, delta_x,
+                 np.where(f_delta_y == 0, np.copysign(distance, f_delta_x) + delta_x,
+                          distance * np.cos(f_slope) + delta_x))
+    y = np.where(f_delta_x == 0, np.copysign(distance, f_delta_y) + delta_y,
+                 np.where(f_delta_y == 0, delta_y,
+                          distance * np.sin(f_slope) + delta_y))
+    return x, y
 
-        Rendered SVG elements:
-            <circle>, <ellipse>, <line>, <path>, <polygon>, <polyline>, <rect>
 
-        Supported SVG elements:
-            <group>, <use>
+def segmentDistances(a, b, p):
+    """
+    Distances from the points p to the line segments from a to b, all
+    given as (n, 2) arrays.  Computed as inkex's
+    DirectedLineSegment.distance_to_point() does, so that flatness tests
+    agree with bezier.maxdist() to the last bit.
+    """
 
-        Ignored SVG elements:
-            <defs>, <eggbot>, <metadata>, <namedview>, <pattern>
+    vx = b[:, 0] - a[:, 0]
+    vy = b[:, 1] - a[:, 1]
+    wx = p[:, 0] - a[:, 0]
+    wy = p[:, 1] - a[:, 1]
+    dot2 = wx * vx + wy * vy
+    length = np.abs(vx + 1j * vy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = np.abs((vx * (a[:, 1] - p[:, 1])) - ((a[:, 0] - p[:, 0]) * vy)) / length
+    distance = np.where(vx * vx + vy * vy <= dot2, np.abs((b[:, 0] - p[:, 0]) + 1j * (b[:, 1] - p[:, 1])), distance)
+    return np.where(dot2 <= 0, np.abs((a[:, 0] - p[:, 0]) + 1j * (a[:, 1] - p[:, 1])), distance)
 
-        All other SVG elements trigger an error (including <text>)
 
-        Once a supported graphical element is found, we call functions to
-        create a hatchfill specific to this element. These hatches and their
-        corresponding transforms are stored in self.hatches and self.transforms
-        These two dictionaries are used when we return to the effect method
-        in joinFillsWithNode()
+def flattenSuperpath(csp, flat):
+    """
+    Flatten every subpath of the cubic superpath csp into a list of
+    vertices, splitting each Bezier curve in half until its control
+    points lie within [flat] of its chord (bezier.maxdist()), as
+    cspsubdiv.cspsubdiv() does.
+
+    Rather than splitting one curve at a time, all the curves of the
+    superpath are tested and split together, one level of subdivision per
+    array pass.  Each piece remembers its curve and where along it it
+    starts, so the vertices can be put back in order at the end.  The
+    vertices are the same, to the last bit, as splitting one curve at a
+    time with bezier.beziersplitatt() gives.
+    """
 
-        """
-        for node in a_node_list:
+    curves = []
+    for sp in csp:
+        for i in range(1, len(sp)):
+            curves.append((sp[i - 1][1], sp[i - 1][2], sp[i][0], sp[i][1]))
+
+    ends = []
+    curve_index = []
+    positions = []
+    if curves:
+        bez = np.array(curves, dtype=float)
+        index = np.arange(len(curves))
+        position = np.zeros(len(curves))
+        step = 1.0
+        for depth in range(N_MAX_SUBDIVISION_DEPTH + 1):
+            b_split = np.maximum(segmentDistances(bez[:, 0], bez[:, 3], bez[:, 1]),
+                                 segmentDistances(bez[:, 0], bez[:, 3], bez[:, 2])) > flat
+            if depth == N_MAX_SUBDIVISION_DEPTH:
+                b_split[:] = False
+            b_done = ~b_split
+            ends.append(bez[b_done, 3])
+            curve_index.append(index[b_done])
+            positions.append(position[b_done])
+            if not b_split.any():
+                break
 
-            """
-             Initialize dictionary for each new node
-             This allows us to create hatch fills as if each 
-             object to be hatched has been selected individually
+            # de Casteljau split at t = 0.5, as bezier.beziersplitatt()
+            bez = bez[b_split]
+            p0, p1, p2, p3 = bez[:, 0], bez[:, 1], bez[:, 2], bez[:, 3]
+            m1 = p0 + 0.5 * (p1 - p0)
+            m2 = p1 + 0.5 * (p2 - p1)
+            m3 = p2 + 0.5 * (p3 - p2)
+            m4 = m1 + 0.5 * (m2 - m1)
+            m5 = m2 + 0.5 * (m3 - m2)
+            m = m4 + 0.5 * (m5 - m4)
+            step /= 2
+            bez = np.concatenate((np.stack((p0, m1, m4, m), axis=1), np.stack((m, m5, m3, p3), axis=1)))
+            index = np.concatenate((index[b_split], index[b_split]))
+            position = np.concatenate((position[b_split], position[b_split] + step))
+
+        ends = np.concatenate(ends)
+        curve_index = np.concatenate(curve_index)
+        order = np.lexsort((np.concatenate(positions), curve_index))
+        ends = ends[order].tolist()
+        n_ends = np.bincount(curve_index, minlength=len(curves)).tolist()
+
+    subpaths = []
+    n_curve = 0
+    n_end = 0
+    for sp in csp:
+        vertices = [sp[0][1]] if len(sp) else []
+        for i in range(1, len(sp)):
+            vertices.extend(ends[n_end:n_end + n_ends[n_curve]])
+            n_end += n_ends[n_curve]
+            n_curve += 1
+        subpaths.append(vertices)
+    return subpaths
 
-            """
-            self.xmin, self.ymin = (0.0, 0.0)
-            self.xmax, self.ymax = (0.0, 0.0)
-            self.paths = {}
-            self.grid = []
 
-            if node.tag in [inkex.addNS('g', 'svg'), 'g']:
-                self.recursivelyTraverseSvg(node)
+def distanceSquared(p1, p2):
+    """
+    Pythagorean distance formula WITHOUT the square root.  Since
+    we just want to know if the distance is less than some fixed
+    fudge factor, we can just square the fudge factor once and run
+    with it rather than compute square roots over and over.
+    """
 
-            elif node.tag in [
-                inkex.addNS('path', 'svg'), 'path',
-                inkex.addNS('rect', 'svg'), 'rect', 
-                inkex.addNS('line', 'svg'), 'line', 
-                inkex.addNS('polyline', 'svg'), 'polyline', 
-                inkex.addNS('polygon', 'svg'), 'polygon', 
-                inkex.addNS('ellipse', 'svg'), 'ellipse',
-                inkex.addNS('circle', 'svg'), 'circle']:
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
 
-                self.addPathVertices(node)
-                # We now have a path we want to apply a (cross)hatch to
-                # Apply appropriate functions
-                b_have_grid = self.makeHatchGrid(float(self.options.hatchAngle), float(self.options.hatchSpacing), True)
-                if b_have_grid:
-                    if self.options.crossHatch:
-                        self.makeHatchGrid(float(self.options.hatchAngle + 90.0), float(self.options.hatchSpacing), False)
-                    # Now loop over our hatch lines looking for intersections
-                    for h in self.grid:
-                        interstices(self, (h[0], h[1]), (h[2], h[3]), self.paths, self.hatches, self.options.holdBackHatchFromEdges, self.options.holdBackSteps)
+    return dx * dx + dy * dy
 
-            elif node.tag in [inkex.addNS('use', 'svg'), 'use']:
-                inkex.errormsg('Warning: unable to hatch object <{0}>, please unlink any clones first.'.format(node.get_id()))
-                pass
-            elif node.tag in [inkex.addNS('text', 'svg'), 'text']:
-                inkex.errormsg('Warning: unable to draw text, please convert it to a path first.')
-                pass
-            else:
-                inkex.errormsg('Warning: unable to hatch object <{0}>, please convert it to a path first.'.format(node.get_id()))
-                pass
 
-    def joinFillsWithNode(self, node, stroke_width, path, transform_hatch_spacing):
+class SubpathArray(object):
+
+    """
+    The subpaths of an element held as a ragged array: the vertices of
+    all of them in one (n, 2) float64 buffer, subpath i being the rows
+    offsets[i] to offsets[i + 1].  The arrays are made read only, so an
+    instance may be shared, as the flatten_cache does.
+    """
+
+    def __init__(self, vertices, offsets):
+        self.vertices = vertices
+        self.offsets = offsets
+        self.vertices.flags.writeable = False
+        self.offsets.flags.writeable = False
+        self._digest = None
+        if len(vertices):
+            xmin, ymin = vertices.min(axis=0).tolist()
+            xmax, ymax = vertices.max(axis=0).tolist()
+            self.bounding_box = (xmin, xmax, ymin, ymax)
+        else:
+            self.bounding_box = None
+
+    @classmethod
+    def fromList(cls, subpaths):
+        offsets = np.zeros(len(subpaths) + 1, dtype=np.intp)
+        offsets[1:] = np.cumsum([len(subpath) for subpath in subpaths])
+        vertices = np.array([vertex for subpath in subpaths for vertex in subpath], dtype=float).reshape(-1, 2)
+        return cls(vertices, offsets)
 
+    @classmethod
+    def concatenate(cls, parts):
         """
-        Generate a SVG <path> element containing the path data "path".
-        Then put this new <path> element into a <group> with the supplied
-        node.  This means making a new <group> element and moving node
-        under it with the new <path> as a sibling element.
+        The subpaths of every SubpathArray of parts, in order, as one
         """
 
-        if not path or len(path) == 0:
-            return
+        vertices = np.concatenate([part.vertices for part in parts])
+        starts = np.cumsum([0] + [len(part.vertices) for part in parts[:-1]])
+        offsets = np.concatenate([[0]] + [part.offsets[1:] + start for part, start in zip(parts, starts)])
+        return cls(vertices, offsets.astype(np.intp))
 
-        # Make a new SVG <group> element whose parent is the parent of node
-        parent = node.getparent()
-        if parent is None:
-            parent = self.document.getroot()
-        g = etree.SubElement(parent, inkex.addNS('g', 'svg'))
-        # Move node to be a child of this new <g> element
-        g.append(node)
+    def __len__(self):
+        return len(self.offsets) - 1
 
-        # Now make a <path> element which contains the hatches & is a child
-        # of the new <g> element
-        stroke_color = None  # default assumption
-        stroke_width = str(transform_hatch_spacing)  # default value
-        has_set_stroke_color = False
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.vertices[self.offsets[i]:self.offsets[i + 1]]
 
-        try:
-            stroke_color = node.get("fill")
-            if stroke_color is None:
-                stroke_color = node.get("stroke")
-
-            if stroke_color is None:
-                style = node.get('style')
-                if style is not None:
-                    declarations = style.split(';')
-                    for i, declaration in enumerate(declarations):
-                        parts = declaration.split(':', 2)
-                        if len(parts) == 2:
-                            (prop, val) = parts
-                            prop = prop.strip().lower()
-                            if prop == 'stroke' and not has_set_stroke_color:
-                                val = val.strip()
-                                stroke_color = val
-                            elif prop == 'fill':
-                                val = val.strip()
-                                stroke_color = val
-                                has_set_stroke_color = True
-        finally:
-            style = {'stroke': '{0}'.format(stroke_color), 'fill': 'none', 'stroke-width': '{0}'.format(stroke_width)}
-            line_attribs = {'style': str(inkex.Style(style)), 'd': path}
+    @property
+    def nbytes(self):
+        return self.vertices.nbytes + self.offsets.nbytes
 
-            inverse_parent_transform = -node.getparent().composed_transform()
-            hatch = etree.SubElement(g, inkex.addNS('path', 'svg'), line_attribs)
-            hatch.transform = inverse_parent_transform
+    @property
+    def digest(self):
+        """
+        Hash of the vertices and offsets, identifying the polygons in the
+        keys of the StageCache entries made from them
+        """
 
-    def makeHatchGrid(self, angle, spacing, init=True):  # returns True if succeeds in making grid, else False
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.vertices.tobytes() + self.offsets.tobytes()).digest()
+        return self._digest
 
+    def edges(self):
         """
-        Build a grid of hatch lines which encompasses the entire bounding
-        box of the graphical elements we are to hatch.
-
-        1. Figure out the bounding box for all of the graphical elements
-        2. Pick a rectangle larger than that bounding box so that we can
-           later rotate the rectangle and still have it cover the bounding
-           box of the graphical elements.
-        3. Center the rectangle of 2 on the origin (0, 0).
-        4. Build the hatch line grid in this rectangle.
-        5. Rotate the rectangle by the hatch angle.
-        6. Translate the center of the rotated rectangle, (0, 0), to be
-           the center of the bounding box for the graphical elements.
-        7. We now have a grid of hatch lines which overlay the graphical
-           elements and can now be intersected with those graphical elements.
+        The (n, 4) array of (x3, y3, x4, y4) rows joining each vertex to
+        the next one of its subpath
         """
 
-        # If this is the first call, do some one time initializations
-        # When generating cross hatches, we may be called more than once
-        if init:
-            self.getBoundingBox()
-            self.grid = []
+        if len(self.vertices) < 2:
+            return np.empty((0, 4))
+        pairs = np.hstack((self.vertices[:-1], self.vertices[1:]))
+        starts = self.offsets[1:-1]
+        starts = starts[(starts > 0) & (starts < len(self.vertices))]
+        within = np.ones(len(pairs), dtype=bool)
+        within[starts - 1] = False
+        return pairs[within]
 
-        # Determine the width and height of the bounding box containing
-        # all the polygons to be hatched
-        w = self.xmax - self.xmin
-        h = self.ymax - self.ymin
 
-        b_bounding_box_exists = ((w != (EXTREME_NEG - EXTREME_POS)) and (h != (EXTREME_NEG - EXTREME_POS)))
-        ret_value = b_bounding_box_exists
+def appendHatches(hatches, key, segments):
+    """
+    Append the (n, 4) array of hatch segments (x1, y1, x2, y2) to those
+    held in hatches for key
+    """
 
-        if b_bounding_box_exists:
-            # Nice thing about rectangles is that the diameter of the circle
-            # encompassing them is the length the rectangle's diagonal...
-            r = math.sqrt(w * w + h * h) / 2.0
+    if key in hatches:
+        hatches[key] = np.concatenate((hatches[key], segments))
+    else:
+        hatches[key] = segments
 
-            # Length of a hatch line will be 2r
-            # Now generate hatch lines within the square
-            # centered at (0, 0) and with side length at least d
 
-            # While we could generate these lines running back and forth,
-            # that makes for weird behavior later when applying odd/even
-            # rules AND there are nested polygons.  Instead, when we
-            # generate the SVG <path> elements with the hatch line
-            # segments, we can do the back and forth weaving.
+def subpathsRegion(subpaths, fill_rule='evenodd'):
+    """
+    The region the polygons of the SubpathArray subpaths enclose, as a
+    shapely geometry, or None for no polygons.  The polygons are combined
+    by the odd/even rule the hatching uses, or by the nonzero winding
+    rule for fill_rule 'nonzero', SVG's default.
+    """
 
-            # Rotation information
-            ca = math.cos(math.radians(90 - angle))
-            sa = math.sin(math.radians(90 - angle))
+    from shapely.geometry import Polygon
+    from shapely.validation import make_valid
 
-            # Translation information
-            cx = self.xmin + (w / 2)
+    if fill_rule == 'nonzero':
+        return nonzeroRegion(subpaths)
+
+    region = None
+    for vertices in subpaths:
+        if len(vertices) < 3:
+            continue
+        ring = make_valid(Polygon(vertices.tolist()))
+        region = ring if region is None else region.symmetric_difference(ring)
+    return region
+
+
+def windingNumbers(points, vertices):
+    """
+    The winding number of the polygon vertices around each of the (n, 2)
+    array of points, as an array of n ints
+    """
+
+    x, y = points[:, 0:1], points[:, 1:2]
+    x1, y1 = vertices[:, 0], vertices[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    # Which side of each edge the points are on
+    side = (x2 - x1) * (y - y1) - (x - x1) * (y2 - y1)
+    upward = (y1 <= y) & (y2 > y) & (side > 0)
+    downward = (y1 > y) & (y2 <= y) & (side < 0)
+    return np.count_nonzero(upward, axis=1) - np.count_nonzero(downward, axis=1)
+
+
+def nonzeroRegion(subpaths):
+    """
+    The region the polygons of the SubpathArray subpaths enclose by the
+    nonzero winding rule, as a shapely geometry, or None for no polygons.
+    The outlines of the polygons cut the plane into faces, and the faces
+    the polygons wind around, in whichever direction, make the region:
+    a polygon inside another one drawn the same way adds nothing, one
+    drawn the other way cuts a hole.
+    """
+
+    from shapely.geometry import LineString
+    from shapely.ops import polygonize, unary_union
+
+    rings = [vertices for vertices in subpaths if len(vertices) >= 3]
+    if not rings:
+        return None
+    # Noded by their union, so that the faces do not overlap
+    outlines = unary_union([LineString(np.vstack((vertices, vertices[:1])).tolist()) for vertices in rings])
+    faces = [face for face in polygonize(outlines) if not face.is_empty]
+    if not faces:
+        return None
+    points = np.array([face.representative_point().coords[0] for face in faces], dtype=float)
+    winding = sum(windingNumbers(points, vertices) for vertices in rings)
+    region = unary_union([face for face, n in zip(faces, winding) if n != 0])
+    return None if region.is_empty else region
+
+
+def regionSubpaths(region):
+    """
+    The outlines of the polygons of the shapely geometry region, their
+    exteriors and holes, as a SubpathArray
+    """
+
+    rings = []
+    if region is not None:
+        for polygon in getattr(region, 'geoms', [region]):
+            if polygon.geom_type != 'Polygon' or polygon.is_empty:
+                continue
+            rings.append(list(polygon.exterior.coords))
+            rings.extend(list(interior.coords) for interior in polygon.interiors)
+    return SubpathArray.fromList(rings)
+
+
+def insetSubpaths(subpaths, distance):
+    """
+    Inset the polygons of the SubpathArray subpaths by distance, with
+    shapely, and return the outlines of what is left as a SubpathArray.
+    The subpaths are combined by the odd/even rule the hatching uses.
+    """
+
+    region = subpathsRegion(subpaths)
+    if region is None:
+        return SubpathArray.fromList([])
+
+    # Mitred joins keep the inset edges parallel to the original ones
+    return regionSubpaths(region.buffer(-distance, join_style=2, mitre_limit=10.0))
+
+
+def visibleSubpaths(elements):
+    """
+    The visible part of each of the (subpaths, b_occludes, fill_rule)
+    elements, given in paint order: what is left of its polygons once the
+    regions of the occluding elements painted after it, filled by their
+    own fill_rule, are taken away.  Returns
+    a list with a SubpathArray for each element, the element's own
+    subpaths when nothing covers them.  Only elements whose bounding
+    boxes overlap are compared.
+    """
+
+    from shapely.ops import unary_union
+
+    boxes = np.array([subpaths.bounding_box for subpaths, _, _ in elements], dtype=float).reshape(-1, 4)
+    occluding = np.array([b_occludes for _, b_occludes, _ in elements], dtype=bool)
+    regions = {}
+
+    def region(i, fill_rule='evenodd'):
+        # An element is hatched by the odd/even rule, but covers what is
+        # under it by the rule it is filled with
+        if (i, fill_rule) not in regions:
+            regions[(i, fill_rule)] = subpathsRegion(elements[i][0], fill_rule)
+        return regions[(i, fill_rule)]
+
+    visible = []
+    for i, (subpaths, _, _) in enumerate(elements):
+        xmin, xmax, ymin, ymax = boxes[i]
+        later = np.arange(len(elements)) > i
+        overlapping = later & occluding & (boxes[:, 0] <= xmax) & (boxes[:, 1] >= xmin) & \
+            (boxes[:, 2] <= ymax) & (boxes[:, 3] >= ymin)
+        occluders = [region(j, elements[j][2]) for j in np.flatnonzero(overlapping)]
+        occluders = [occluder for occluder in occluders if occluder is not None]
+        own = region(i) if occluders else None
+        if own is None:
+            visible.append(subpaths)
+            continue
+        cover = unary_union(occluders)
+        if not own.intersects(cover):
+            visible.append(subpaths)
+            continue
+        visible.append(regionSubpaths(own.difference(cover)))
+    return visible
+
+
+class PathData(object):
+
+    """
+    Hatch path data held as command codes and their coordinates in
+    arrays preallocated for n_segments hatch segments.  A segment adds at
+    most a move, a line and a joining curve, so the arrays never grow.
+    The data is serialized only once, by str(), and consumers wanting the
+    geometry can read codes and coordinates directly.
+
+        MOVE   x,y               absolute
+        LINE   dx,dy             relative
+        CURVE  x1,y1 x2,y2 x,y   relative cubic Bezier
+    """
+
+    MOVE, LINE, CURVE = 0, 1, 2
+    TEMPLATES = ('M %f,%f ', 'l %f,%f ', 'c %f,%f %f,%f %f,%f ')
+
+    def __init__(self, n_segments):
+        self.codes = np.empty(3 * n_segments, dtype=np.uint8)
+        self.coordinates = np.empty(10 * n_segments)
+        self.n_codes = 0
+        self.n_coordinates = 0
+        # The path_cache key the path is stored under, if any
+        self.key = None
+        # The path this one is a translated copy of and the offset, if any
+        self.source = None
+
+    def __len__(self):
+        return self.n_codes
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.coordinates.nbytes
+
+    def __str__(self):
+        codes = self.codes[:self.n_codes].tolist()
+        template = ''.join([PathData.TEMPLATES[code] for code in codes])
+        return (template % tuple(self.coordinates[:self.n_coordinates].tolist()))[:-1]
+
+    def append(self, code, *coordinates):
+        self.codes[self.n_codes] = code
+        self.n_codes += 1
+        n = self.n_coordinates
+        self.coordinates[n:n + len(coordinates)] = coordinates
+        self.n_coordinates = n + len(coordinates)
+
+    def move(self, x, y):
+        self.append(PathData.MOVE, x, y)
+
+    def line(self, dx, dy):
+        self.append(PathData.LINE, dx, dy)
+
+    def curve(self, x1, y1, x2, y2, x, y):
+        self.append(PathData.CURVE, x1, y1, x2, y2, x, y)
+
+    def segments(self, starts, deltas):
+        """
+        Append a move to each of the (n, 2) array of starts, each followed
+        by a line by the same row of deltas
+        """
+
+        n = len(starts)
+        codes = self.codes[self.n_codes:self.n_codes + 2 * n]
+        codes[0::2] = PathData.MOVE
+        codes[1::2] = PathData.LINE
+        self.n_codes += 2 * n
+        self.coordinates[self.n_coordinates:self.n_coordinates + 4 * n] = np.hstack((starts, deltas)).ravel()
+        self.n_coordinates += 4 * n
+
+    def translated(self, dx, dy):
+
+        """
+        A copy of the path moved by (dx, dy).  Only the moves are absolute,
+        so only their coordinates change.
+        """
+
+        path = PathData(0)
+        path.codes = self.codes[:self.n_codes]
+        path.coordinates = self.coordinates[:self.n_coordinates].copy()
+        path.n_codes, path.n_coordinates = self.n_codes, self.n_coordinates
+        n_pairs = np.array([1, 1, 3])[path.codes]
+        moves = 2 * (np.cumsum(n_pairs) - n_pairs)[path.codes == PathData.MOVE]
+        path.coordinates[moves] += dx
+        path.coordinates[moves + 1] += dy
+        if self.key is not None:
+            path.key = (self.key, dx, dy)
+        path.source = (self, complex(dx, dy))
+        return path
+
+    @classmethod
+    def concatenate(cls, paths):
+
+        """
+        The paths drawn one after the other, as one path.  Each starts
+        with a move, so their data is simply put end to end.
+        """
+
+        path = cls(0)
+        path.codes = np.concatenate([part.codes[:part.n_codes] for part in paths])
+        path.coordinates = np.concatenate([part.coordinates[:part.n_coordinates] for part in paths])
+        path.n_codes, path.n_coordinates = len(path.codes), len(path.coordinates)
+        if all(part.key is not None for part in paths):
+            path.key = ("concatenated",) + tuple(part.key for part in paths)
+        return path
+
+    def lines(self, quantization):
+
+        """
+        The path as a list of polylines, each an array of absolute complex
+        points.  Curves are flattened into segments no longer than
+        quantization, as vpype does when reading an SVG.
+        """
+
+        lines = []
+        coordinates = self.coordinates[:self.n_coordinates].tolist()
+        n = 0
+        for code in self.codes[:self.n_codes].tolist():
+            if code == PathData.MOVE:
+                pt = complex(coordinates[n], coordinates[n + 1])
+                line = [pt]
+                lines.append(line)
+                n += 2
+            elif code == PathData.LINE:
+                pt += complex(coordinates[n], coordinates[n + 1])
+                line.append(pt)
+                n += 2
+            else:
+                p1 = pt + complex(coordinates[n], coordinates[n + 1])
+                p2 = pt + complex(coordinates[n + 2], coordinates[n + 3])
+                p3 = pt + complex(coordinates[n + 4], coordinates[n + 5])
+                # The control polygon is never shorter than the curve
+                n_segments = max(1, math.ceil((abs(p1 - pt) + abs(p2 - p1) + abs(p3 - p2)) / quantization))
+                t = np.linspace(0.0, 1.0, n_segments + 1)[1:]
+                u = 1.0 - t
+                line.extend((u * u * u * pt + 3.0 * u * u * t * p1 + 3.0 * u * t * t * p2 + t * t * t * p3).tolist())
+                pt = p3
+                n += 6
+        return [np.array(line) for line in lines]
+
+
+class StageCache(object):
+
+    """
+    Least recently used cache of the results of one stage of the hatch
+    pipeline, shared by every Hatch_Fill in the process and so by every
+    request it serves.  Keys hold only what the stage's result depends
+    on: the digests of the polygons hatched and the options the stage
+    reads, so that a request differing from an earlier one only in the
+    options of later stages finds the earlier stages here.  Values are
+    shared, never modified, and their total size is kept under
+    n_max_bytes.
+    """
+
+    def __init__(self, name, n_max_bytes):
+        self.name = name
+        self.n_max_bytes = n_max_bytes
+        self.n_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value stored under key, or None
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, n_bytes):
+        """
+        Store value, taking about n_bytes, under key
+        """
+
+        n_bytes += 64
+        if n_bytes > self.n_max_bytes:
+            return
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, n_bytes)
+                self.n_bytes += n_bytes
+                while self.n_bytes > self.n_max_bytes:
+                    _, (_, n_evicted) = self.entries.popitem(last=False)
+                    self.n_bytes -= n_evicted
+
+
+def valueBytes(value):
+    """
+    Approximate size in bytes of a value kept in a StageCache: its
+    arrays, and the arrays of the tuples, lists and dicts it is made of
+    """
+
+    if isinstance(value, (tuple, list)):
+        return sum(valueBytes(item) for item in value) + 8 * len(value)
+    if isinstance(value, dict):
+        return sum(valueBytes(item) for item in value.items()) + 100 * len(value)
+    if isinstance(value, str):
+        return len(value)
+    return getattr(value, 'nbytes', 32)
+
+
+class FlattenCache(StageCache):
+
+    """
+    The cache of the first stage, flattened polygons.  Entries are keyed
+    by a hash of the element's path data together with its composed
+    transform and the flattening tolerance, so re-hatching a document
+    with other hatch settings skips parsing and flattening its paths.
+    Each entry holds the SubpathArray, shared by every document using it.
+    """
+
+    def __init__(self, n_max_bytes):
+        super().__init__("flatten", n_max_bytes)
+
+    @staticmethod
+    def key(node, transform, tolerance):
+        if node.tag in [inkex.addNS('path', 'svg'), 'path']:
+            data = node.get('d') or ''
+        else:
+            data = repr(sorted((k, v) for k, v in node.attrib.items() if k not in ('id', 'style')))
+        digest = hashlib.sha1((node.tag + data).encode('utf-8')).digest()
+        return digest, transform.matrix, tolerance
+
+    def put(self, key, subpaths):
+        """
+        Store the SubpathArray subpaths under key
+        """
+
+        super().put(key, subpaths, subpaths.nbytes)
+
+
+flatten_cache = FlattenCache(N_FLATTEN_CACHE_BYTES)
+
+# The later stages: hatch grid, raw intersections of the grid with the
+# edges, hatch segments after holding back and the odd/even rule, joined
+# path data and its emission as polylines
+grid_cache = StageCache("grid", N_STAGE_CACHE_BYTES)
+intersection_cache = StageCache("intersections", N_STAGE_CACHE_BYTES)
+segment_cache = StageCache("segments", N_STAGE_CACHE_BYTES)
+path_cache = StageCache("paths", N_STAGE_CACHE_BYTES)
+emission_cache = StageCache("emission", N_STAGE_CACHE_BYTES)
+
+# What the process pool gives back for an element, kept where the pool is
+# used; the workers keep the stages in caches of their own
+element_cache = StageCache("elements", N_STAGE_CACHE_BYTES)
+
+# The hatches of whole documents by result_handle(), for re-hatching them
+# once edited
+result_cache = StageCache("results", N_STAGE_CACHE_BYTES)
+
+
+class HatchStats(object):
+    """
+    Stage timers and counters of a Hatch_Fill run.  Timings accumulate
+    seconds per stage over every element; counters accumulate numbers.
+    Runs hatching on the process pool merge in the stats of their
+    workers, so there a stage time is summed over the workers.
+
+    Stages:    parse, flatten, occlusion, grid, inset, interstices,
+               penlift, join, pool, vpype, estimate and serialize (left
+               to the caller)
+    Counters:  elements, clones, grouped_elements, occluded_elements,
+               reused_elements, edges, grid_lines, intersections,
+               segments, pen_lifts, distance_moved_with_pen_up
+               (user units, only when reducing pen lifts), and
+               cached_<stage> for each result taken from the
+               StageCache of a stage instead of computed
+    """
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        for name, seconds in other.timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def as_dict(self):
+        return {
+            "timings_ms": {name: round(seconds * 1000, 3) for name, seconds in self.timings.items()},
+            "counters": dict(self.counters),
+        }
+
+    def server_timing(self):
+        """
+        The stats as a Server-Timing header value: a duration for each
+        stage and the counters as descriptions
+        """
+
+        metrics = ['{0};dur={1:.3f}'.format(name, seconds * 1000) for name, seconds in self.timings.items()]
+        metrics += ['{0};desc="{1:g}"'.format(name, n) for name, n in self.counters.items()]
+        return ', '.join(metrics)
+
+
+class SegmentEndGrid(object):
+    """
+    Grid hash over the end points of the hatch segments that the pen lift
+    reduction may join.  The cells are as wide as the neighborhood radius
+    searched for a segment to join, so every end point within that radius
+    of another lies in the 3 x 3 block of cells around it.
+
+    End e is end e & 1 of segment e >> 1, the row e of points.  The ends
+    are sorted by cell, a cell being numbered column by column, so the
+    three cells of a column of the block are one run of the sorted ends,
+    found by bisection for many ends at once.
+    """
+
+    def __init__(self, ends, f_radius_squared):
+        # ends is the N x 4 array of segments
+        self.points = ends.reshape(-1, 2)
+        self.f_cell_size = math.sqrt(f_radius_squared) if f_radius_squared > 0 else 0.0
+        if self.f_cell_size == 0.0 or len(self.points) == 0:
+            self.f_cell_size = 0.0
+            return  # Nothing is ever within a zero radius
+        cells = np.floor(self.points / self.f_cell_size).astype(np.int64)
+        # Margins of one cell, so that the block around any end is on the grid
+        cells -= cells.min(axis=0) - 1
+        self.n_rows = int(cells[:, 1].max()) + 2
+        self.cell_numbers = cells[:, 0] * self.n_rows + cells[:, 1]
+        self.order = np.argsort(self.cell_numbers, kind='stable')
+        self.sorted_cell_numbers = self.cell_numbers[self.order]
+
+    def pairs(self, ref_ends):
+        """
+        Return the arrays (ref_ends, near_ends) pairing each of the ends
+        ref_ends with every end in the block of cells around it, itself
+        included, the pairs of each reference end together.
+        """
+
+        if self.f_cell_size == 0.0 or len(ref_ends) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        # The runs of the three columns of each block, end by end
+        runs = (self.cell_numbers[ref_ends, None] + self.n_rows * np.arange(-1, 2)).ravel()
+        firsts = np.searchsorted(self.sorted_cell_numbers, runs - 1, side='left')
+        counts = np.searchsorted(self.sorted_cell_numbers, runs + 1, side='right') - firsts
+        n_pairs = np.cumsum(counts)
+        positions = np.arange(n_pairs[-1]) + np.repeat(firsts - (n_pairs - counts), counts)
+        return np.repeat(np.repeat(ref_ends, 3), counts), self.order[positions]
+
+
+class Clone(object):
+
+    """
+    A graphical element drawn by a <use> element: node, in the content
+    the outermost of uses references, drawn in the document with the
+    composed transform transform.  uses are the <use> elements node is
+    drawn through, outermost first.  A Clone stands in for the element
+    wherever Hatch_Fill keys its state by element, answering the few
+    element methods it calls; the Clones of every traversal of the
+    document are equal.
+
+    Hatching an element only depends on where it is up to a translation,
+    the hatch grid being centred on its bounding box, so a Clone is
+    flattened with local_transform, its transform without the
+    translation, and hatched there.  Clones of node with the same linear
+    part then have the same polygons, which the stage caches hatch once
+    for all of them, and each only moves its hatches by offset, the
+    translation, see Hatch_Fill.placedPath().  A rotated, scaled or
+    skewed clone has other polygons and is hatched in its own right, so
+    the hatch angle and spacing stay those of the document.
+    """
+
+    def __init__(self, uses, node, transform):
+        self.uses = uses
+        self.use = uses[0]
+        self.node = node
+        self.tag = node.tag
+        self.transform = Transform(transform)
+        self.local_transform = Transform((self.transform.a, self.transform.b, self.transform.c, self.transform.d, 0.0, 0.0))
+        self.offset = (self.transform.e, self.transform.f)
+
+    def __eq__(self, other):
+        return isinstance(other, Clone) and self.node is other.node and self.uses == other.uses
+
+    def __hash__(self):
+        return hash((self.uses, self.node))
+
+    def composed_transform(self):
+        return self.transform
+
+    def get(self, name, default=None):
+        """
+        The attribute name of node, but for the id, which is made of the
+        ids of the outermost <use> and of node so that it names the clone
+        """
+
+        if name != 'id':
+            return self.node.get(name, default)
+        if self.use.get('id') is None or self.node.get('id') is None:
+            return default
+        return '{0}-{1}'.format(self.use.get('id'), self.node.get('id'))
+
+    def get_id(self):
+        return '{0}-{1}'.format(self.use.get_id(), self.node.get_id())
+
+    def iterancestors(self):
+        """
+        The elements the clone is drawn from: node and its ancestors,
+        then each <use>, innermost first, and its ancestors
+        """
+
+        yield self.node
+        yield from self.node.iterancestors()
+        for use in reversed(self.uses):
+            yield use
+            yield from use.iterancestors()
+
+    def specified_style(self):
+        # node inherits from the <use> elements, not from its own ancestors alone
+        style = self.use.specified_style()
+        for element in self.uses[1:] + (self.node,):
+            style = style + element.specified_style()
+        return style
+
+
+class Compound(object):
+
+    """
+    The graphical elements nodes, children of the element parent, of
+    --groupFills drawn in the one colour stroke_color, hatched as a
+    single shape: their polygons together, in document coordinates, make
+    one even-odd region, with one grid over its bounding box and one
+    sweep of its edges, and one hatch path in stroke_color.  A Compound
+    stands in for its elements as a Clone does for its own.
+    """
+
+    def __init__(self, parent, stroke_color, nodes):
+        self.parent = parent
+        self.stroke_color = stroke_color
+        self.nodes = nodes
+
+    def get(self, name, default=None):
+        # Not an element of the document, so without attributes, its id included
+        return default
+
+
+def symbolTransform(use, symbol):
+    """
+    The transform from the viewBox of the <symbol> element symbol to the
+    viewport the <use> element use gives it, the identity unless both
+    have a size
+    """
+
+    viewbox = symbol.get('viewBox')
+    width, height = use.get('width'), use.get('height')
+    if viewbox is None or width is None or height is None or '%' in width + height:
+        return Transform()
+    vx, vy, vw, vh = [float(value) for value in viewbox.replace(',', ' ').split()]
+    width, height = use.to_dimensionless(width), use.to_dimensionless(height)
+    if vw <= 0 or vh <= 0:
+        return Transform()
+    align, _, meet_or_slice = (symbol.get('preserveAspectRatio') or 'xMidYMid').strip().partition(' ')
+    if align == 'none':
+        sx, sy = width / vw, height / vh
+        tx, ty = 0.0, 0.0
+    else:
+        sx = sy = (max if meet_or_slice.strip() == 'slice' else min)(width / vw, height / vh)
+        fractions = {'Min': 0.0, 'Mid': 0.5, 'Max': 1.0}
+        tx = (width - vw * sx) * fractions.get(align[1:4], 0.5)
+        ty = (height - vh * sy) * fractions.get(align[5:8], 0.5)
+    return Transform(translate=(tx, ty)) @ Transform(scale=(sx, sy)) @ Transform(translate=(-vx, -vy))
+
+
+class Hatch_Fill(inkex.Effect):
+
+    def __init__(self):
+
+        inkex.Effect.__init__(self)
+
+        self.xmin, self.ymin = (0.0, 0.0)
+        self.xmax, self.ymax = (0.0, 0.0)
+        self.paths = {}
+        self.grid = []
+        self.grid_angles = []
+        self.hatches = {}
+        self.transforms = {}
+        self.offsets = {}
+        self.hatch_groups = {}
+        self.elements = []
+        self.hatch_paths = []
+        self.segment_keys = {}
+        self.join_fills = True
+        self.variants = []
+        self.edge_indexes = None
+        self.visible = None
+        self.nodes = None
+        self.stats = HatchStats()
+        self.cancel_token = CancelToken()
+        self.pt_last_position_abs = [0, 0]
+
+        # For handling an SVG viewbox attribute, we will need to know the
+        # values of the document's <svg> width and height attributes as well
+        # as establishing a transform from the viewbox to the display.
+        self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+        # The options are registered once, on the parser every instance shares
+        self.arg_parser = optionParser()
+
+    @staticmethod
+    def addOptions(pars):
+
+        """
+        Register the Hatch_Fill options on the argument parser pars
+        """
+
+        pars.add_argument(
+                '--unit', type = str,
+                default = 'mm',
+                help = 'Unit')
+        pars.add_argument(
+                "--holdBackSteps", type=float,
+                default=3.0,
+                help="How far hatch strokes stay from boundary (steps)")
+        pars.add_argument(
+                "--hatchScope", type=float,
+                default=3.0,
+                help="Radius searched for segments to join (units of hatch width)")
+        pars.add_argument(
+                "--holdBackHatchFromEdges",
+                type=inkex.Boolean, default=True,
+                help="Stay away from edges, so no need for inset")
+        pars.add_argument(
+                "--holdBackMode", type=str,
+                default="trim", choices=HOLD_BACK_MODES,
+                help="Hold back by trimming each hatch at the edge it meets, or by insetting the polygons once")
+        pars.add_argument(
+                "--reducePenLifts",
+                type=inkex.Boolean, default=True,
+                help="Reduce plotting time by joining some hatches")
+        pars.add_argument(
+                "--crossHatch",
+                type=inkex.Boolean, default=False,
+                help="Generate a cross hatch pattern")
+        pars.add_argument(
+                "--hatchAngle", type=float,
+                default=90.0,
+                help="Angle of inclination for hatch lines")
+        pars.add_argument(
+                "--hatchSpacing", type=float,
+                default=10.0,
+                help="Spacing between hatch lines")
+        pars.add_argument(
+                "--tolerance", type=float,
+                default=20.0,
+                help="Allowed deviation from original paths")
+        pars.add_argument(
+                "--occlusion",
+                type=inkex.Boolean, default=False,
+                help="Hatch only the parts of each shape not covered by the filled shapes painted over it")
+        pars.add_argument(
+                "--joinSameColour",
+                type=inkex.Boolean, default=False,
+                help="Reduce pen lifts across all the elements of a colour, not element by element")
+        pars.add_argument(
+                "--groupFills",
+                type=inkex.Boolean, default=False,
+                help="Hatch the elements of a group sharing a fill as one compound shape")
+        pars.add_argument(
+                "--hatchEngine", type=str,
+                default="numpy", choices=HATCH_ENGINES,
+                help="Intersection engine: batched numpy arrays or the line by line python reference")
+        pars.add_argument(
+                "--processes", type=int,
+                default=1,
+                help="Processes hatching elements in parallel (0 uses every core)")
+
+    def handleViewBox(self):
+
+        """
+        Set up the document-wide transform in the event that the document has an SVG viewbox
+        """
+
+        self.docTransform = Transform(f"scale({self.svg.scale},{self.svg.scale}")
+
+    def addPathVertices(self, node):
+
+        """
+        Decompose the path data from an SVG element into individual
+        subpaths, each starting with an absolute move-to (x, y)
+        coordinate followed by one or more absolute line-to (x, y)
+        coordinates.  The subpaths are held together in a SubpathArray,
+        the first vertex of each understood to be a move-to coordinate
+        and the rest line-to coordinates, which is then stored in the
+        self.paths dictionary using the path's lxml.etree node pointer
+        as the dictionary key.  Elements already flattened with the same
+        transform and tolerance are taken from the flatten_cache.  A Clone
+        is flattened without the translation of its transform, which is
+        kept in self.offsets.
+        """
+
+        if isinstance(node, Clone):
+            shape, transform = node.node, node.local_transform
+        else:
+            shape, transform = node, node.composed_transform()
+        tolerance = float(self.options.tolerance / 100)
+
+        key = FlattenCache.key(shape, transform, tolerance)
+        subpaths = flatten_cache.get(key)
+        if subpaths is None:
+            subpaths = self.flattenPathVertices(shape, transform, tolerance)
+            flatten_cache.put(key, subpaths)
+
+        # Empty path?
+        if len(subpaths) == 0:
+            return
+
+        # And add this path to our dictionary of paths
+        self.paths[node] = subpaths
+
+        # And save the transform for this element in a dictionary keyed
+        # by the element's lxml node pointer
+        self.transforms[node] = node.composed_transform()
+        if isinstance(node, Clone) and node.offset != (0.0, 0.0):
+            self.offsets[node] = node.offset
+
+    def addCompoundVertices(self, compound):
+
+        """
+        Flatten the elements of the Compound compound as addPathVertices()
+        does and store their polygons together in self.paths under
+        compound, in document coordinates.  Under --occlusion, each element
+        adds only its visible part.
+        """
+
+        parts = []
+        transform = None
+        for node in compound.nodes:
+            self.addPathVertices(node)
+            if node not in self.paths:
+                continue
+            if self.visible is not None and node in self.visible:
+                parts.append(self.visible[node])
+            else:
+                parts.append(self.documentSubpaths(node))
+            if transform is None:
+                transform = self.transforms[node]
+            del self.transforms[node]
+            self.offsets.pop(node, None)
+            del self.paths[node]
+
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return
+        self.paths[compound] = SubpathArray.concatenate(parts)
+        # The hatches are drawn as wide as those of the first element
+        self.transforms[compound] = transform
+
+    def documentSubpaths(self, node):
+
+        """
+        The polygons of node in self.paths, in document coordinates: moved
+        by the offset of a Clone
+        """
+
+        subpaths = self.paths[node]
+        offset = self.offsets.get(node)
+        if offset is None:
+            return subpaths
+        return SubpathArray(subpaths.vertices + offset, subpaths.offsets)
+
+    def flattenPathVertices(self, node, transform, tolerance):
+
+        """
+        Return the closed subpaths of node, transformed and flattened
+        into polygons, as a SubpathArray
+        """
+
+        if node.tag in [
+                inkex.addNS('rect', 'svg'), 'rect', 
+                inkex.addNS('line', 'svg'), 'line', 
+                inkex.addNS('polyline', 'svg'), 'polyline', 
+                inkex.addNS('polygon', 'svg'), 'polygon', 
+                inkex.addNS('ellipse', 'svg'), 'ellipse',
+                inkex.addNS('circle', 'svg'), 'circle']:
+            # We use a copy for the shapes, don't want to convert everything to a path
+            node_as_path = node.to_path_element()
+            p = node_as_path.path
+        else:
+            p = node.path
+
+        # Get a cubic super duper path  
+        p = p.transform(transform).to_superpath()
+        
+        # Now traverse the simplified path
+        subpaths = []
+        subpath_vertices = []
+        for vertices in flattenSuperpath(p, tolerance):
+            # We've started a new subpath
+            # See if there is a prior subpath and whether we should keep it
+            if len(subpath_vertices):
+                if distanceSquared(subpath_vertices[0], subpath_vertices[-1]) < 1:
+                    # Keep the prior subpath: it appears to be a closed path
+                    subpaths.append(subpath_vertices)
+            subpath_vertices = vertices
+
+        # Handle final subpath
+        if len(subpath_vertices):
+            if distanceSquared(subpath_vertices[0], subpath_vertices[-1]) < 1:
+                # Path appears to be closed so let's keep it
+                subpaths.append(subpath_vertices)
+
+        return SubpathArray.fromList(subpaths)
+
+    def getBoundingBox(self):
+
+        """
+        Determine the bounding box for our collection of polygons
+        """
+
+        self.xmin, self.xmax = EXTREME_POS, EXTREME_NEG
+        self.ymin, self.ymax = EXTREME_POS, EXTREME_NEG
+        for path in self.paths:
+            if self.paths[path].bounding_box is None:
+                continue
+            # Known since flattening
+            xmin, xmax, ymin, ymax = self.paths[path].bounding_box
+            self.xmin = min(self.xmin, xmin)
+            self.xmax = max(self.xmax, xmax)
+            self.ymin = min(self.ymin, ymin)
+            self.ymax = max(self.ymax, ymax)
+
+    def recursivelyTraverseSvg(self, a_node_list):
+        """
+        Recursively walk the SVG document, building polygon vertex lists
+        for each graphical element we support.
+
+        Rendered SVG elements:
+            <circle>, <ellipse>, <line>, <path>, <polygon>, <polyline>, <rect>
+
+        Supported SVG elements:
+            <group>, <use>, drawing the <symbol> or element it references
+            as Clones
+
+        Ignored SVG elements:
+            <defs>, <eggbot>, <metadata>, <namedview>, <pattern>, <symbol>
+
+        All other SVG elements trigger an error (including <text>)
+
+        Once a supported graphical element is found, we call functions to
+        create a hatchfill specific to this element. These hatches and their
+        corresponding transforms are stored in self.hatches and self.transforms
+        These two dictionaries are used when we return to the effect method
+        in joinFillsWithNode()
+
+        With --groupFills, the elements are hatched as the Compounds of
+        groupFills() instead.
+
+        """
+        nodes = self.iterShapeElements(a_node_list)
+        if self.options.groupFills:
+            nodes = self.groupFills(nodes)
+        for node in nodes:
+            self.hatchElement(node)
+
+    def groupFills(self, nodes):
+
+        """
+        Gather the graphical elements nodes by parent and hatch colour, in
+        a Compound for each, yielded in document order of their first
+        element.  The parent of a Clone is that of its outermost <use>.
+        An element alone with its colour in its parent is yielded as is.
+        """
+
+        groups = collections.OrderedDict()
+        for node in nodes:
+            parent = (node.use if isinstance(node, Clone) else node).getparent()
+            groups.setdefault((parent, self.hatchStrokeColor(node)), []).append(node)
+        for (parent, stroke_color), members in groups.items():
+            yield members[0] if len(members) == 1 else Compound(parent, stroke_color, members)
+
+    def hatchElement(self, node):
+
+        """
+        Flatten the graphical element node and hatch it, or queue it for
+        hatchInParallel() when hatching on the process pool
+        """
+
+        self.cancel_token.check()
+
+        # Initialize dictionary for each new node
+        # This allows us to create hatch fills as if each
+        # object to be hatched has been selected individually
+        self.xmin, self.ymin = (0.0, 0.0)
+        self.xmax, self.ymax = (0.0, 0.0)
+        self.paths = {}
+        self.grid = []
+        self.grid_angles = []
+
+        with self.stats.stage("flatten"):
+            if isinstance(node, Compound):
+                self.addCompoundVertices(node)
+            else:
+                self.addPathVertices(node)
+        if self.visible is not None and node in self.visible and node in self.paths:
+            # In document coordinates, a Clone's offset included
+            self.paths[node] = self.visible[node]
+            self.offsets.pop(node, None)
+            if len(self.paths[node]) == 0:
+                # Hidden under the shapes painted over it
+                del self.paths[node]
+        if node in self.paths:
+            self.stats.count("elements")
+            if isinstance(node, Clone):
+                self.stats.count("clones")
+            if isinstance(node, Compound):
+                self.stats.count("grouped_elements", len(node.nodes))
+        if self.options.processes != 1:
+            # Hatched later on, see hatchInParallel()
+            if node in self.paths:
+                self.elements.append((node, self.paths[node]))
+        else:
+            # We now have a path we want to apply a (cross)hatch to
+            self.hatchPaths()
+
+    def iterShapeElements(self, a_node_list, b_warn=True, uses=()):
+
+        """
+        Yield the graphical elements we can hatch, in document order,
+        descending into groups and the content of <use> elements, whose
+        elements are yielded as Clones, and warning about the elements we
+        can't unless b_warn is False.  uses are the <use> elements whose
+        content a_node_list is, outermost first.
+        """
+
+        for node in a_node_list:
+
+            if node.tag in [inkex.addNS('g', 'svg'), 'g']:
+                yield from self.iterShapeElements(node, b_warn, uses)
+
+            elif node.tag in [inkex.addNS('use', 'svg'), 'use']:
+                yield from self.iterClones(node, b_warn, uses)
+
+            elif node.tag in [inkex.addNS('defs', 'svg'), 'defs', inkex.addNS('symbol', 'svg'), 'symbol']:
+                # Only drawn through <use>
+                pass
+
+            elif node.tag in [
+                inkex.addNS('path', 'svg'), 'path',
+                inkex.addNS('rect', 'svg'), 'rect', 
+                inkex.addNS('line', 'svg'), 'line', 
+                inkex.addNS('polyline', 'svg'), 'polyline', 
+                inkex.addNS('polygon', 'svg'), 'polygon', 
+                inkex.addNS('ellipse', 'svg'), 'ellipse',
+                inkex.addNS('circle', 'svg'), 'circle']:
+
+                yield node
+
+            elif not b_warn:
+                pass
+            elif node.tag in [inkex.addNS('text', 'svg'), 'text']:
+                inkex.errormsg('Warning: unable to draw text, please convert it to a path first.')
+                pass
+            else:
+                inkex.errormsg('Warning: unable to hatch object <{0}>, please convert it to a path first.'.format(node.get_id()))
+                pass
+
+    def iterClones(self, use, b_warn=True, uses=()):
+
+        """
+        Yield a Clone for each graphical element the <use> element use
+        draws, in document order.  uses are the <use> elements use itself
+        is drawn through, outermost first.  A <use> referencing nothing,
+        or content that draws it, draws nothing.
+        """
+
+        href = use.href
+        if href is None or any(href is outer.href for outer in uses):
+            if b_warn:
+                inkex.errormsg('Warning: unable to hatch clone <{0}>, its original is missing or holds the clone.'.format(use.get_id()))
+            return
+        uses = uses + (use,)
+
+        # The transform of the content in the document and in the tree
+        transform = use.composed_transform() @ Transform(
+            translate=(use.to_dimensionless(use.get('x', 0)), use.to_dimensionless(use.get('y', 0))))
+        if href.tag in [inkex.addNS('symbol', 'svg'), 'symbol']:
+            a_node_list = href
+            transform = transform @ symbolTransform(use, href)
+            frame = href.composed_transform()
+        else:
+            a_node_list = [href]
+            frame = href.getparent().composed_transform()
+        to_clone = transform @ -frame
+
+        for node in self.iterShapeElements(a_node_list, b_warn, uses):
+            if isinstance(node, Clone):
+                # Drawn through a <use> in the content, uses already included
+                yield Clone(node.uses, node.node, to_clone @ node.transform)
+            else:
+                yield Clone(uses, node, to_clone @ node.composed_transform())
+
+    def hatchPaths(self):
+
+        """
+        Hatch the polygons in self.paths, adding their hatch segments to
+        self.hatches under the same keys.  The segments are the result of
+        the pipeline of stages hatchSegments() runs, memoized in the
+        segment_cache.
+        """
+
+        segments_key = self.segmentsKey()
+        keys = list(self.paths)
+        for n_path, segments in self.memoized(segment_cache, segments_key, self.hatchSegments):
+            appendHatches(self.hatches, keys[n_path], segments)
+            self.segment_keys[keys[n_path]] = (segments_key, n_path)
+
+    def hatchSegments(self):
+
+        """
+        The hatch segments of the polygons in self.paths, held back from
+        their edges and paired by the odd/even rule, as a list of
+        (n_path, segments) in the order interstices() adds them, n_path
+        being the position of the polygons in self.paths
+        """
+
+        hatches = {}
+        if self.options.hatchEngine == "python":
+            if not self.makeHatchGrids():
+                return []
+            self.stats.count("grid_lines", len(self.grid))
+            # Now loop over our hatch lines looking for intersections,
+            # testing each line only against the edges it can cross
+            edge_index = self.edgeIndex()
+            self.stats.count("edges", len(edge_index))
+            positions = {key: n_path for n_path, key in enumerate(self.paths)}
+            with self.stats.stage("interstices"):
+                active_paths = edge_index.activePaths(self.grid, self.grid_angles)
+                line_hatches = {}
+                for h, paths in zip(self.grid, active_paths):
+                    self.cancel_token.check()
+                    interstices(self, (h[0], h[1]), (h[2], h[3]), paths, line_hatches, self.trimsHoldBack(), self.options.holdBackSteps)
+                for key, segments in line_hatches.items():
+                    appendHatches(hatches, positions[key], np.array(segments, dtype=float).reshape(-1, 4))
+        else:
+            intersections = self.memoized(intersection_cache, self.intersectionsKey(), self.rawIntersections)
+            if intersections is not None:
+                lines, edges, edge_path_index, line_index, edge_index, s = intersections
+                with self.stats.stage("interstices"):
+                    addBatchedHatches(self, lines, edges, edge_path_index, range(len(self.paths)),
+                                      line_index, edge_index, s, hatches, self.trimsHoldBack(), self.options.holdBackSteps)
+        return list(hatches.items())
+
+    def rawIntersections(self):
+
+        """
+        The intersections of the hatch grid of self.paths with their
+        edges, before holding back and the odd/even rule, as the arrays
+        (lines, edges, edge_path_index, line_index, edge_index, s) that
+        addBatchedHatches() takes, or None if there are none
+        """
+
+        if not self.makeHatchGrids():
+            return None
+        self.stats.count("grid_lines", len(self.grid))
+        edge_index = self.edgeIndex()
+        self.stats.count("edges", len(edge_index))
+        with self.stats.stage("interstices"):
+            intersections = gridIntersections(self, self.grid, self.grid_angles, edge_index)
+        if intersections is None:
+            return None
+        lines, line_index, hit_edge_index, s = intersections
+        return lines, edge_index.edges, edge_index.edge_path_index, line_index, hit_edge_index, s
+
+    def makeHatchGrids(self):
+
+        """
+        Make the grid of hatch lines over self.paths, crossed when cross
+        hatching, memoized in the grid_cache by bounding box.  Returns
+        True if there is a grid.
+        """
+
+        with self.stats.stage("grid"):
+            self.getBoundingBox()
+            key = (self.xmin, self.xmax, self.ymin, self.ymax, float(self.options.hatchAngle),
+                   float(self.options.hatchSpacing), bool(self.options.crossHatch))
+            b_have_grid, self.grid, self.grid_angles = self.memoized(grid_cache, key, self.hatchGrids)
+        return b_have_grid
+
+    def hatchGrids(self):
+
+        """
+        Make the grids makeHatchGrids() memoizes, returning whether there
+        is one along with the hatch lines and their angles as tuples
+        """
+
+        b_have_grid = self.makeHatchGrid(float(self.options.hatchAngle), float(self.options.hatchSpacing), True)
+        if b_have_grid and self.options.crossHatch:
+            self.makeHatchGrid(float(self.options.hatchAngle + 90.0), float(self.options.hatchSpacing), False)
+        return b_have_grid, tuple(self.grid), tuple(self.grid_angles)
+
+    def memoized(self, cache, key, compute):
+
+        """
+        Return compute(), the result of one stage of the hatch pipeline,
+        taken from the StageCache cache when it holds key, else computed
+        and stored there.  The counters the stage adds to self.stats are
+        stored along with the result and added again on every hit, so
+        that the stats of a run do not depend on what was cached.
+        """
+
+        entry = cache.get(key)
+        if entry is not None:
+            self.replayStage(cache, entry)
+            return entry[0]
+        before = dict(self.stats.counters)
+        value = compute()
+        self.storeStage(cache, key, value, self.countersSince(before))
+        return value
+
+    def replayStage(self, cache, entry):
+
+        """
+        Add the counters of the (value, counters) entry of cache to
+        self.stats, counting the hit
+        """
+
+        for name, n in entry[1].items():
+            self.stats.count(name, n)
+        self.stats.count("cached_" + cache.name)
+
+    def storeStage(self, cache, key, value, counters):
+
+        """
+        Store value in cache under key, along with the counters its stage
+        added to self.stats
+        """
+
+        cache.put(key, (value, counters), valueBytes(value))
+
+    def countersSince(self, before):
+
+        """
+        The counters added to self.stats since its counters were before,
+        leaving out the cache hits
+        """
+
+        return {name: n - before.get(name, 0) for name, n in self.stats.counters.items()
+                if n != before.get(name, 0) and not name.startswith("cached_")}
+
+    def intersectionsKey(self):
+
+        """
+        The intersection_cache key of self.paths: their polygons and the
+        options the grid and the polygons intersected depend on
+        """
+
+        return (tuple(subpaths.digest for subpaths in self.paths.values()),
+                self.options.holdBackSteps if self.insetsHoldBack() else None,
+                float(self.options.hatchAngle), float(self.options.hatchSpacing), bool(self.options.crossHatch))
+
+    def segmentsKey(self):
+
+        """
+        The segment_cache key of self.paths: the intersections and the
+        options trimming them depends on
+        """
+
+        b_trim = self.trimsHoldBack()
+        return (self.intersectionsKey(), self.options.hatchEngine, b_trim, self.options.holdBackSteps if b_trim else None)
+
+    def pathDataKey(self, segment_keys, transformed_hatch_spacing):
+
+        """
+        The path_cache key of the path data joining the segments of
+        segment_keys, values of self.segment_keys, or None if any is
+        unknown
+        """
+
+        if any(key is None for key in segment_keys):
+            return None
+        if self.options.reducePenLifts:
+            return tuple(segment_keys), True, float(self.options.hatchScope), transformed_hatch_spacing
+        return tuple(segment_keys), False
+
+    def joinedPathData(self, segments, segment_keys, transformed_hatch_spacing, n_element_segments=None):
+
+        """
+        hatchPathData() for the segments of segment_keys, memoized in the
+        path_cache
+        """
+
+        key = self.pathDataKey(segment_keys, transformed_hatch_spacing)
+        if key is None:
+            return self.hatchPathData(segments, transformed_hatch_spacing, n_element_segments)
+        path = self.memoized(path_cache, key,
+                             lambda: self.hatchPathData(segments, transformed_hatch_spacing, n_element_segments))
+        path.key = key
+        return path
+
+    def elementKey(self, node, subpaths, stroke_width):
+
+        """
+        The element_cache key of the result of hatching the one element
+        node on the pool, see hatchInParallel(): its segments when
+        joining across elements, else its path data
+        """
+
+        self.paths = {node: subpaths}
+        segments_key = self.segmentsKey()
+        self.segment_keys[node] = (segments_key, 0)
+        if self.options.joinSameColour:
+            return segments_key, "segments"
+        return self.pathDataKey([(segments_key, 0)], stroke_width * self.options.hatchSpacing)
+
+    def pathString(self, path):
+
+        """
+        str(path), memoized in the emission_cache for the paths of the
+        path_cache
+        """
+
+        if path.key is None:
+            return str(path)
+        return self.memoized(emission_cache, (path.key, "d"), lambda: str(path))
+
+    def pathLines(self, path, quantization):
+
+        """
+        path.lines(quantization), memoized in the emission_cache for the
+        paths of the path_cache
+        """
+
+        if path.source is not None:
+            # The lines of the path it was moved from, moved
+            source, offset = path.source
+            return [line + offset for line in self.pathLines(source, quantization)]
+        if path.key is None:
+            return path.lines(quantization)
+        return self.memoized(emission_cache, (path.key, quantization), lambda: path.lines(quantization))
+
+    def placedPath(self, node, path):
+
+        """
+        The hatch PathData of node, joined where node was hatched, moved
+        into place in the document: by the offset of a Clone
+        """
+
+        offset = self.offsets.get(node)
+        if offset is None or len(path) == 0:
+            return path
+        return path.translated(*offset)
+
+    def placedSegments(self, node, segments):
+
+        """
+        The hatch segments of node, moved into place as placedPath() moves
+        its path
+        """
+
+        offset = self.offsets.get(node)
+        if offset is None:
+            return segments
+        return segments + (offset[0], offset[1], offset[0], offset[1])
+
+    def placedSegmentKey(self, node):
+
+        """
+        The value of self.segment_keys for node, identifying its segments
+        once placedSegments() has moved them
+        """
+
+        key = self.segment_keys.get(node)
+        offset = self.offsets.get(node)
+        if key is None or offset is None:
+            return key
+        return key + (offset,)
+
+    def hatchBands(self, node, subpaths, options, pool, n_bands):
+
+        """
+        Hatch the one element node on the pool, its grid split into about
+        n_bands bands of consecutive hatch lines.  Each band is sent with
+        only the edges that reach its offsets.  Returns the segment_cache
+        key of the element, the counters added to self.stats and the
+        futures of the bands' hatch segments, in grid order: concatenated,
+        they are the segments hatchPaths() would give the element.  When
+        the segment_cache holds them already, the futures are done.
+        """
+
+        self.paths = {node: subpaths}
+        segments_key = self.segmentsKey()
+        self.segment_keys[node] = (segments_key, 0)
+        entry = segment_cache.get(segments_key)
+        if entry is not None:
+            self.replayStage(segment_cache, entry)
+            futures = []
+            for _, segments in entry[0]:
+                future = Future()
+                future.set_result((segments, HatchStats()))
+                futures.append(future)
+            return segments_key, {}, futures
+
+        before = dict(self.stats.counters)
+        if not self.makeHatchGrids():
+            return segments_key, {}, []
+        self.stats.count("grid_lines", len(self.grid))
+        edge_index = self.edgeIndex()
+        self.stats.count("edges", len(edge_index))
+
+        lines = np.asarray(self.grid, dtype=float)
+        angles = np.asarray(self.grid_angles, dtype=float)
+        futures = []
+        for angle in dict.fromkeys(self.grid_angles):
+            group = np.flatnonzero(angles == angle)
+            n_group_bands = max(1, min(n_bands, len(group) // N_MIN_BAND_LINES))
+            for band in np.array_split(group, n_group_bands):
+                band_edges = edge_index.bandEdges(lines[band], angle)
+                futures.append(pool.submit(hatchBand, options, lines[band], angles[band],
+                                           edge_index.edges[band_edges], edge_index.f_margin))
+        return segments_key, self.countersSince(before), futures
+
+    def elementPathData(self, segments, segment_key, stroke_width):
+
+        """
+        The PathData of the hatch segments of an element hatched on the
+        pool, or the segments themselves when joining across elements.
+        segments is None for an element without hatches, segment_key the
+        element's value of self.segment_keys.
+        """
+
+        if self.options.joinSameColour:
+            return segments if segments is not None else np.empty((0, 4))
+        if segments is None:
+            return PathData(0)
+        with self.stats.stage("penlift"):
+            return self.joinedPathData(segments, [segment_key], stroke_width * self.options.hatchSpacing)
+
+    def edgeIndex(self):
+
+        """
+        The EdgeIndex over self.paths, inset by holdBackSteps when holding
+        back by inset.  When self.edge_indexes is a dict, indexes are kept
+        there and shared by the runs given the same dict, so that the
+        projections made for one angle are reused wherever the angle
+        repeats.
+        """
+
+        key = (tuple(self.paths), self.options.tolerance)
+        if self.insetsHoldBack():
+            key += (self.options.holdBackSteps,)
+        if self.edge_indexes is not None and key in self.edge_indexes:
+            return self.edge_indexes[key]
+
+        if self.insetsHoldBack():
+            with self.stats.stage("inset"):
+                edge_index = EdgeIndex({node: insetSubpaths(subpaths, self.options.holdBackSteps)
+                                        for node, subpaths in self.paths.items()})
+        else:
+            edge_index = EdgeIndex(self.paths)
+        if self.edge_indexes is not None:
+            self.edge_indexes[key] = edge_index
+        return edge_index
+
+    def trimsHoldBack(self):
+
+        """
+        True if hatches are held back from the edges by trimming each one
+        where it meets an edge, as interstices() does
+        """
+
+        return self.options.holdBackHatchFromEdges and self.options.holdBackMode == "trim"
+
+    def insetsHoldBack(self):
+
+        """
+        True if hatches are held back from the edges by insetting the
+        polygons they are intersected with, see insetSubpaths()
+        """
+
+        return self.options.holdBackHatchFromEdges and self.options.holdBackMode == "inset"
+
+    def hatchInParallel(self):
+
+        """
+        Hatch the elements collected in self.elements on a pool of
+        processes.  Each element is hatched on its own, as in the serial
+        traversal, so only its flattened subpaths travel to the workers
+        and only its hatch path data comes back.  The hatches are then
+        joined with their nodes in document order.
+
+        The Hatch_Fill runs in self.variants, with other options over the
+        same document and tolerance, are hatched along with this one: each
+        element is sent once and hatched for every variant in turn.
+
+        Elements of N_MIN_BAND_VERTICES or more are instead split into
+        bands of hatch lines, see hatchBands(), so that a single dominant
+        shape keeps every worker busy.  Their bands are merged back in
+        grid order and joined to reduce pen lifts here, over the whole
+        element, so the result is the same as hatching it serially.
+
+        Elements with the same polygons, as the Clones of one element
+        are, are hatched once: the later ones take the hatches of the
+        first, as they would from the caches when hatching serially.
+        """
+
+        effects = [self] + self.variants
+
+        # Open input and output streams can't be pickled
+        options_list = []
+        for effect in effects:
+            options = copy.copy(effect.options)
+            options.input_file = None
+            options.output = None
+            options_list.append(options)
+
+        n_processes = self.options.processes
+        pool = processPool()
+
+        jobs = []
+        strokes = []
+        banded = {}
+        element_keys = {}
+        cached = {}
+        firsts = {}
+        copies = {}
+        for node, subpaths in self.elements:
+            transform, stroke_width = self.hatchStrokeWidth(node)
+            strokes.append((transform, stroke_width))
+            first = firsts.setdefault((subpaths.digest, stroke_width), node)
+            if first is not node:
+                copies[node] = first
+                continue
+            if n_processes > 1 and len(subpaths.vertices) >= N_MIN_BAND_VERTICES:
+                banded[node] = [effect.hatchBands(node, subpaths, options, pool, 4 * n_processes)
+                                for effect, options in zip(effects, options_list)]
+                continue
+            element_keys[node] = [effect.elementKey(node, subpaths, stroke_width) for effect in effects]
+            entries = [element_cache.get(key) for key in element_keys[node]]
+            if all(entry is not None for entry in entries):
+                for effect, entry in zip(effects, entries):
+                    effect.replayStage(element_cache, entry)
+                cached[node] = entries
+                continue
+            jobs.append((subpaths, stroke_width))
+
+        # A few chunks per worker keeps them busy without pickling every element separately
+        n_chunk = max(1, -(-len(jobs) // (4 * n_processes)))
+        futures = [pool.submit(hatchElements, options_list, jobs[i:i + n_chunk]) for i in range(0, len(jobs), n_chunk)]
+        with self.stats.stage("pool"):
+            self.waitForFutures(futures + [future for node in banded for _, _, bands in banded[node] for future in bands])
+            results = [future.result() for future in futures]
+            for node in banded:
+                banded[node] = [(segments_key, counters, [future.result() for future in futures])
+                                for segments_key, counters, futures in banded[node]]
+
+        paths = []
+        for chunk_paths, chunk_stats in results:
+            paths.extend(chunk_paths)
+            for effect, stats in zip(effects, chunk_stats):
+                effect.stats.merge(stats)
+        paths = iter(paths)
+
+        # The (path, counters) each effect got for the first elements of their polygons
+        hatched = {}
+        for (node, _), (transform, stroke_width) in zip(self.elements, strokes):
+            if node in copies:
+                hatched[node] = hatched[copies[node]]
+                for effect, (path, counters) in zip(effects, hatched[node]):
+                    effect.replayStage(element_cache, (path, counters))
+                    effect.segment_keys[node] = effect.segment_keys.get(copies[node])
+            elif node in banded:
+                hatched[node] = []
+                for effect, (segments_key, counters, bands) in zip(effects, banded[node]):
+                    element_stats = HatchStats()
+                    element_stats.counters.update(counters)
+                    for _, stats in bands:
+                        effect.stats.merge(stats)
+                        element_stats.merge(stats)
+                    segments = np.concatenate([segments for segments, _ in bands]) if bands else None
+                    effect.storeStage(segment_cache, segments_key, [(0, segments)] if bands else [], element_stats.counters)
+                    before = dict(effect.stats.counters)
+                    path = effect.elementPathData(segments, effect.segment_keys[node], stroke_width)
+                    counters = collections.Counter(element_stats.counters)
+                    counters.update(effect.countersSince(before))
+                    hatched[node].append((path, dict(counters)))
+            elif node in cached:
+                hatched[node] = cached[node]
+            else:
+                hatched[node] = []
+                for effect, key, (path, counters) in zip(effects, element_keys[node], next(paths)):
+                    effect.storeStage(element_cache, key, path, counters)
+                    hatched[node].append((path, counters))
+            for effect, (path, _) in zip(effects, hatched[node]):
+                if effect.options.joinSameColour:
+                    if len(path):
+                        effect.hatches[node] = path
+                        effect.transforms[node] = self.transforms[node]
+                        if node in self.offsets:
+                            effect.offsets[node] = self.offsets[node]
+                else:
+                    effect.addHatchPath(node, stroke_width, self.placedPath(node, path), stroke_width * effect.options.hatchSpacing)
+
+        for effect in effects:
+            if effect.options.joinSameColour:
+                effect.hatchByColour()
+
+    def waitForFutures(self, futures):
+
+        """
+        Wait for the futures of the process pool to finish, checking the
+        cancel token as they run.  Once cancelled, the futures not yet
+        started are dropped; those already running finish in their
+        worker, but nobody waits for them.
+        """
+
+        try:
+            for future in futures:
+                while not wait([future], timeout=F_CANCEL_POLL_SECONDS).done:
+                    self.cancel_token.check()
+        except Cancelled:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def addHatchPath(self, node, stroke_width, path, transformed_hatch_spacing):
+
+        """
+        Record the hatch PathData of node in self.hatch_paths and, unless
+        only the geometry is wanted, join it with node in the document
+        """
+
+        if len(path):
+            self.hatch_paths.append((node, path, transformed_hatch_spacing))
+        if self.join_fills:
+            with self.stats.stage("join"):
+                self.joinFillsWithNode(node, stroke_width, path, transformed_hatch_spacing)
+
+    @staticmethod
+    def hatchStrokeColor(node):
+
+        """
+        The colour to draw the hatches of node with: its fill, else its
+        stroke, from either the attributes or the style.  A Clone without
+        either takes those of the innermost of its <use> elements with one.
+        A Compound takes that of its elements.
+        """
+
+        if isinstance(node, Compound):
+            return node.stroke_color
+
+        if isinstance(node, Clone):
+            for element in (node.node,) + tuple(reversed(node.uses)):
+                stroke_color = Hatch_Fill.hatchStrokeColor(element)
+                if stroke_color is not None:
+                    return stroke_color
+            return None
+
+        has_set_stroke_color = False
+
+        stroke_color = node.get("fill")
+        if stroke_color is None:
+            stroke_color = node.get("stroke")
+
+        if stroke_color is None:
+            style = node.get('style')
+            if style is not None:
+                declarations = style.split(';')
+                for i, declaration in enumerate(declarations):
+                    parts = declaration.split(':', 2)
+                    if len(parts) == 2:
+                        (prop, val) = parts
+                        prop = prop.strip().lower()
+                        if prop == 'stroke' and not has_set_stroke_color:
+                            val = val.strip()
+                            stroke_color = val
+                        elif prop == 'fill':
+                            val = val.strip()
+                            stroke_color = val
+                            has_set_stroke_color = True
+
+        return stroke_color
+
+    @staticmethod
+    def occludes(node):
+
+        """
+        True if node hides what is painted under it: it is filled, SVG's
+        default being black, and the fill is opaque
+        """
+
+        style = node.specified_style()
+        if style.get('fill') == 'none':
+            return False
+        for prop in ('fill-opacity', 'opacity'):
+            try:
+                if float(style.get(prop, 1)) < 1:
+                    return False
+            except (TypeError, ValueError):
+                pass
+        return True
+
+    @staticmethod
+    def fillRule(node):
+
+        """
+        The fill-rule node is filled by, 'nonzero', SVG's default, or
+        'evenodd'
+        """
+
+        fill_rule = str(node.specified_style().get('fill-rule', 'nonzero')).strip().lower()
+        return 'evenodd' if fill_rule == 'evenodd' else 'nonzero'
+
+    def joinFillsWithNode(self, node, stroke_width, path, transform_hatch_spacing):
+
+        """
+        Generate a SVG <path> element containing the path data "path".
+        Then put this new <path> element into a <group> with the supplied
+        node.  This means making a new <group> element and moving node
+        under it with the new <path> as a sibling element.  The hatches of
+        a Clone go with its outermost <use>, which takes the hatches of all
+        the elements it draws into the one <group>.  Those of a Compound go
+        in a new <group> of their own, the last child of its parent.
+        """
+
+        if not path or len(path) == 0:
+            return
+
+        element = node.use if isinstance(node, Clone) else node
+        g = self.hatch_groups.get(element)
+        if isinstance(node, Compound):
+            # Over the elements, which stay where they are
+            g = etree.SubElement(node.parent, inkex.addNS('g', 'svg'))
+        elif g is None:
+            # Make a new SVG <group> element whose parent is the parent of node
+            parent = element.getparent()
+            if parent is None:
+                parent = self.document.getroot()
+            g = etree.SubElement(parent, inkex.addNS('g', 'svg'))
+            # Move node to be a child of this new <g> element
+            g.append(element)
+            self.hatch_groups[element] = g
+
+        # Now make a <path> element which contains the hatches & is a child
+        # of the new <g> element
+        stroke_color = self.hatchStrokeColor(node)
+        stroke_width = str(transform_hatch_spacing)  # default value
+
+        style = {'stroke': '{0}'.format(stroke_color), 'fill': 'none', 'stroke-width': '{0}'.format(stroke_width)}
+        line_attribs = {'style': str(inkex.Style(style)), 'd': self.pathString(path)}
+
+        inverse_parent_transform = -g.composed_transform()
+        hatch = etree.SubElement(g, inkex.addNS('path', 'svg'), line_attribs)
+        hatch.transform = inverse_parent_transform
+
+    def makeHatchGrid(self, angle, spacing, init=True):  # returns True if succeeds in making grid, else False
+
+        """
+        Build a grid of hatch lines which encompasses the entire bounding
+        box of the graphical elements we are to hatch.
+
+        1. Figure out the bounding box for all of the graphical elements
+        2. Pick a rectangle larger than that bounding box so that we can
+           later rotate the rectangle and still have it cover the bounding
+           box of the graphical elements.
+        3. Center the rectangle of 2 on the origin (0, 0).
+        4. Build the hatch line grid in this rectangle.
+        5. Rotate the rectangle by the hatch angle.
+        6. Translate the center of the rotated rectangle, (0, 0), to be
+           the center of the bounding box for the graphical elements.
+        7. We now have a grid of hatch lines which overlay the graphical
+           elements and can now be intersected with those graphical elements.
+        """
+
+        # If this is the first call, do some one time initializations
+        # When generating cross hatches, we may be called more than once
+        if init:
+            self.getBoundingBox()
+            self.grid = []
+            self.grid_angles = []
+
+        # Determine the width and height of the bounding box containing
+        # all the polygons to be hatched
+        w = self.xmax - self.xmin
+        h = self.ymax - self.ymin
+
+        b_bounding_box_exists = ((w != (EXTREME_NEG - EXTREME_POS)) and (h != (EXTREME_NEG - EXTREME_POS)))
+        ret_value = b_bounding_box_exists
+
+        if b_bounding_box_exists:
+            # Nice thing about rectangles is that the diameter of the circle
+            # encompassing them is the length the rectangle's diagonal...
+            r = math.sqrt(w * w + h * h) / 2.0
+
+            # Length of a hatch line will be 2r
+            # Now generate hatch lines within the square
+            # centered at (0, 0) and with side length at least d
+
+            # While we could generate these lines running back and forth,
+            # that makes for weird behavior later when applying odd/even
+            # rules AND there are nested polygons.  Instead, when we
+            # generate the SVG <path> elements with the hatch line
+            # segments, we can do the back and forth weaving.
+
+            # Rotation information
+            ca = math.cos(math.radians(90 - angle))
+            sa = math.sin(math.radians(90 - angle))
+
+            # Translation information
+            cx = self.xmin + (w / 2)
             cy = self.ymin + (h / 2)
 
             # Since the spacing may be fractional (e.g., 6.5), we
@@ -896,13 +3007,17 @@ class Hatch_Fill(inkex.Effect):
                 if (y1 < self.ymin and y2 < self.ymin) or (y1 > self.ymax and y2 > self.ymax):
                     continue
                 self.grid.append((x1, y1, x2, y2))
+                self.grid_angles.append(angle)
 
         return ret_value
 
-    def effect(self):
+    def prepareOptions(self):
+
+        """
+        Handle the viewbox and express the lengths in self.options in
+        user units
+        """
 
-        global ref_count
-        global pt_last_position_abs
         # Viewbox handling
         self.handleViewBox()
 
@@ -912,11 +3027,99 @@ class Hatch_Fill(inkex.Effect):
         if self.options.hatchSpacing == 0:
             self.options.hatchSpacing = 0.1 # Hardcode minimum value
 
-        ref_count = 0
-        pt_last_position_abs = [0, 0]
+        self.options.processes = processCount(self.options.processes)
+
+    def estimate(self):
+
+        """
+        Predict the cost of hatching the document without hatching it.
+        Every element is flattened, through the flatten_cache so that the
+        run which follows gets it for free, and then its grid lines are
+        counted from the extent of its bounding box across the hatch
+        normal and its intersections from the extent of its edges, each
+        edge crossing one grid line per hatch spacing it spans.  Returns
+        a HatchEstimate.
+        """
+
+        self.prepareOptions()
 
-        # Build a list of the vertices for the document's graphical elements
         if self.options.ids:
+            a_node_list = [self.svg.selected[id_] for id_ in self.options.ids]
+        else:
+            a_node_list = self.document.getroot()
+
+        spacing = abs(float(self.options.hatchSpacing))
+        angles = [float(self.options.hatchAngle)]
+        if self.options.crossHatch:
+            angles.append(angles[0] + 90)
+        normals = np.array([EdgeIndex.normal(angle) for angle in angles])
+
+        n_elements, n_edges, f_lines, f_crossings = 0, 0, 0.0, 0.0
+        for node in self.iterShapeElements(a_node_list):
+            self.cancel_token.check()
+            self.paths = {}
+            self.addPathVertices(node)
+            subpaths = self.paths.get(node)
+            if subpaths is None or subpaths.bounding_box is None:
+                continue
+            edges = subpaths.edges()
+            xmin, xmax, ymin, ymax = subpaths.bounding_box
+            n_elements += 1
+            n_edges += len(edges)
+            extents = np.abs(normals[:, 0]) * (xmax - xmin) + np.abs(normals[:, 1]) * (ymax - ymin)
+            f_lines += float(np.sum(np.floor(extents / spacing) + 1))
+            spans = np.abs((edges[:, 2:] - edges[:, :2]) @ normals.T)
+            f_crossings += float(np.sum(spans)) / spacing
+        self.paths = {}
+
+        # Back in the unit of the request, for coarsening the spacing
+        unit_spacing = spacing / self.svg.unittouu('1' + self.options.unit)
+        return HatchEstimate.fromCounts(n_elements, n_edges, f_lines, f_crossings,
+                                        self.options.reducePenLifts, unit_spacing,
+                                        spacing / self.svg.unittouu('1mm'))
+
+    def findVisibleParts(self):
+
+        """
+        Work out, for --occlusion, the part of every graphical element of
+        the document left visible by the filled shapes painted over it,
+        and keep it in self.visible for hatchElement() to hatch in place
+        of the whole element.  Unselected elements cover selected ones
+        all the same.
+        """
+
+        elements = []
+        for node in self.iterShapeElements(self.document.getroot(), False):
+            self.cancel_token.check()
+            self.paths = {}
+            with self.stats.stage("flatten"):
+                self.addPathVertices(node)
+            if node in self.paths:
+                elements.append((node, self.documentSubpaths(node), self.occludes(node), self.fillRule(node)))
+        self.paths = {}
+
+        with self.stats.stage("occlusion"):
+            visible = visibleSubpaths([element[1:] for element in elements])
+        self.visible = {}
+        for (node, subpaths, _, _), visible_subpaths in zip(elements, visible):
+            if visible_subpaths is not subpaths:
+                self.visible[node] = visible_subpaths
+                self.stats.count("occluded_elements")
+
+    def effect(self):
+
+        self.prepareOptions()
+
+        self.pt_last_position_abs = [0, 0]
+
+        if self.options.occlusion:
+            self.findVisibleParts()
+
+        # Build a list of the vertices for the document's graphical elements
+        if self.nodes is not None:
+            # Traverse the elements picked by hatchReusing()
+            self.recursivelyTraverseSvg(self.nodes)
+        elif self.options.ids:
             # Traverse the selected objects
             for id_ in self.options.ids:
                 self.recursivelyTraverseSvg([self.svg.selected[id_]])
@@ -924,7 +3127,169 @@ class Hatch_Fill(inkex.Effect):
             # Traverse the entire document
             self.recursivelyTraverseSvg(self.document.getroot())
 
-        # After recursively traversing the svg, we will have a dictionary of transforms and hatches
+        # Now, dump the hatch fills sorted by which document element
+        # they correspond to.  This is made easy by the fact that we
+        # saved the information and used each element's lxml.etree node
+        # pointer as the dictionary key under which to save the hatch
+        # fills for that node.
+
+        if self.options.processes != 1:
+            self.hatchInParallel()
+            return
+
+        if self.options.joinSameColour:
+            self.hatchByColour()
+            return
+
+        for key in self.hatches:
+            self.cancel_token.check()
+            transform, stroke_width = self.hatchStrokeWidth(key)
+            # The transform also applies to the hatch spacing we use when searching for end connections
+            transformed_hatch_spacing = stroke_width * self.options.hatchSpacing
+            with self.stats.stage("penlift"):
+                path = self.joinedPathData(self.hatches[key], [self.segment_keys.get(key)], transformed_hatch_spacing)
+            self.addHatchPath(key, stroke_width, self.placedPath(key, path), transformed_hatch_spacing)
+
+    def hatchReusing(self, reused, changed_ids):
+
+        """
+        Hatch the document as effect() does, but take the hatches of the
+        graphical elements found in reused, a result of hatchesById(),
+        from there instead.  The elements whose id, or the id of one of
+        their ancestors, is in changed_ids are hatched all the same, as
+        are those reused knows nothing of.  self.hatch_paths is left in
+        document order, as effect() leaves it.
+        """
+
+        nodes = list(self.iterShapeElements(self.document.getroot(), False))
+        changed_ids = set(changed_ids)
+        hatched = [node for node in nodes
+                   if node.get('id') not in reused or node.get('id') in changed_ids or
+                   any(ancestor.get('id') in changed_ids for ancestor in node.iterancestors())]
+        self.stats.count("reused_elements", len(nodes) - len(hatched))
+        if hatched:
+            self.nodes = hatched
+            self.effect()
+
+        fresh = {node: (path, transformed_hatch_spacing) for node, path, transformed_hatch_spacing in self.hatch_paths}
+        b_hatched = set(hatched)
+        self.hatch_paths = []
+        for node in nodes:
+            hatch = fresh.get(node) if node in b_hatched else reused[node.get('id')]
+            if hatch is not None:
+                self.hatch_paths.append((node, hatch[0], hatch[1]))
+
+    def hatchesById(self):
+
+        """
+        The hatches of the graphical elements with an id of their own, as
+        a dict of (path, transformed_hatch_spacing) keyed by id, None for
+        the elements without hatches, for a later hatchReusing()
+        """
+
+        nodes = list(self.iterShapeElements(self.document.getroot(), False))
+        n_ids = collections.Counter(node.get('id') for node in nodes)
+        hatches = {node.get('id'): None for node in nodes if node.get('id') is not None and n_ids[node.get('id')] == 1}
+        for node, path, transformed_hatch_spacing in self.hatch_paths:
+            if node.get('id') in hatches:
+                hatches[node.get('id')] = (path, transformed_hatch_spacing)
+        return hatches
+
+    def iterHatchPaths(self):
+
+        """
+        Hatch the document element by element, as effect() does, but yield
+        (node, path, transformed_hatch_spacing) for each element as soon
+        as it is hatched instead of joining the hatches with the document.
+        Only the element in hand is held, so memory does not grow with the
+        document.  Elements are hatched serially and each on its own:
+        --processes, --joinSameColour and --groupFills are ignored.
+        """
+
+        self.prepareOptions()
+        self.options.processes = 1
+
+        self.pt_last_position_abs = [0, 0]
+
+        if self.options.occlusion:
+            self.findVisibleParts()
+
+        if self.options.ids:
+            a_node_list = [self.svg.selected[id_] for id_ in self.options.ids]
+        else:
+            a_node_list = self.document.getroot()
+
+        for node in self.iterShapeElements(a_node_list):
+            self.hatchElement(node)
+            segments = self.hatches.pop(node, None)
+            segment_key = self.segment_keys.pop(node, None)
+            if segments is not None and len(segments):
+                transform, stroke_width = self.hatchStrokeWidth(node)
+                transformed_hatch_spacing = stroke_width * self.options.hatchSpacing
+                with self.stats.stage("penlift"):
+                    path = self.joinedPathData(segments, [segment_key], transformed_hatch_spacing)
+                if len(path):
+                    yield node, self.placedPath(node, path), transformed_hatch_spacing
+            self.transforms.pop(node, None)
+            self.offsets.pop(node, None)
+
+    def hatchByColour(self):
+
+        """
+        Join the hatch segments of all the elements sharing a stroke
+        colour and hatch spacing in a single pen lift reduction pass, so
+        that touching shapes of one colour can be hatched without lifting
+        the pen between them.  Each colour is drawn as one hatch path, in
+        a group of its own at the end of the document.
+
+        The segments of each element are joined as they would be on their
+        own and the resulting chains then linked across the elements, so
+        joining by colour never lifts the pen more than joining element by
+        element, see Hatch_Fill.joinChains().
+        """
+
+        by_colour = collections.OrderedDict()
+        for key in self.hatches:
+            transform, stroke_width = self.hatchStrokeWidth(key)
+            transformed_hatch_spacing = stroke_width * self.options.hatchSpacing
+            by_colour.setdefault((self.hatchStrokeColor(key), transformed_hatch_spacing), []).append(key)
+
+        for (stroke_color, transformed_hatch_spacing), keys in by_colour.items():
+            self.cancel_token.check()
+            # The hatches are in document coordinates, whatever the element,
+            # once the clones are moved into place
+            segments = np.concatenate([self.placedSegments(key, self.hatches[key]) for key in keys])
+            with self.stats.stage("penlift"):
+                path = self.joinedPathData(segments, [self.placedSegmentKey(key) for key in keys], transformed_hatch_spacing,
+                                           [len(self.hatches[key]) for key in keys])
+            if len(path) == 0:
+                continue
+            self.hatch_paths.append((keys[0], path, transformed_hatch_spacing))
+            if self.join_fills:
+                with self.stats.stage("join"):
+                    self.joinFillsWithColour(stroke_color, path, transformed_hatch_spacing)
+
+    def joinFillsWithColour(self, stroke_color, path, transform_hatch_spacing):
+
+        """
+        Generate a SVG <path> element containing the path data "path",
+        drawn in stroke_color, inside a new <group> appended to the root
+        of the document
+        """
+
+        g = etree.SubElement(self.document.getroot(), inkex.addNS('g', 'svg'))
+        style = {'stroke': '{0}'.format(stroke_color), 'fill': 'none', 'stroke-width': '{0}'.format(transform_hatch_spacing)}
+        line_attribs = {'style': str(inkex.Style(style)), 'd': self.pathString(path)}
+        hatch = etree.SubElement(g, inkex.addNS('path', 'svg'), line_attribs)
+        hatch.transform = -g.composed_transform()
+
+    def hatchStrokeWidth(self, key):
+
+        """
+        Return the inverse transform for the hatches of key and the
+        stroke width to draw them with
+        """
+
         # Target stroke width will be (doc width + doc height) / 2 / 1000
         # stroke_width_target = ( self.svg.height + self.svg.width ) / 2000
         # stroke_width_target = 1
@@ -941,449 +3306,495 @@ class Hatch_Fill(inkex.Effect):
         # transformed segment is.  We could, alternatively, look at the
         # x and y scaling factors in the transform and average them.
         s = stroke_width_target / math.sqrt(2)
+        if key in self.transforms:
+            transform = -Transform(self.transforms[key])
+            # Determine the scaled stroke width for a hatch line
+            # We produce a line segment of unit length, transform
+            # its endpoints and then determine the length of the
+            # resulting line segment.
+            pt1 = [0, 0]
+            pt2 = [s, s]
+            Transform(transform).apply_to_point(pt1)
+            Transform(transform).apply_to_point(pt2)
+            dx = pt2[0] - pt1[0]
+            dy = pt2[1] - pt1[1]
+            stroke_width = math.sqrt(dx * dx + dy * dy)
+        else:
+            transform = None
+            stroke_width = 1.0
 
-        # Now, dump the hatch fills sorted by which document element
-        # they correspond to.  This is made easy by the fact that we
-        # saved the information and used each element's lxml.etree node
-        # pointer as the dictionary key under which to save the hatch
-        # fills for that node.
+        return transform, stroke_width
+
+    def hatchPathData(self, segments, transformed_hatch_spacing, n_element_segments=None):
+
+        """
+        Generate the PathData drawing the hatch segments, joining
+        neighbouring segments when reducing pen lifts.  n_element_segments,
+        if given, is the number of segments of each of the elements whose
+        segments are pooled in segments, see joinChains().
+        """
 
-        abs_line_segments = {} # Absolute line segments
-        n_abs_line_segment_total = 0
         n_pen_lifts = 0
-        # To implement
-        for key in self.hatches:
-            direction = True
-            if key in self.transforms:
-                transform = -Transform(self.transforms[key])
-                # Determine the scaled stroke width for a hatch line
-                # We produce a line segment of unit length, transform
-                # its endpoints and then determine the length of the
-                # resulting line segment.
-                pt1 = [0, 0]
-                pt2 = [s, s]
-                Transform(transform).apply_to_point(pt1)
-                Transform(transform).apply_to_point(pt2)
-                dx = pt2[0] - pt1[0]
-                dy = pt2[1] - pt1[1]
-                stroke_width = math.sqrt(dx * dx + dy * dy)
-            else:
-                transform = None
-                stroke_width = 1.0
 
-            # The transform also applies to the hatch spacing we use when searching for end connections
-            transformed_hatch_spacing = stroke_width * self.options.hatchSpacing
+        path = PathData(len(segments))  # regardless of whether or not we're reducing pen lifts
+        self.stats.count("segments", len(segments))
+        self.pt_last_position_abs = [0, 0]
+        f_distance_moved_with_pen_up = 0
+
+        # The hatches were computed in document coordinates and are drawn
+        # there: joinFillsWithNode() gives their <path> the inverse of its
+        # parent's transform, so no transform is applied to the points.
+        # Every other segment, of each element, is drawn in the opposite direction.
+        ends = np.array(segments, dtype=float).reshape(-1, 4)
+        if n_element_segments is None:
+            ends[1::2] = ends[1::2][:, [2, 3, 0, 1]]
+        else:
+            n_firsts = np.cumsum(n_element_segments) - n_element_segments
+            b_reversed = (np.arange(len(ends)) - np.repeat(n_firsts, n_element_segments)) % 2 == 1
+            ends[b_reversed] = ends[b_reversed][:, [2, 3, 0, 1]]
 
-            path = ''  # regardless of whether or not we're reducing pen lifts
-            pt_last_position_abs = [0, 0]
-            pt_last_position_abs[0] = 0
-            pt_last_position_abs[1] = 0
-            f_distance_moved_with_pen_up = 0
-            if not self.options.reducePenLifts:
-                for segment in self.hatches[key]:
-                    if len(segment) < 2:
-                        continue
-                    pt1 = segment[0]
-                    pt2 = segment[1]
-                    # Okay, we're going to put these hatch lines into the same
-                    # group as the element they hatch.  That element is down
-                    # some chain of SVG elements, some of which may have
-                    # transforms attached.  But, our hatch lines have been
-                    # computed assuming that those transforms have already
-                    # been applied (since we had to apply them so as to know
-                    # where this element is on the page relative to other
-                    # elements and their transforms).  So, we need to invert
-                    # the transforms for this element and then either apply
-                    # that inverse transform here and now or set it in a
-                    # transform attribute of the <path> element.  Having it
-                    # set in the path element seems a bit counterintuitive
-                    # after the fact (i.e., what's this transform here for?).
-                    # So, we compute the inverse transform and apply it here.
-                    if transform is not None:
-                        Transform(transform).apply_to_point(pt1)
-                        Transform(transform).apply_to_point(pt2)
-                    # Now generate the path data for the <path>
-                    if direction:
-                        # Go this direction
-                        path += ('M {0:f},{1:f} l {2:f},{3:f} '.format(pt1[0], pt1[1], pt2[0] - pt1[0], pt2[1] - pt1[1]))
-                    else:
-                        # Or go this direction
-                        path += ('M {0:f},{1:f} l {2:f},{3:f} '.format(pt2[0], pt2[1], pt1[0] - pt2[0], pt1[1] - pt2[1]))
+        if not self.options.reducePenLifts:
+            path.segments(ends[:, :2], ends[:, 2:] - ends[:, :2])
+            n_pen_lifts = len(ends)
+            self.stats.count("pen_lifts", n_pen_lifts)
+            return path
 
-                    direction = not direction
-                self.joinFillsWithNode(key, stroke_width, path[:-1], transformed_hatch_spacing)
+        else:
+            # We want to combine as many paths as possible to reduce pen lifts.
+            # The order the segments are drawn in, and which are joined, is
+            # settled first; the segment ends are the rows of points: row e is
+            # end e & 1 of segment e >> 1, so the other end of a segment is row e ^ 1.
+            points = ends.reshape(-1, 2)
+            starts, b_joined = self.joinChains(ends, transformed_hatch_spacing, n_element_segments)
+            b_chain_goes_on = np.append(b_joined[1:], False)
+
+            for n_start, b_joined_here, b_goes_on in zip(starts.tolist(), b_joined.tolist(), b_chain_goes_on.tolist()):
+                if b_joined_here:
+                    # Joined to the segment before with a curve
+                    self.appendJoinedSegment(transformed_hatch_spacing,
+                                             n_ref_end,
+                                             n_start,
+                                             points,
+                                             path,
+                                             relative_held_line_pos)
+                    n_ref_end = n_start ^ 1
+                    if not b_goes_on:
+                        path.line(relative_held_line_pos[0], relative_held_line_pos[1])  # close out this segment
+                        self.pt_last_position_abs[0] += relative_held_line_pos[0]
+                        self.pt_last_position_abs[1] += relative_held_line_pos[1]
+                elif not b_goes_on:
+                    # This segment is solitary.
+                    # Must start a new line, not joined to any previous paths
+                    x1, y1 = points[n_start].tolist()
+                    x2, y2 = points[n_start ^ 1].tolist()
+                    delta_x = x2 - x1  # end minus start, in original direction
+                    delta_y = y2 - y1  # end minus start, in original direction
+                    path.move(x1, y1)
+                    path.line(delta_x, delta_y)  # delta is from initial point
+                    f_distance_moved_with_pen_up += math.hypot(x1 - self.pt_last_position_abs[0],
+                                                               y1 - self.pt_last_position_abs[1])
+                    self.pt_last_position_abs[0] = x1 + delta_x
+                    self.pt_last_position_abs[1] = y1 + delta_y
+                    n_pen_lifts += 1
+                else:
+                    # Found segment to add, and we must get to it in absolute terms
+                    pt_start = points[n_start].tolist()
+                    pt_end = points[n_start ^ 1].tolist()
+                    # final point (which was closer to the closest continuation segment) minus initial point
+                    delta_x = pt_end[0] - pt_start[0]
+                    delta_y = pt_end[1] - pt_start[1]
+
+                    path.move(pt_start[0], pt_start[1])
+                    f_distance_moved_with_pen_up += math.hypot(pt_start[0] - self.pt_last_position_abs[0],
+                                                               pt_start[1] - self.pt_last_position_abs[1])
+                    self.pt_last_position_abs[0] = pt_start[0]
+                    self.pt_last_position_abs[1] = pt_start[1]
+                    # Note that this does not complete the line, as the completion (the delta_x, delta_y part) is being held in abeyance
+
+                    # We are coming up on a problem:
+                    # If we add a curve to the end of the line, we have made the curve extend beyond the end of the line,
+                    # and thus beyond the boundaries we should be respecting.
+                    # The solution is to hold in abeyance the actual plotting of the line,
+                    # holding it available for shrinking if a curve is to be added.
+                    # That is
+                    relative_held_line_pos = {0: delta_x, 1: delta_y}
+                    # delta is from initial point
+                    # Will be printed after we know if it must be modified
+                    # to keep the ending join within bounds
+                    self.pt_last_position_abs[0] += delta_x
+                    self.pt_last_position_abs[1] += delta_y
+                    n_ref_end = n_start ^ 1
+                    n_pen_lifts += 1
+
+            self.stats.count("pen_lifts", n_pen_lifts)
+            self.stats.count("distance_moved_with_pen_up", f_distance_moved_with_pen_up)
+            return path
+
+    def joinChains(self, ends, transformed_hatch_spacing, n_element_segments=None):
 
-            else:
-                for segment in self.hatches[key]:
-                    if len(segment) < 2:  # Copied from original, no idea why this is needed [sbm]
-                        continue
-                    if direction:
-                        pt1 = segment[0]
-                        pt2 = segment[1]
-                    else:
-                        pt1 = segment[1]
-                        pt2 = segment[0]
-                    # Okay, we're going to put these hatch lines into the same
-                    # group as the element they hatch.  That element is down
-                    # some chain of SVG elements, some of which may have
-                    # transforms attached.  But, our hatch lines have been
-                    # computed assuming that those transforms have already
-                    # been applied (since we had to apply them so as to know
-                    # where this element is on the page relative to other
-                    # elements and their transforms).  So, we need to invert
-                    # the transforms for this element and then either apply
-                    # that inverse transform here and now or set it in a
-                    # transform attribute of the <path> element.  Having it
-                    # set in the path element seems a bit counterintuitive
-                    # after the fact (i.e., what's this transform here for?).
-                    # So, we compute the inverse transform and apply it here.
-                    if transform is not None:
-                        Transform(transform).apply_to_point(pt1)
-                        Transform(transform).apply_to_point(pt2)
-
-                    # Now generate the path data for the <path>
-                    # BUT we want to combine as many paths as possible to reduce pen lifts.
-                    # In order to combine paths, we need to know all of the path segments.
-                    # The solution to this conundrum is to generate all path segments,
-                    # but instead of drawing them into the path right away, we put them in
-                    # an array where they'll be available for random access
-                    # by our anti-pen-lift algorithm
-                    abs_line_segments[n_abs_line_segment_total] = [pt1, pt2, False]  # False indicates that segment has not yet been drawn
-                    n_abs_line_segment_total += 1
-                    direction = not direction
-
-                # Now have a nice juicy buffer full of line segments with absolute coordinates
-                f_proposed_neighborhood_radius_squared = self.ProposeNeighborhoodRadiusSquared(transformed_hatch_spacing)  
-                # Just fixed and simple for now - may make function of neighborhood later
-                
-                for ref_count in range(n_abs_line_segment_total):  # This is the entire range of segments,
-                    # Sets global ref_count to segment which has an end closest to current pen position.
-                    # Doesn't need to select which end is closest, as that will happen below, with n_ref_end_index.
-                    # When we have gone thru this whole range, we will be completely done.
-                    # We only get here again, after all _connected_ segments have been "drawn".
-                    if not abs_line_segments[ref_count][2]:  # Test whether this segment has been drawn
-                        # Has not been drawn yet
-
-                        # Before we do any irrevocable changes to path, let's see if we are going to be able to append any segments.
-                        # The below solution is inelegant, but has the virtue of being relatively simple to implement.
-                        # Pre-qualify this segment on the issue of whether it has any connecting segments.
-                        # If it does not, then just add the path for this one segment, and go on to the next.
-                        # If it does have connecting segments, we need to go through the recursive logic.
-                        # Lazily, again, select the desired direction of line ahead of time.
-
-                        b_found_segment_to_add = False  # default assumption
-                        n_ref_end_index_at_closest = 0
-                        f_closest_distance_squared = 123456  # just a random large number
-                        for n_ref_end_index in range(2):
-                            pt_reference = abs_line_segments[ref_count][n_ref_end_index]
-                            pt_reference_other_end = abs_line_segments[ref_count][not n_ref_end_index]
-                            f_reference_direction_radians = math.atan2(pt_reference_other_end[1] - pt_reference[1], pt_reference_other_end[0] - pt_reference[0])  # from other end to this end
-                            # The following is just a simple copy from the routine in recursivelyAppendNearbySegments procedure
-                            # Look through all possibilities to choose the closest that fulfills all requirements e.g. direction and colinearity
-                            for innerCount in range(n_abs_line_segment_total):  # investigate all segments
-                                if not abs_line_segments[innerCount][2]:
-                                    # This segment currently undrawn, so it is a candidate for a path extension
-                                    # Need to check both ends of each and every proposed segment so we can find the most appropriate one
-                                    # Define pt2 in the reference as the end which we want to extend
-                                    for nNewSegmentInitialEndIndex in range(2):
-                                        # First try initial end of test segment (aka pt1) vs final end (aka pt2) of reference segment
-                                        if innerCount != ref_count:  # don't investigate self ends
-                                            delta_x = abs_line_segments[innerCount][nNewSegmentInitialEndIndex][0] - pt_reference[0]  # proposed initial pt1 X minus existing final pt1 X
-                                            delta_y = abs_line_segments[innerCount][nNewSegmentInitialEndIndex][1] - pt_reference[1]  # proposed initial pt1 Y minus existing final pt1 Y
-                                            if (delta_x * delta_x + delta_y * delta_y) < f_proposed_neighborhood_radius_squared:
-                                                f_this_distance_squared = delta_x * delta_x + delta_y * delta_y
-                                                pt_new_segment_this_end = abs_line_segments[innerCount][nNewSegmentInitialEndIndex]
-                                                pt_new_segment_other_end = abs_line_segments[innerCount][not nNewSegmentInitialEndIndex]
-                                                f_new_segment_direction_radians = math.atan2(pt_new_segment_this_end[1] - pt_new_segment_other_end[1], pt_new_segment_this_end[0] - pt_new_segment_other_end[0])  # from other end to this end
-                                                # If this end would cause an alternating direction,
-                                                # then exclude it
-                                                if not self.WouldBeAnAlternatingDirection(f_reference_direction_radians, f_new_segment_direction_radians):
-                                                    pass
-                                                elif f_this_distance_squared < f_closest_distance_squared:
-                                                    # One other thing could rule out choosing this segment end:
-                                                    # Want to screen and remove two segments that, while close enough,
-                                                    # should be disqualified because they are colinear.  The reason for this is that
-                                                    # if they are colinear, they arose from the same global grid line, which means
-                                                    # that the gap between them arises from intersections with the boundary.
-                                                    # The idea here is that, all things being more-or-less equal,
-                                                    # we would like to give preference to connecting to a segment
-                                                    # which is the reverse of our current direction.  This makes for better
-                                                    # bezier curve join.
-                                                    # The criterion for being colinear is that the reference segment angle is effectively
-                                                    # the same as the line connecting the reference segment to the end of the new segment.
-                                                    f_joiner_direction_radians = math.atan2(pt_new_segment_this_end[1] - pt_reference[1], pt_new_segment_this_end[0] - pt_reference[0])
-                                                    if not self.AreCoLinear(f_reference_direction_radians, f_joiner_direction_radians):
-                                                        # not colinear
-                                                        f_closest_distance_squared = f_this_distance_squared
-                                                        b_found_segment_to_add = True
-                                                        n_ref_end_index_at_closest = n_ref_end_index
-
-                        # At last we've looked at all the candidate segment ends, as related to all the reference ends
-                        if not b_found_segment_to_add:
-                            # This segment is solitary.
-                            # Must start a new line, not joined to any previous paths
-                            delta_x = abs_line_segments[ref_count][1][0] - abs_line_segments[ref_count][0][0]  # end minus start, in original direction
-                            delta_y = abs_line_segments[ref_count][1][1] - abs_line_segments[ref_count][0][1]  # end minus start, in original direction
-                            path += ('M {0:f},{1:f} l {2:f},{3:f} '.format(abs_line_segments[ref_count][0][0],
-                                                                           abs_line_segments[ref_count][0][1],
-                                                                           delta_x,
-                                                                           delta_y))  # delta is from initial point
-                            f_distance_moved_with_pen_up += math.hypot(
-                                    abs_line_segments[ref_count][0][0] - pt_last_position_abs[0],
-                                    abs_line_segments[ref_count][0][1] - pt_last_position_abs[1])
-                            pt_last_position_abs[0] = abs_line_segments[ref_count][0][0] + delta_x
-                            pt_last_position_abs[1] = abs_line_segments[ref_count][0][1] + delta_y
-                            abs_line_segments[ref_count][2] = True  # True flags that this line segment has been
-                            # added to the path to be drawn, so should
-                            # no longer be a candidate for any kind of move.
-                            n_pen_lifts += 1
-                        else:
-                            # Found segment to add, and we must get to it in absolute terms
-                            delta_x = (abs_line_segments[ref_count][n_ref_end_index_at_closest][0] -
-                                       abs_line_segments[ref_count][not n_ref_end_index_at_closest][0])
-                            # final point (which was closer to the closest continuation segment) minus initial point = delta_x
-
-                            delta_y = (abs_line_segments[ref_count][n_ref_end_index_at_closest][1] -
-                                       abs_line_segments[ref_count][not n_ref_end_index_at_closest][1])
-                            # final point (which was closer to the closest continuation segment) minus initial point = delta_y
-
-                            path += ('M {0:f},{1:f} l '.format(abs_line_segments[ref_count][not n_ref_end_index_at_closest][0],
-                                                               abs_line_segments[ref_count][not n_ref_end_index_at_closest][1]))
-                            f_distance_moved_with_pen_up += math.hypot(
-                                    abs_line_segments[ref_count][not n_ref_end_index_at_closest][0] - pt_last_position_abs[0],
-                                    abs_line_segments[ref_count][not n_ref_end_index_at_closest][1] - pt_last_position_abs[1])
-                            pt_last_position_abs[0] = abs_line_segments[ref_count][not n_ref_end_index_at_closest][0]
-                            pt_last_position_abs[1] = abs_line_segments[ref_count][not n_ref_end_index_at_closest][1]
-                            # Note that this does not complete the line, as the completion (the delta_x, delta_y part) is being held in abeyance
-
-                            # We are coming up on a problem:
-                            # If we add a curve to the end of the line, we have made the curve extend beyond the end of the line,
-                            # and thus beyond the boundaries we should be respecting.
-                            # The solution is to hold in abeyance the actual plotting of the line,
-                            # holding it available for shrinking if a curve is to be added.
-                            # That is
-                            relative_held_line_pos = {0: delta_x, 1: delta_y}
-                            # delta is from initial point
-                            # Will be printed after we know if it must be modified
-                            # to keep the ending join within bounds
-                            pt_last_position_abs[0] += delta_x
-                            pt_last_position_abs[1] += delta_y
-
-                            abs_line_segments[ref_count][2] = True  # True flags that this line segment has been
-                            # added to the path to be drawn, so should
-                            # no longer be a candidate for any kind of move.
-                            n_pen_lifts += 1
-                            # Now comes the speedup logic:
-                            # We've just drawn a segment starting at an absolute, not relative, position.
-                            # It was drawn from pt1 to pt2.
-                            # Look for an as-yet-not-drawn segment which has a beginning or ending
-                            # point "near" the end point of this absolute draw, and leave the pen down
-                            # while moving to and then drawing this found line.
-                            # Do this recursively, marking each segment True to show that
-                            # it has been "drawn" already.
-                            # pt2 is the reference point, ie. the point from which the next segment will start
-                            path = self.recursivelyAppendNearbySegments(transformed_hatch_spacing,
-                                                                            0,
-                                                                            ref_count,
-                                                                            n_ref_end_index_at_closest,
-                                                                            n_abs_line_segment_total,
-                                                                            abs_line_segments,
-                                                                            path,
-                                                                            relative_held_line_pos)
-
-                self.joinFillsWithNode(key, stroke_width, path[:-1], transformed_hatch_spacing)
-
-    def recursivelyAppendNearbySegments(self,
-                                            transformed_hatch_spacing,
-                                            n_recursion_count,
-                                            n_ref_segment_count,
-                                            n_ref_end_index,
-                                            n_abs_line_segment_total,
-                                            abs_line_segments,
-                                            cumulative_path,
-                                            relative_held_line_pos):
-
-        global pt_last_position_abs
+        """
+        Choose the order in which to draw the segments ends, an N x 4
+        array, and which to join with a curve to the one drawn before.
+        Returns the arrays (starts, b_joined), giving for each segment in
+        drawing order the end it is drawn from and whether it is joined.
+
+        Each chain of joined segments is begun from the first segment not
+        yet drawn and grown from its end for as long as a segment can be
+        joined, see appendNearbySegments().  If n_element_segments gives the
+        number of segments of each of the elements pooled in ends, the
+        chains are built within each element, just as if it were joined on
+        its own, and then linked end to end across elements, see
+        linkChains(), so that pooling never lifts the pen more.
+        """
+
+        n_abs_line_segment_total = len(ends)
+        # b_drawn flags the segments already drawn
+        b_drawn = np.zeros(n_abs_line_segment_total, dtype=bool)
+        starts = []
+        b_joined = []
+
+        # Now have a nice juicy buffer full of line segments with absolute coordinates
         f_proposed_neighborhood_radius_squared = self.ProposeNeighborhoodRadiusSquared(transformed_hatch_spacing)
+        # Just fixed and simple for now - may make function of neighborhood later
+
+        # Size up once, for every segment end, the ends in its neighborhood it could be joined to
+        elements = None
+        if n_element_segments is not None:
+            elements = np.repeat(np.arange(len(n_element_segments)), n_element_segments)
+        preferences = self.joinPreferences(ends, f_proposed_neighborhood_radius_squared, elements=elements)
+
+        for ref_count in range(n_abs_line_segment_total):  # This is the entire range of segments,
+            # Sets ref_count to segment which has an end closest to current pen position.
+            # Doesn't need to select which end is closest, as that will happen below, with n_ref_end_at_closest.
+            # When we have gone thru this whole range, we will be completely done.
+            # We only get here again, after all _connected_ segments have been "drawn".
+            if not b_drawn[ref_count]:  # Test whether this segment has been drawn
+                # Has not been drawn yet
+
+                # Pre-qualify this segment on the issue of whether it has any connecting segments.
+                # If it does not, then it is drawn on its own, and we go on to the next.
+                # If it does have connecting segments, we need to go through the chaining logic.
+                # Lazily, again, select the desired direction of line ahead of time.
+                n_ref_end_at_closest = None  # default assumption: no segment to add
+                f_closest_distance_squared = 123456  # just a random large number
+                for n_ref_end in (2 * ref_count, 2 * ref_count + 1):
+                    # Look through all possibilities to choose the closest that fulfills all requirements e.g. direction and colinearity
+                    n_new_end, f_this_distance_squared = self.closestJoin(
+                            preferences, b_drawn, n_ref_end, f_closest_distance_squared)
+                    if n_new_end is not None:
+                        f_closest_distance_squared = f_this_distance_squared
+                        n_ref_end_at_closest = n_ref_end
+
+                b_drawn[ref_count] = True  # True flags that this line segment has been
+                # added to the path to be drawn, so should
+                # no longer be a candidate for any kind of move.
+                b_joined.append(False)
+                if n_ref_end_at_closest is None:
+                    # This segment is solitary, drawn in its original direction
+                    starts.append(2 * ref_count)
+                else:
+                    # Drawn towards the end closer to the closest continuation segment,
+                    # then look for an as-yet-not-drawn segment which has a beginning or ending
+                    # point "near" that end, and leave the pen down
+                    # while moving to and then drawing this found line.
+                    starts.append(n_ref_end_at_closest ^ 1)
+                    self.appendNearbySegments(n_ref_end_at_closest, b_drawn, preferences, starts, b_joined)
+
+        starts = np.array(starts, dtype=np.intp)
+        b_joined = np.array(b_joined, dtype=bool)
+        if n_element_segments is not None and len(n_element_segments) > 1 and len(starts):
+            # Chains are linked by their ends, whatever their elements
+            chain_ends = np.concatenate((starts[~b_joined], starts[np.append(~b_joined[1:], True)] ^ 1))
+            preferences = self.joinPreferences(ends, f_proposed_neighborhood_radius_squared, ref_ends=np.unique(chain_ends))
+            starts, b_joined = self.linkChains(starts, b_joined, preferences)
+        return starts, b_joined
+
+    def appendNearbySegments(self, n_ref_end, b_drawn, preferences, starts, b_joined):
 
-        # Look through all possibilities to choose the closest
-        b_found_segment_to_add = False  # default assumption
-        n_new_segment_end1_index_at_closest = 0
-        n_outer_count_at_closest = -1
-        f_closest_distance_squared = 123456789.0  # just a random large number
-
-        pt_reference = abs_line_segments[n_ref_segment_count][n_ref_end_index]
-        pt_reference_other_end = abs_line_segments[n_ref_segment_count][not n_ref_end_index]
-        f_reference_delta_x = pt_reference_other_end[0] - pt_reference[0]
-        f_reference_delta_y = pt_reference_other_end[1] - pt_reference[1]
-        f_reference_direction_radians = math.atan2(f_reference_delta_y, f_reference_delta_x)  # from other end to this end
-
-        for outerCount in range(n_abs_line_segment_total):  # investigate all segments
-            if not abs_line_segments[outerCount][2]:
-                # This segment currently undrawn, so it is a candidate for a path extension
-
-                # Need to check both ends of each and every proposed segment until we find one in the neighborhood
-                # Defines pt2 in the reference as the end which we want to extend
-
-                for n_new_segment_end1_index in range(2):
-                    # First try initial end of test segment (aka pt1) vs final end (aka pt2) of reference segment
-                    if outerCount != n_ref_segment_count:  # don't investigate self ends
-                        delta_x = abs_line_segments[outerCount][n_new_segment_end1_index][0] - pt_reference[0]  # proposed initial pt1 X minus existing final pt1 X
-                        delta_y = abs_line_segments[outerCount][n_new_segment_end1_index][1] - pt_reference[1]  # proposed initial pt1 Y minus existing final pt1 Y
-                        if (delta_x * delta_x + delta_y * delta_y) < f_proposed_neighborhood_radius_squared:
-                            f_this_distance_squared = delta_x * delta_x + delta_y * delta_y
-                            pt_new_segment_this_end = abs_line_segments[outerCount][n_new_segment_end1_index]
-                            pt_new_segment_other_end = abs_line_segments[outerCount][not n_new_segment_end1_index]
-                            f_new_segment_Dx = pt_new_segment_this_end[0] - pt_new_segment_other_end[0]
-                            f_new_segment_Dy = pt_new_segment_this_end[1] - pt_new_segment_other_end[1]
-                            f_new_segment_direction_radians = math.atan2(f_new_segment_Dy, f_new_segment_Dx)  # from other end to this end
-                            if not self.WouldBeAnAlternatingDirection(f_reference_direction_radians, f_new_segment_direction_radians):
-                                # If this end would cause an alternating direction,
-                                # then exclude it regardless of how close it is
-                                pass
-
-                            elif f_this_distance_squared < f_closest_distance_squared:
-                                # One other thing could rule out choosing this segment end:
-                                # Want to screen and remove two segments that, while close enough,
-                                # should be disqualified because they are colinear.  The reason for this is that
-                                # if they are colinear, they arose from the same global grid line, which means
-                                # that the gap between them arises from intersections with the boundary.
-                                # The idea here is that, all things being more-or-less equal,
-                                # we would like to give preference to connecting to a segment
-                                # which is the reverse of our current direction.  This makes for better
-                                # bezier curve join.
-                                # The criterion for being colinear is that the reference segment angle is effectively
-                                # the same as the line connecting the reference segment to the end of the new segment.
-
-                                f_joiner_direction_radians = math.atan2(pt_new_segment_this_end[1] - pt_reference[1], pt_new_segment_this_end[0] - pt_reference[0])
-                                if not self.AreCoLinear(f_reference_direction_radians, f_joiner_direction_radians):
-                                    # not colinear
-                                    f_closest_distance_squared = f_this_distance_squared
-                                    b_found_segment_to_add = True
-                                    n_new_segment_end1_index_at_closest = n_new_segment_end1_index
-                                    n_outer_count_at_closest = outerCount
-                                    delta_x_at_closest = delta_x
-                                    delta_y_at_closest = delta_y
-
-        # At last we've looked at all the candidate segment ends
-        n_recursion_count += 1
-        if not b_found_segment_to_add or n_recursion_count >= RECURSION_LIMIT:
-            cumulative_path += '{0:f},{1:f} '.format(relative_held_line_pos[0],
-                                                     relative_held_line_pos[1])  # close out this segment
-            pt_last_position_abs[0] += relative_held_line_pos[0]
-            pt_last_position_abs[1] += relative_held_line_pos[1]
-            return cumulative_path  # No undrawn segments were suitable for appending,
-            # or there were so many that we worry about python recursion limit
-        else:
-            n_new_segment_end1_index = n_new_segment_end1_index_at_closest
-            n_new_segment_end2_index = not n_new_segment_end1_index
-            # n_new_segment_end1_index is 0 for connecting to pt1,
-            # and is 1 for connecting to pt2
-            count = n_outer_count_at_closest  # count is the index of the segment to be appended.
-            delta_x = delta_x_at_closest  # delta from final end of incoming segment to initial end of outgoing segment
-            delta_y = delta_y_at_closest
-
-            # First, move pen to initial end (may be either its pt1 or its pt2) of new segment
-
-            # Insert a bezier curve for this transition element
-            # To accomplish this, we need information on the incoming and outgoing segments.
-            # Specifically, we need to know the lengths and angles of the segments in
-            # order to decide on control points.
-            f_in_Dx = abs_line_segments[n_ref_segment_count][n_ref_end_index][0] - abs_line_segments[n_ref_segment_count][not n_ref_end_index][0]
-            f_in_Dy = abs_line_segments[n_ref_segment_count][n_ref_end_index][1] - abs_line_segments[n_ref_segment_count][not n_ref_end_index][1]
-            # The outgoing deltas are based on the reverse direction of the segment, i.e. the segment pointing back to the joiner bezier curve
-            f_out_Dx = abs_line_segments[count][n_new_segment_end1_index][0] - abs_line_segments[count][n_new_segment_end2_index][0]  # index is [count][start point = 0, final point = 1][0=x, 1=y]
-            f_out_Dy = abs_line_segments[count][n_new_segment_end1_index][1] - abs_line_segments[count][n_new_segment_end2_index][1]
-
-            length_of_incoming = math.hypot(f_in_Dx, f_in_Dy)
-            length_of_outgoing = math.hypot(f_out_Dx, f_out_Dy)
-
-            # We are going to trim-up the ends of the incoming and outgoing segments,
-            # in order to get a curve which reliably does not extend beyond the boundary.
-            # Crude readings from inkscape on bezier curve overshoot, using control points extended hatch-spacing distance parallel to segment:
-            # when end points are in line, overshoot 12/16 in direction of segment
-            #          when at 45 degrees, overshoot 12/16 in direction of segment
-            #          when at 60 degrees, overshoot 12/16 in direction of segment
-            # Conclusion, at any angle, remove 0.75 * hatch spacing from the length of both lines,
-            # where 0.75 is, by no coincidence, BEZIER_OVERSHOOT_MULTIPLIER
-
-            # If hatches are getting quite short, we can use a smaller Bezier loop at
-            # the end to squeeze into smaller spaces.  We'll use a normal nice smooth
-            # curve for non-short hatches
-            f_desired_shorten_for_smoothest_join = transformed_hatch_spacing * BEZIER_OVERSHOOT_MULTIPLIER  # This is what we really want to use for smooth curves
-            # Separately check incoming vs outgoing lengths to see if bezier distances must be reduced,
-            # then choose greatest reduction to apply to both - lest we go off-course
-            # Finally, clip reduction to be no less than 1.0
-            f_control_point_divider_incoming = 2.0 * f_desired_shorten_for_smoothest_join / length_of_incoming
-            f_control_point_divider_outgoing = 2.0 * f_desired_shorten_for_smoothest_join / length_of_outgoing
-            if f_control_point_divider_incoming > f_control_point_divider_outgoing:
-                f_largest_desired_control_point_divider = f_control_point_divider_incoming
-            else:
-                f_largest_desired_control_point_divider = f_control_point_divider_outgoing
-            if f_largest_desired_control_point_divider < 1.0:
-                f_control_point_divider = 1.0
-            else:
-                f_control_point_divider = f_largest_desired_control_point_divider
-            f_desired_shorten = f_desired_shorten_for_smoothest_join / f_control_point_divider
-
-            pt_delta_to_subtract_from_incoming_end = self.RelativeControlPointPosition(f_desired_shorten, f_in_Dx, f_in_Dy, 0, 0)
-            # Note that this will be subtracted from the _point held in abeyance_.
-            relative_held_line_pos[0] -= pt_delta_to_subtract_from_incoming_end[0]
-            relative_held_line_pos[1] -= pt_delta_to_subtract_from_incoming_end[1]
-
-            pt_delta_to_add_to_outgoing_start = self.RelativeControlPointPosition(f_desired_shorten, f_out_Dx, f_out_Dy, 0, 0)
-
-            # We know that when we tack on a curve, we must chop some off the end of the incoming segment,
-            # and also chop some off the start of the outgoing segment.
-            # Now, we know we want the control points to be on a projection of each segment,
-            # in order that there be no abrupt change of plotting angle.  The question is, how
-            # far beyond the endpoint should we place the control point.
-            pt_relative_control_point_in = self.RelativeControlPointPosition(
-                    transformed_hatch_spacing / f_control_point_divider,
-                    f_in_Dx,
-                    f_in_Dy,
-                    0,
-                    0)
-            pt_relative_control_point_out = self.RelativeControlPointPosition(
-                    transformed_hatch_spacing / f_control_point_divider,
-                    f_out_Dx,
-                    f_out_Dy,
-                    delta_x,
-                    delta_y)
-
-            cumulative_path += '{0:f},{1:f} '.format(relative_held_line_pos[0],
-                                                     relative_held_line_pos[1])  # close out this segment, which has been modified
-            pt_last_position_abs[0] += relative_held_line_pos[0]
-            pt_last_position_abs[1] += relative_held_line_pos[1]
-            # add bezier cubic curve
-            cumulative_path += ('c {0:f},{1:f} {2:f},{3:f} {4:f},{5:f} l '.format(pt_relative_control_point_in[0],
-                                                                                  pt_relative_control_point_in[1],
-                                                                                  pt_relative_control_point_out[0],
-                                                                                  pt_relative_control_point_out[1],
-                                                                                  delta_x,
-                                                                                  delta_y))
-            pt_last_position_abs[0] += delta_x
-            pt_last_position_abs[1] += delta_y
-            # Next, move pen in appropriate direction to draw the new segment, given that
-            # we have just moved to the initial end of the new segment.
-            # This needs special treatment, as we just did some length changing.
-            delta_x = abs_line_segments[count][n_new_segment_end2_index][0] - abs_line_segments[count][n_new_segment_end1_index][0] + pt_delta_to_add_to_outgoing_start[0]
-            delta_y = abs_line_segments[count][n_new_segment_end2_index][1] - abs_line_segments[count][n_new_segment_end1_index][1] + pt_delta_to_add_to_outgoing_start[1]
-            relative_held_line_pos[0] = delta_x  # delta is from initial point
-            relative_held_line_pos[1] = delta_y  # Will be printed after we know if it must be modified
+        """
+        Starting from end n_ref_end of the segment just drawn, keep joining
+        the closest suitable undrawn segment, see closestJoin(), for as
+        long as one can be found, appending the end it is drawn from to
+        starts and True to b_joined.  This is a loop rather than a
+        recursion, so chains of any length can be built.
+        """
+
+        while True:
+            # Look through all possibilities to choose the closest
+            n_new_segment_end1, _ = self.closestJoin(preferences, b_drawn, n_ref_end,
+                                                     123456789.0)  # just a random large number
+            if n_new_segment_end1 is None:
+                return  # No undrawn segments were suitable for appending
 
             # Mark this segment as drawn
-            abs_line_segments[count][2] = True
-
-            cumulative_path = self.recursivelyAppendNearbySegments(transformed_hatch_spacing,
-                                                                       n_recursion_count,
-                                                                       count,
-                                                                       n_new_segment_end2_index,
-                                                                       n_abs_line_segment_total,
-                                                                       abs_line_segments,
-                                                                       cumulative_path,
-                                                                       relative_held_line_pos)
-            return cumulative_path
+            b_drawn[n_new_segment_end1 >> 1] = True
+            starts.append(n_new_segment_end1)
+            b_joined.append(True)
+
+            # The new segment is now the one to extend
+            n_ref_end = n_new_segment_end1 ^ 1
+
+    @staticmethod
+    def linkChains(starts, b_joined, preferences):
+
+        """
+        Link the chains of joinChains() end to end where an end of one is
+        among the joinPreferences() of the last end of another, returning
+        starts and b_joined in the new drawing order.  A chain is followed
+        by the closest of the chains not yet drawn it can be linked to, as
+        segments are by joinChains(), drawn backwards if it is its last end
+        that is linked.  Every link saves a pen lift and the chains are
+        otherwise drawn in their order, so there are never more pen lifts
+        than chains.
+        """
+
+        offsets, near_ends, distances = preferences
+        chain_firsts = np.flatnonzero(~b_joined)
+        chain_lasts = np.append(chain_firsts[1:], len(starts)) - 1
+        # The chain each segment end may enter, -1 for none, and whether backwards
+        chain_entered = np.full(len(offsets) - 1, -1, dtype=np.intp)
+        chain_entered[starts[chain_lasts] ^ 1] = np.arange(len(chain_firsts))
+        chain_entered[starts[chain_firsts]] = np.arange(len(chain_firsts))
+        b_backwards = np.zeros(len(offsets) - 1, dtype=bool)
+        b_backwards[starts[chain_lasts] ^ 1] = True
+        b_backwards[starts[chain_firsts]] = False
+
+        b_linked = np.zeros(len(chain_firsts), dtype=bool)
+        linked_starts = []
+        n_lifts = []  # Where the pen is lifted in the new drawing order
+        n_drawn = 0
+        for n_chain in range(len(chain_firsts)):
+            if b_linked[n_chain]:
+                continue
+            n_lifts.append(n_drawn)
+            n_entry = None
+            while True:
+                b_linked[n_chain] = True
+                chain = starts[chain_firsts[n_chain]:chain_lasts[n_chain] + 1]
+                if n_entry is not None and b_backwards[n_entry]:
+                    chain = (chain ^ 1)[::-1]
+                linked_starts.append(chain)
+                n_drawn += len(chain)
+
+                # The closest chain not yet drawn that the end of this one can be linked to
+                n_tail = chain[-1] ^ 1
+                for n in range(offsets[n_tail], offsets[n_tail + 1]):
+                    n_next_chain = chain_entered[near_ends[n]]
+                    if n_next_chain >= 0 and not b_linked[n_next_chain]:
+                        break
+                else:
+                    break
+                n_chain, n_entry = n_next_chain, near_ends[n]
+
+        linked_b_joined = np.ones(len(starts), dtype=bool)
+        linked_b_joined[n_lifts] = False
+        return np.concatenate(linked_starts), linked_b_joined
+
+    def joinPreferences(self, ends, f_proposed_neighborhood_radius_squared, ref_ends=None, elements=None):
+
+        """
+        For every end of the segments ends, an N x 4 array, the segment
+        ends it may be joined to, closest first: those of other segments in
+        the neighborhood which would continue the hatches in the
+        alternating direction without being colinear with its segment.
+        Ends as close are in the order a scan over all segments would visit
+        them.  Returned as the arrays (offsets, near_ends, distances
+        squared), the ends joinable to end e being
+        near_ends[offsets[e]:offsets[e + 1]].
+
+        Only the ends ref_ends, if given, are sized up, the others getting
+        no ends to join, and if elements gives the element of each segment,
+        only the ends of segments of the same element are joinable.
+        """
+
+        points = ends.reshape(-1, 2)
+        end_grid = SegmentEndGrid(ends, f_proposed_neighborhood_radius_squared)
+        # The direction of each segment, seen from each of its ends
+        f_outward_radians = np.arctan2(points[1::2, 1] - points[0::2, 1], points[1::2, 0] - points[0::2, 0])
+        f_inward_radians = np.arctan2(points[0::2, 1] - points[1::2, 1], points[0::2, 0] - points[1::2, 0])
+        # From the reference end to the other end of its segment
+        f_away_from_end_radians = np.column_stack((f_outward_radians, f_inward_radians)).ravel()
+        # From the other end of the segment to this end
+        f_towards_end_radians = np.column_stack((f_inward_radians, f_outward_radians)).ravel()
+
+        sized_up_ends = np.arange(len(points)) if ref_ends is None else ref_ends
+        batches = []
+        for n_first in range(0, len(sized_up_ends), N_MAX_JOIN_ENDS_PER_BATCH):
+            ref_ends, near_ends = end_grid.pairs(sized_up_ends[n_first:n_first + N_MAX_JOIN_ENDS_PER_BATCH])
+            b_other = (ref_ends >> 1) != (near_ends >> 1)  # don't investigate self ends
+            if elements is not None:
+                b_other &= elements[ref_ends >> 1] == elements[near_ends >> 1]
+            ref_ends, near_ends = ref_ends[b_other], near_ends[b_other]
+
+            delta_x = points[near_ends, 0] - points[ref_ends, 0]  # proposed initial pt1 X minus existing final pt1 X
+            delta_y = points[near_ends, 1] - points[ref_ends, 1]  # proposed initial pt1 Y minus existing final pt1 Y
+            f_this_distance_squared = delta_x * delta_x + delta_y * delta_y
+            b_near = f_this_distance_squared < f_proposed_neighborhood_radius_squared
+            ref_ends, near_ends = ref_ends[b_near], near_ends[b_near]
+            delta_x, delta_y, f_this_distance_squared = delta_x[b_near], delta_y[b_near], f_this_distance_squared[b_near]
+
+            # If this end would cause an alternating direction, then exclude it
+            f_reference_direction_radians = f_away_from_end_radians[ref_ends]
+            b_alternating = self.WouldBeAnAlternatingDirection(f_reference_direction_radians, f_towards_end_radians[near_ends])
+            ref_ends, near_ends = ref_ends[b_alternating], near_ends[b_alternating]
+            delta_x, delta_y, f_this_distance_squared = delta_x[b_alternating], delta_y[b_alternating], f_this_distance_squared[b_alternating]
+            f_reference_direction_radians = f_reference_direction_radians[b_alternating]
+
+            # One other thing could rule out choosing a segment end:
+            # Want to screen and remove two segments that, while close enough,
+            # should be disqualified because they are colinear.  The reason for this is that
+            # if they are colinear, they arose from the same global grid line, which means
+            # that the gap between them arises from intersections with the boundary.
+            # The idea here is that, all things being more-or-less equal,
+            # we would like to give preference to connecting to a segment
+            # which is the reverse of our current direction.  This makes for better
+            # bezier curve join.
+            # The criterion for being colinear is that the reference segment angle is effectively
+            # the same as the line connecting the reference segment to the end of the new segment.
+            f_joiner_direction_radians = np.arctan2(delta_y, delta_x)
+            b_suitable = ~self.AreCoLinear(f_reference_direction_radians, f_joiner_direction_radians)
+            batches.append((ref_ends[b_suitable], near_ends[b_suitable], f_this_distance_squared[b_suitable]))
+
+        ref_ends = np.concatenate([batch[0] for batch in batches] or [np.empty(0, dtype=np.intp)])
+        near_ends = np.concatenate([batch[1] for batch in batches] or [np.empty(0, dtype=np.intp)])
+        distances = np.concatenate([batch[2] for batch in batches] or [np.empty(0)])
+        order = np.lexsort((near_ends, distances, ref_ends))
+        offsets = np.searchsorted(ref_ends[order], np.arange(len(points) + 1))
+        return offsets, near_ends[order], distances[order]
+
+    @staticmethod
+    def closestJoin(preferences, b_drawn, n_ref_end, f_closest_distance_squared):
+
+        """
+        Return the segment end to join to end n_ref_end, and their squared
+        distance, or (None, None) if there is none: the first of its
+        joinPreferences() whose segment is not yet drawn, if it is closer
+        than f_closest_distance_squared
+        """
+
+        offsets, near_ends, distances = preferences
+        for n in range(offsets[n_ref_end], offsets[n_ref_end + 1]):
+            if not b_drawn[near_ends[n] >> 1]:
+                if distances[n] < f_closest_distance_squared:
+                    return int(near_ends[n]), float(distances[n])
+                break
+        return None, None
+
+    def appendJoinedSegment(self,
+                            transformed_hatch_spacing,
+                            n_ref_end,
+                            n_new_segment_end1,
+                            points,
+                            path,
+                            relative_held_line_pos):
+        """
+        Join the segment drawn from end n_new_segment_end1, a row of points,
+        to end n_ref_end of the segment drawn before it with a Bezier curve.
+        The path data of the segment before, held in abeyance in
+        relative_held_line_pos, is shortened to make room for the curve and
+        appended to path, a PathData, with the curve; that of the new
+        segment is left in relative_held_line_pos in turn.
+        """
+
+        pt_last_position_abs = self.pt_last_position_abs
+
+        # n_new_segment_end1 is the end of the new segment to connect to,
+        # n_new_segment_end2 the end it will be drawn to
+        n_new_segment_end2 = n_new_segment_end1 ^ 1
+        pt_reference = points[n_ref_end].tolist()
+        pt_reference_other_end = points[n_ref_end ^ 1].tolist()
+        pt_new_segment_end1 = points[n_new_segment_end1].tolist()
+        pt_new_segment_end2 = points[n_new_segment_end2].tolist()
+        delta_x = pt_new_segment_end1[0] - pt_reference[0]  # delta from final end of incoming segment to initial end of outgoing segment
+        delta_y = pt_new_segment_end1[1] - pt_reference[1]
+
+        # First, move pen to initial end (may be either its pt1 or its pt2) of new segment
+
+        # Insert a bezier curve for this transition element
+        # To accomplish this, we need information on the incoming and outgoing segments.
+        # Specifically, we need to know the lengths and angles of the segments in
+        # order to decide on control points.
+        f_in_Dx = pt_reference[0] - pt_reference_other_end[0]
+        f_in_Dy = pt_reference[1] - pt_reference_other_end[1]
+        # The outgoing deltas are based on the reverse direction of the segment, i.e. the segment pointing back to the joiner bezier curve
+        f_out_Dx = pt_new_segment_end1[0] - pt_new_segment_end2[0]
+        f_out_Dy = pt_new_segment_end1[1] - pt_new_segment_end2[1]
+
+        length_of_incoming = math.hypot(f_in_Dx, f_in_Dy)
+        length_of_outgoing = math.hypot(f_out_Dx, f_out_Dy)
+
+        # We are going to trim-up the ends of the incoming and outgoing segments,
+        # in order to get a curve which reliably does not extend beyond the boundary.
+        # Crude readings from inkscape on bezier curve overshoot, using control points extended hatch-spacing distance parallel to segment:
+        # when end points are in line, overshoot 12/16 in direction of segment
+        #          when at 45 degrees, overshoot 12/16 in direction of segment
+        #          when at 60 degrees, overshoot 12/16 in direction of segment
+        # Conclusion, at any angle, remove 0.75 * hatch spacing from the length of both lines,
+        # where 0.75 is, by no coincidence, BEZIER_OVERSHOOT_MULTIPLIER
+
+        # If hatches are getting quite short, we can use a smaller Bezier loop at
+        # the end to squeeze into smaller spaces.  We'll use a normal nice smooth
+        # curve for non-short hatches
+        f_desired_shorten_for_smoothest_join = transformed_hatch_spacing * BEZIER_OVERSHOOT_MULTIPLIER  # This is what we really want to use for smooth curves
+        # Separately check incoming vs outgoing lengths to see if bezier distances must be reduced,
+        # then choose greatest reduction to apply to both - lest we go off-course
+        # Finally, clip reduction to be no less than 1.0
+        f_control_point_divider_incoming = 2.0 * f_desired_shorten_for_smoothest_join / length_of_incoming
+        f_control_point_divider_outgoing = 2.0 * f_desired_shorten_for_smoothest_join / length_of_outgoing
+        if f_control_point_divider_incoming > f_control_point_divider_outgoing:
+            f_largest_desired_control_point_divider = f_control_point_divider_incoming
+        else:
+            f_largest_desired_control_point_divider = f_control_point_divider_outgoing
+        if f_largest_desired_control_point_divider < 1.0:
+            f_control_point_divider = 1.0
+        else:
+            f_control_point_divider = f_largest_desired_control_point_divider
+        f_desired_shorten = f_desired_shorten_for_smoothest_join / f_control_point_divider
+
+        pt_delta_to_subtract_from_incoming_end = self.RelativeControlPointPosition(f_desired_shorten, f_in_Dx, f_in_Dy, 0, 0)
+        # Note that this will be subtracted from the _point held in abeyance_.
+        relative_held_line_pos[0] -= pt_delta_to_subtract_from_incoming_end[0]
+        relative_held_line_pos[1] -= pt_delta_to_subtract_from_incoming_end[1]
+
+        pt_delta_to_add_to_outgoing_start = self.RelativeControlPointPosition(f_desired_shorten, f_out_Dx, f_out_Dy, 0, 0)
+
+        # We know that when we tack on a curve, we must chop some off the end of the incoming segment,
+        # and also chop some off the start of the outgoing segment.
+        # Now, we know we want the control points to be on a projection of each segment,
+        # in order that there be no abrupt change of plotting angle.  The question is, how
+        # far beyond the endpoint should we place the control point.
+        pt_relative_control_point_in = self.RelativeControlPointPosition(
+                transformed_hatch_spacing / f_control_point_divider,
+                f_in_Dx,
+                f_in_Dy,
+                0,
+                0)
+        pt_relative_control_point_out = self.RelativeControlPointPosition(
+                transformed_hatch_spacing / f_control_point_divider,
+                f_out_Dx,
+                f_out_Dy,
+                delta_x,
+                delta_y)
+
+        path.line(relative_held_line_pos[0], relative_held_line_pos[1])  # close out this segment, which has been modified
+        pt_last_position_abs[0] += relative_held_line_pos[0]
+        pt_last_position_abs[1] += relative_held_line_pos[1]
+        # add bezier cubic curve
+        path.curve(pt_relative_control_point_in[0],
+                   pt_relative_control_point_in[1],
+                   pt_relative_control_point_out[0],
+                   pt_relative_control_point_out[1],
+                   delta_x,
+                   delta_y)
+        pt_last_position_abs[0] += delta_x
+        pt_last_position_abs[1] += delta_y
+        # Next, move pen in appropriate direction to draw the new segment, given that
+        # we have just moved to the initial end of the new segment.
+        # This needs special treatment, as we just did some length changing.
+        delta_x = pt_new_segment_end2[0] - pt_new_segment_end1[0] + pt_delta_to_add_to_outgoing_start[0]
+        delta_y = pt_new_segment_end2[1] - pt_new_segment_end1[1] + pt_delta_to_add_to_outgoing_start[1]
+        relative_held_line_pos[0] = delta_x  # delta is from initial point
+        relative_held_line_pos[1] = delta_y  # Will be printed after we know if it must be modified
 
     def ProposeNeighborhoodRadiusSquared(self, transformed_hatch_spacing):
         return transformed_hatch_spacing * transformed_hatch_spacing * self.options.hatchScope * self.options.hatchScope
@@ -1414,27 +3825,584 @@ class Hatch_Fill(inkex.Effect):
         # atan2 returns values in the range -pi to +pi, so we must evaluate difference values
         # in the range of -2*pi to +2*pi
         # f_dir_diff_rad:  Direction difference, radians
+        # Either may be an array of directions
         f_dir_diff_rad = f_reference_direction_radians - f_new_segment_direction_radians
-        if f_dir_diff_rad < 0:
-            f_dir_diff_rad += 2 * math.pi
+        f_dir_diff_rad = np.where(f_dir_diff_rad < 0, f_dir_diff_rad + 2 * math.pi, f_dir_diff_rad)
         # Without having changed the vector direction of the difference, we have
         # now reduced the range to 0 to 2*pi
         f_dir_diff_rad -= math.pi  # flip opposite direction to coincide with same direction
         # Of course they may not be _exactly_ pi different due to osmosis, so allow a tolerance
-        b_ret_val = abs(f_dir_diff_rad) < RADIAN_TOLERANCE_FOR_ALTERNATING_DIRECTION
+        b_ret_val = np.abs(f_dir_diff_rad) < RADIAN_TOLERANCE_FOR_ALTERNATING_DIRECTION
 
         return b_ret_val
 
     @staticmethod
     def AreCoLinear(f_direction_1_radians, f_direction_2_radians):
-        # allow slight difference in angles, for floating-point indeterminacy
-        f_abs_delta_radians = abs(f_direction_1_radians - f_direction_2_radians)
-        if f_abs_delta_radians < RADIAN_TOLERANCE_FOR_COLINEAR:
-            return True
-        elif abs(f_abs_delta_radians - math.pi) < RADIAN_TOLERANCE_FOR_COLINEAR:
-            return True
+        # allow slight difference in angles, for floating-point indeterminacy;
+        # either may be an array of directions
+        f_abs_delta_radians = np.abs(f_direction_1_radians - f_direction_2_radians)
+        return ((f_abs_delta_radians < RADIAN_TOLERANCE_FOR_COLINEAR) |
+                (np.abs(f_abs_delta_radians - math.pi) < RADIAN_TOLERANCE_FOR_COLINEAR))
+
+
+def hatchElements(options_list, elements):
+
+    """
+    Process pool worker for Hatch_Fill.hatchInParallel().  Hatch each of
+    the (subpaths, stroke_width) elements on its own, once for each
+    options of options_list, and return for every element the list of
+    its PathData and the counters its hatching added, along with the
+    HatchStats of each options.  Options joining segments across
+    elements get the raw hatch segments instead.  The variants of an
+    element share its EdgeIndex, and the stages are memoized in the
+    caches of the worker's process.
+    """
+
+    effects = []
+    for options in options_list:
+        effect = Hatch_Fill()
+        effect.options = options
+        effects.append(effect)
+
+    paths = []
+    for subpaths, stroke_width in elements:
+        edge_indexes = {}
+        element_paths = []
+        for effect in effects:
+            effect.paths = {0: subpaths}
+            effect.hatches = {}
+            effect.segment_keys = {}
+            effect.edge_indexes = edge_indexes
+            before = dict(effect.stats.counters)
+            effect.hatchPaths()
+            path = effect.elementPathData(effect.hatches.get(0), effect.segment_keys.get(0), stroke_width)
+            element_paths.append((path, effect.countersSince(before)))
+        paths.append(element_paths)
+    return paths, [effect.stats for effect in effects]
+
+
+def hatchBand(options, lines, angles, edges, f_margin):
+
+    """
+    Process pool worker for Hatch_Fill.hatchBands().  Intersect the band
+    of hatch lines, at the given angles, with the edges of the polygon
+    and return its hatch segments along with the HatchStats of the run.
+    """
+
+    effect = Hatch_Fill()
+    effect.options = options
+    edge_index = EdgeIndex(None, edges, f_margin)
+    hatches = {}
+    with effect.stats.stage("interstices"):
+        if options.hatchEngine == "python":
+            line_hatches = {}
+            for h, paths in zip(lines.tolist(), edge_index.activePaths(lines, angles)):
+                interstices(effect, (h[0], h[1]), (h[2], h[3]), paths, line_hatches, effect.trimsHoldBack(), options.holdBackSteps)
+            for key, segments in line_hatches.items():
+                appendHatches(hatches, key, np.array(segments, dtype=float).reshape(-1, 4))
         else:
-            return False
+            interstices_batched(effect, lines, None, hatches, effect.trimsHoldBack(), options.holdBackSteps,
+                                angles, edge_index)
+    return hatches.get(0, np.empty((0, 4))), effect.stats
+
+
+@functools.lru_cache(maxsize=None)
+def processPool():
+
+    """
+    The pool of N_MAX_PROCESSES workers used for hatching elements in
+    parallel, started on first use and shared by every later run,
+    whatever its --processes.  Workers are spawned rather than forked,
+    as the API calls in from threads.
+    """
+
+    return ProcessPoolExecutor(max_workers=N_MAX_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+
+def processCount(processes):
+
+    """
+    The processes a run asking for processes hatches with: 0 for every
+    worker of the pool, else processes clamped to [1, N_MAX_PROCESSES].
+    A run splits its work for that many workers; the pool they share
+    bounds how many work at once.
+    """
+
+    if processes == 0:
+        return N_MAX_PROCESSES
+    return max(1, min(processes, N_MAX_PROCESSES))
+
+
+@dataclass(frozen=True)
+class HatchParams(object):
+    """
+    Settings for hatch(), named after the /api/hatch-svg query parameters.
+    Lengths are expressed in "unit".
+    """
+
+    hatch_spacing: float = 10.0
+    hatch_angle: float = 45.0
+    hold_back_steps: float = 1.0
+    cross_hatch: bool = False
+    reduce_pen_lifts: bool = False
+    hold_back_hatch_from_edges: bool = True
+    hold_back_mode: str = "trim"
+    hatch_scope: float = 3.0
+    tolerance: float = 20.0
+    unit: str = "mm"
+    hatch_engine: str = "numpy"
+    processes: int = 1
+    join_same_colour: bool = False
+    occlusion: bool = False
+    group_fills: bool = False
+
+    def to_args(self):
+        """
+        The equivalent Hatch_Fill command line arguments
+        """
+
+        return [
+            "--hatchSpacing", str(self.hatch_spacing),
+            "--hatchAngle", str(self.hatch_angle),
+            "--holdBackSteps", str(self.hold_back_steps),
+            "--crossHatch", str(self.cross_hatch).lower(),
+            "--reducePenLifts", str(self.reduce_pen_lifts).lower(),
+            "--holdBackHatchFromEdges", str(self.hold_back_hatch_from_edges).lower(),
+            "--holdBackMode", self.hold_back_mode,
+            "--hatchScope", str(self.hatch_scope),
+            "--tolerance", str(self.tolerance),
+            "--unit", self.unit,
+            "--hatchEngine", self.hatch_engine,
+            "--processes", str(self.processes),
+            "--joinSameColour", str(self.join_same_colour).lower(),
+            "--occlusion", str(self.occlusion).lower(),
+            "--groupFills", str(self.group_fills).lower(),
+        ]
+
+    def __post_init__(self):
+        # Refused here rather than by the option parser, which would exit
+        if self.hatch_engine not in HATCH_ENGINES:
+            raise ValueError("hatch_engine must be one of {0}, not {1!r}".format(
+                ", ".join(HATCH_ENGINES), self.hatch_engine))
+        if self.hold_back_mode not in HOLD_BACK_MODES:
+            raise ValueError("hold_back_mode must be one of {0}, not {1!r}".format(
+                ", ".join(HOLD_BACK_MODES), self.hold_back_mode))
+        if self.processes < 0:
+            raise ValueError("processes must be 0, for every core, or more, not {0}".format(self.processes))
+
+
+@dataclass
+class HatchResult(object):
+    """
+    Output of hatch(): the hatched document serialized as SVG
+    """
+
+    svg: bytes
+
+
+@dataclass(frozen=True)
+class HatchLimits(object):
+    """
+    Admission limits for a hatch request, checked against its
+    HatchEstimate before hatching
+    """
+
+    max_edges: int = 2000000
+    max_grid_lines: int = 1000000
+    max_segments: int = 2000000
+    max_output_bytes: int = 100 << 20
+    max_seconds: float = 60.0
+
+
+@dataclass(frozen=True)
+class HatchEstimate(object):
+    """
+    Predicted cost of a hatch run, from Hatch_Fill.estimate().  The
+    element and edge counts, fixed_output_bytes and fixed_seconds do not
+    depend on the hatch spacing; the rest grows in proportion to
+    1 / hatch_spacing, which is in the unit of the request.  Seconds are
+    those of a serial /api/hatch-svg request.
+    """
+
+    elements: int
+    edges: int
+    grid_lines: int
+    intersections: int
+    segments: int
+    output_bytes: int
+    seconds: float
+    hatch_spacing: float
+    fixed_output_bytes: int
+    fixed_seconds: float
+
+    @classmethod
+    def fromCounts(cls, n_elements, n_edges, f_lines, f_crossings, b_reduce_pen_lifts, hatch_spacing, f_spacing_mm):
+        # Odd/even: every other crossing ends a segment
+        f_segments = f_crossings / 2
+        fixed_seconds = F_SECONDS_PER_RUN + F_SECONDS_PER_ELEMENT * n_elements + F_SECONDS_PER_EDGE * n_edges
+        seconds = fixed_seconds + F_SECONDS_PER_GRID_LINE * f_lines + \
+            F_SECONDS_PER_INTERSECTION * f_crossings + F_SECONDS_PER_SEGMENT * f_segments
+        # Joining curves are flattened into steps of a fixed length, so
+        # their points grow with the spacing as the segments shrink
+        fixed_output_bytes = N_BYTES_PER_EDGE * n_edges
+        if b_reduce_pen_lifts:
+            fixed_output_bytes += N_BYTES_PER_JOIN_MM * f_spacing_mm * f_segments
+        output_bytes = fixed_output_bytes + N_BYTES_PER_SEGMENT * f_segments
+        return cls(elements=n_elements, edges=n_edges, grid_lines=int(round(f_lines)),
+                   intersections=int(round(f_crossings)), segments=int(round(f_segments)),
+                   output_bytes=int(round(output_bytes)), seconds=round(seconds, 3),
+                   hatch_spacing=hatch_spacing, fixed_output_bytes=int(round(fixed_output_bytes)),
+                   fixed_seconds=round(fixed_seconds, 3))
+
+    def quantities(self, limits):
+        """
+        (name, estimate, the part of it not shrinking as the hatch
+        spacing grows, limit) for each limited quantity
+        """
+
+        return [
+            ("polygon edges", self.edges, self.edges, limits.max_edges),
+            ("grid lines", self.grid_lines, 0, limits.max_grid_lines),
+            ("hatch segments", self.segments, 0, limits.max_segments),
+            ("output bytes", self.output_bytes, self.fixed_output_bytes, limits.max_output_bytes),
+            ("seconds", self.seconds, self.fixed_seconds, limits.max_seconds),
+        ]
+
+    def exceeded(self, limits):
+        """
+        Describe each limit the estimate is over, as a list of strings
+        """
+
+        return ["about {0:,.0f} {1}, over the limit of {2:,.0f}".format(value, name, limit)
+                for name, value, fixed, limit in self.quantities(limits) if value > limit]
+
+    def coarsenedSpacing(self, limits):
+        """
+        The smallest hatch spacing, at least the estimated one, whose
+        run would be within limits, or None when the document is over
+        them whatever the spacing
+        """
+
+        factor = 1.0
+        for name, value, fixed, limit in self.quantities(limits):
+            if value > limit:
+                if fixed >= limit:
+                    return None
+                factor = max(factor, (value - fixed) / (limit - fixed))
+        return self.hatch_spacing * factor
+
+    def as_dict(self):
+        return asdict(self)
+
+
+@functools.lru_cache(maxsize=None)
+def optionParser():
+    """
+    The Hatch_Fill argument parser, built once and shared: inkex's own
+    arguments and those of Hatch_Fill.addOptions().  Parsing does not
+    modify the parser, so it may be used from several threads.
+    """
+
+    parser = inkex.Effect().arg_parser
+    Hatch_Fill.addOptions(parser)
+    return parser
+
+
+def runHatchFill(svg, params=None, join_fills=True, stats=None, cancel_token=None, reused=None, changed_ids=()):
+    """
+    Run Hatch_Fill over the SVG document given as bytes and return it.
+    The run records its timings and counters in stats, if given, else in
+    a HatchStats of its own, and raises Cancelled once cancel_token, if
+    given, is cancelled.  Given reused, the hatches of an earlier run by
+    element id, only the elements changed_ids names or reused lacks are
+    hatched, see Hatch_Fill.hatchReusing().
+    """
+
+    if params is None:
+        params = HatchParams()
+    effect = Hatch_Fill()
+    effect.options = optionParser().parse_args(params.to_args())
+    effect.join_fills = join_fills
+    if stats is not None:
+        effect.stats = stats
+    if cancel_token is not None:
+        effect.cancel_token = cancel_token
+    with effect.stats.stage("parse"):
+        effect.document = effect.load(io.BytesIO(svg))
+    if reused is not None:
+        effect.hatchReusing(reused, changed_ids)
+    else:
+        effect.effect()
+    return effect
+
+
+def result_handle(svg, params):
+    """
+    The handle under which hatch_document() keeps the hatches of the SVG
+    document given as bytes hatched with params, for re-hatching the
+    document once edited
+    """
+
+    return hashlib.sha1(svg + repr(params).encode('utf-8')).hexdigest()
+
+
+def estimate_hatch(svg, params=None, cancel_token=None):
+    """
+    Estimate the cost of hatching the SVG document given as bytes with
+    params, without hatching it, and return a HatchEstimate
+    """
+
+    return estimate_variants(svg, [params if params is not None else HatchParams()], cancel_token)[0]
+
+
+def estimate_variants(svg, params_list, cancel_token=None):
+    """
+    Estimate the cost of hatching the SVG document given as bytes with
+    each HatchParams of params_list, as estimate_hatch() would, and
+    return a HatchEstimate for each.  The SVG is parsed once, and
+    flattened once for each tolerance through the flatten_cache.
+    """
+
+    estimates = []
+    document = None
+    for params in params_list:
+        effect = Hatch_Fill()
+        effect.options = optionParser().parse_args(params.to_args())
+        if cancel_token is not None:
+            effect.cancel_token = cancel_token
+        if document is None:
+            document = effect.load(io.BytesIO(svg))
+        effect.document = document
+        effect.svg = document.getroot()
+        estimates.append(effect.estimate())
+    return estimates
+
+
+def hatch(svg, params=None):
+    """
+    Hatch the SVG document given as bytes and return a HatchResult.
+
+    All state lives in a Hatch_Fill instance private to this call; neither
+    sys.argv nor any module global is touched, so calls may run
+    concurrently on a thread or process pool.
+    """
+
+    effect = runHatchFill(svg, params)
+    output = io.BytesIO()
+    effect.save(output)
+    return HatchResult(svg=output.getvalue())
+
+
+def hatch_document(svg, params=None, quantization=None, stats=None, cancel_token=None, base=None, changed_ids=()):
+    """
+    Hatch the SVG document given as bytes straight into a vpype Document,
+    without writing the hatched SVG out and reading it back in.
+
+    The Document holds the geometry of the SVG itself, read as
+    `vpype read --attr stroke` would, with the hatch lines added to the
+    layer of their stroke colour.  Joining curves are flattened into
+    segments no longer than quantization, vpype's 0.1mm by default.
+    Timings and counters are recorded in stats, if given, and Cancelled
+    is raised once cancel_token, if given, is cancelled.
+
+    The hatches of the elements are kept under result_handle(svg, params).
+    Given the handle of an earlier result of the same params as base,
+    the elements keep their hatches from there, except those changed_ids
+    names, with their descendants, and those new to the document, which
+    are hatched.  The Document is the same as for hatching the whole
+    document.  Without base, or when it is no longer kept, was hatched
+    with other params, or with occlusion, joinSameColour or groupFills,
+    where an element's hatches depend on the others, the whole document
+    is hatched.
+    """
+
+    import vpype
+
+    if params is None:
+        params = HatchParams()
+    if quantization is None:
+        quantization = vpype.convert_length("0.1mm")
+
+    b_reusable = not params.occlusion and not params.join_same_colour and not params.group_fills
+    reused = None
+    earlier = result_cache.get(base) if base is not None and b_reusable else None
+    if earlier is not None and earlier[0] == params:
+        reused = earlier[1]
+
+    effect = runHatchFill(svg, params, join_fills=False, stats=stats, cancel_token=cancel_token,
+                          reused=reused, changed_ids=changed_ids)
+    if b_reusable:
+        hatches = effect.hatchesById()
+        result_cache.put(result_handle(svg, params), (params, hatches), valueBytes(list(hatches.values())))
+    with effect.stats.stage("vpype"):
+        document = vpype.read_svg_by_attributes(io.BytesIO(svg), ["stroke"], quantization)
+        addHatchLayers(document, effect, quantization)
+    return document
+
+
+def hatch_variants(svg, params_list, quantization=None, processes=0, cancel_token=None):
+    """
+    Hatch the SVG document given as bytes once for each HatchParams of
+    params_list and return a vpype Document for each, as hatch_document()
+    would.
+
+    The SVG is parsed and read by vpype once, and flattened once for each
+    tolerance, occlusion and groupFills setting.  The variants are then
+    hatched side by side on the process pool, with processes workers (0
+    uses all of them, see processCount()): each element is hatched for
+    every variant in turn, sharing its edge index wherever the angle
+    repeats.  With processes 1, the variants are hatched serially, one
+    after the other, each taking the polygons of the elements from the
+    flatten_cache.
+    Cancelled is raised once cancel_token, if given, is cancelled.
+    """
+
+    import vpype
+
+    if quantization is None:
+        quantization = vpype.convert_length("0.1mm")
+
+    effects = []
+    by_tolerance = {}
+    for params in params_list:
+        effect = Hatch_Fill()
+        effect.options = optionParser().parse_args(params.to_args())
+        effect.options.processes = processes
+        effect.join_fills = False
+        if cancel_token is not None:
+            effect.cancel_token = cancel_token
+        effects.append(effect)
+        by_tolerance.setdefault((effect.options.tolerance, effect.options.occlusion, effect.options.groupFills),
+                                []).append(effect)
+    if not effects:
+        return []
+
+    base = vpype.read_svg_by_attributes(io.BytesIO(svg), ["stroke"], quantization)
+    with effects[0].stats.stage("parse"):
+        document = effects[0].load(io.BytesIO(svg))
+    for effect in effects:
+        effect.document = document
+        effect.svg = document.getroot()
+
+    if processCount(processes) == 1:
+        # Only the pool hatches the variants of an element together
+        for effect in effects:
+            effect.effect()
+    else:
+        # The first run of each tolerance, occlusion and groupFills traverses the document, the others ride along
+        for group in by_tolerance.values():
+            for effect in group[1:]:
+                effect.prepareOptions()
+            group[0].variants = group[1:]
+            group[0].effect()
+
+    documents = []
+    for effect in effects:
+        with effect.stats.stage("vpype"):
+            variant = copy.deepcopy(base)
+            addHatchLayers(variant, effect, quantization)
+        documents.append(variant)
+    return documents
+
+
+def hatch_preview(svg, params=None, cancel_token=None):
+    """
+    Hatch the SVG document given as bytes element by element, yielding a
+    preview of the result as SVG text while it is being hatched: first
+    the <svg> header, with the size and viewBox of the original, then
+    one <g> for each element as soon as it is hatched, holding the
+    element's flattened outline and its hatch lines in its fill colour,
+    and finally the closing tag.
+
+    The preview is a document of its own, not the hatch_document() result
+    drawn early: it holds only the hatched elements, not the strokes of
+    the original or its vpype layers, and hatches each element on its
+    own, ignoring processes, joinSameColour and groupFills, see
+    Hatch_Fill.iterHatchPaths().
+
+    Once cancel_token, if given, is cancelled, the preview stops before
+    the next element and ends with PREVIEW_TRUNCATED, naming the reason,
+    then the closing tag, so that it is still a whole SVG document.  An
+    error ends it the same way before it is raised.
+    """
+
+    if params is None:
+        params = HatchParams()
+    effect = Hatch_Fill()
+    effect.options = optionParser().parse_args(params.to_args())
+    if cancel_token is not None:
+        effect.cancel_token = cancel_token
+    with effect.stats.stage("parse"):
+        effect.document = effect.load(io.BytesIO(svg))
+
+    root = effect.document.getroot()
+    attributes = ''.join(' {0}={1}'.format(name, quoteattr(root.get(name)))
+                         for name in ('width', 'height', 'viewBox') if root.get(name) is not None)
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<svg xmlns="http://www.w3.org/2000/svg"{0}>\n'.format(attributes)
+
+    try:
+        for node, path, transformed_hatch_spacing in effect.iterHatchPaths():
+            yield previewGroup(effect, node, path, transformed_hatch_spacing)
+    except Cancelled as e:
+        yield PREVIEW_TRUNCATED.format(e.reason)
+    except Exception:
+        # Still a whole document, the error going on to the caller
+        yield PREVIEW_TRUNCATED.format("error") + '</svg>\n'
+        raise
+
+    yield '</svg>\n'
+
+
+def previewGroup(effect, node, path, transformed_hatch_spacing):
+    """
+    The <g> of hatch_preview() for node, as text
+    """
+
+    style = {'stroke': '{0}'.format(effect.hatchStrokeColor(node)), 'fill': 'none',
+             'stroke-width': '{0}'.format(transformed_hatch_spacing)}
+    g = etree.Element('g', {'id': '{0}-hatch'.format(node.get_id()), 'style': str(inkex.Style(style))})
+    # The flattened outline, like the hatches, is in document coordinates
+    subpaths = effect.documentSubpaths(node) if node in effect.paths else []
+    outline = ' '.join('M ' + ' L '.join('%f,%f' % (x, y) for x, y in subpath.tolist()) + ' Z'
+                       for subpath in subpaths)
+    if outline:
+        etree.SubElement(g, 'path', {'d': outline})
+    etree.SubElement(g, 'path', {'d': effect.pathString(path)})
+    return etree.tostring(g, encoding='unicode') + '\n'
+
+
+def addHatchLayers(document, effect, quantization):
+    """
+    Add the hatches recorded by the Hatch_Fill run effect to the vpype
+    document read from the same SVG, each to the layer of its stroke
+    colour
+    """
+
+    import vpype
+
+    # Hatches are in user units, the Document is in pixels of the page
+    page_width, page_height = document.page_size
+    vx, vy, vw, vh = effect.svg.get_viewbox()
+    sx = page_width / vw if vw else 1.0
+    sy = page_height / vh if vh else 1.0
+
+    layer_ids = {layer.metadata.get("svg_stroke"): layer_id for layer_id, layer in document.layers.items()}
+    for node, path, transformed_hatch_spacing in effect.hatch_paths:
+        effect.cancel_token.check()
+        stroke = '{0}'.format(effect.hatchStrokeColor(node))
+        lines = [complex(-vx * sx, -vy * sy) + line.real * sx + 1j * line.imag * sy
+                 for line in effect.pathLines(path, quantization / sx if sx else quantization)]
+        lc = vpype.LineCollection(lines, {
+            "svg_stroke": stroke,
+            "vp_color": vpype.Color(stroke),
+            "vp_pen_width": transformed_hatch_spacing * sx,
+        })
+        lc.crop(0, 0, page_width, page_height)
+        if stroke in layer_ids:
+            document.add(lc, layer_ids[stroke])
+        else:
+            layer_ids[stroke] = document.free_id()
+            document.add(lc, layer_ids[stroke], with_metadata=True)
 
 
 if __name__ == '__main__':
@@ -1,21 +1,30 @@
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, Response, Query
+from fastapi import FastAPI, UploadFile, File, Form, Response, Query, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from shapely.geometry import MultiLineString
+from dataclasses import asdict, replace
 import vpype
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import contextlib
+import io
+import itertools
+import json
 import os
 import tempfile
 import toml
 import vpype_cli
 from vpype import read_svg_by_attributes
-import sys
 import requests
 import svgutils.transform as sg
 import uvicorn
 from pathlib import Path
+from typing import Literal
 
+from cancellation import Cancelled, CancelToken, Sessions
 from hatched import hatched
-from hatch_fill import Hatch_Fill
+from hatch_fill import HatchEstimate, HatchLimits, HatchParams, HatchStats, estimate_hatch, estimate_variants, hatch_document, hatch_preview, hatch_variants, result_handle
 from isolines import clean_svg
 from depth import get_depth_image
 from isolines import get_isolines
@@ -40,8 +49,57 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Hatch-Stats", "X-Hatch-Spacing", "X-Hatch-Result"],
 )
 
+# Seconds after which a long running request is abandoned, unless it asks for another deadline
+DEADLINE_SECONDS = float(os.getenv("DEADLINE_SECONDS", 300))
+
+# Seconds between checks for a client that has gone away
+DISCONNECT_POLL_SECONDS = 0.25
+
+# The work running for each client session, superseded by the session's next request
+sessions = Sessions()
+
+def session_key(request: Request, session: str):
+    """
+    Key of a client session's work on the endpoint of request, or None without a session
+    """
+    return (request.url.path, session) if session else None
+
+async def run_cancellable(request: Request, cancel_token: CancelToken, func, *args):
+    """
+    Run func(*args) on a worker thread, as run_in_threadpool does, cancelling cancel_token
+    when the client disconnects.  func is expected to check the token and raise Cancelled.
+    """
+    task = asyncio.ensure_future(run_in_threadpool(func, *args))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return task.result()
+        if not cancel_token.cancelled and await request.is_disconnected():
+            cancel_token.cancel(CancelToken.DISCONNECTED)
+
+def cancelled_response(e: Cancelled) -> Response:
+    """
+    The response to a request whose work was cancelled: 504 past its deadline, 409 when
+    superseded by a newer request of its session and 499 when the client went away
+    """
+    status_code = {CancelToken.DEADLINE: 504, CancelToken.SUPERSEDED: 409}.get(e.reason, 499)
+    return Response(
+        content=f"Request {e}",
+        status_code=status_code,
+        media_type="text/plain"
+    )
+
+def session_stream(chunks, session_scope: contextlib.ExitStack):
+    """
+    Stream chunks in the session of session_scope, which is closed with the stream.
+    The chunks end themselves once cancelled, see hatch_preview().
+    """
+    with session_scope:
+        yield from chunks
+
 async def upload_file_to_temp(upload_file: UploadFile, suffix: str = None) -> str:
     import tempfile
     
@@ -305,82 +363,151 @@ async def vectorize(
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
-@app.post("/api/hatch-svg")
-async def hatch_svg(
-    file: UploadFile = File(...),
+# Admission limits for the hatch endpoints, checked against an estimate
+# of each request before it is hatched
+HATCH_LIMITS = HatchLimits(
+    max_edges=int(os.getenv("HATCH_MAX_EDGES", HatchLimits.max_edges)),
+    max_grid_lines=int(os.getenv("HATCH_MAX_GRID_LINES", HatchLimits.max_grid_lines)),
+    max_segments=int(os.getenv("HATCH_MAX_SEGMENTS", HatchLimits.max_segments)),
+    max_output_bytes=int(os.getenv("HATCH_MAX_OUTPUT_BYTES", HatchLimits.max_output_bytes)),
+    max_seconds=float(os.getenv("HATCH_MAX_SECONDS", HatchLimits.max_seconds)),
+)
+
+def hatch_params(
     hatch_spacing: float = Query(10.0, description="Spacing between hatch lines"),
     hatch_angle: float = Query(45.0, description="Angle of inclination for hatch lines"),
     hold_back_steps: float = Query(1.0, description="How far hatch strokes stay from boundary"),
     cross_hatch: bool = Query(False, description="Generate a cross hatch pattern"),
     reduce_pen_lifts: bool = Query(False, description="Reduce plotting time by joining some hatches"),
     hold_back_hatch_from_edges: bool = Query(True, description="Stay away from edges"),
+    hold_back_mode: Literal["trim", "inset"] = Query("trim", description="Hold back by trimming each hatch (trim) or by insetting the shapes once (inset)"),
     hatch_scope: float = Query(3.0, description="Radius searched for segments to join"),
     tolerance: float = Query(20.0, description="Allowed deviation from original paths"),
-    unit: str = Query("mm", description="Unit for measurements")
+    unit: str = Query("mm", description="Unit for measurements"),
+    hatch_engine: Literal["numpy", "python"] = Query("numpy", description="Intersection engine: numpy or python"),
+    processes: int = Query(1, ge=0, description="Processes hatching elements in parallel, 0 uses every core"),
+    join_same_colour: bool = Query(False, description="Reduce pen lifts across all the elements of a colour"),
+    occlusion: bool = Query(False, description="Hatch only the parts of shapes not covered by filled shapes painted over them"),
+    group_fills: bool = Query(False, description="Hatch the shapes of a group sharing a fill as one compound shape")
+) -> HatchParams:
+    """
+    The HatchParams of the hatch endpoints, from their query parameters
+    """
+    return HatchParams(
+        hatch_spacing=hatch_spacing,
+        hatch_angle=hatch_angle,
+        hold_back_steps=hold_back_steps,
+        cross_hatch=cross_hatch,
+        reduce_pen_lifts=reduce_pen_lifts,
+        hold_back_hatch_from_edges=hold_back_hatch_from_edges,
+        hold_back_mode=hold_back_mode,
+        hatch_scope=hatch_scope,
+        tolerance=tolerance,
+        unit=unit,
+        hatch_engine=hatch_engine,
+        processes=processes,
+        join_same_colour=join_same_colour,
+        occlusion=occlusion,
+        group_fills=group_fills,
+    )
+
+async def admit_hatch(contents: bytes, params: HatchParams, on_limit: str, hatch_stats: HatchStats = None,
+                      cancel_token: CancelToken = None):
+    """
+    Estimate the cost of hatching contents with params and check it against HATCH_LIMITS.
+    Returns the params to hatch with, coarsened if on_limit is "coarsen" and the hatch spacing
+    is too fine, and None; or params and an error Response: 413 when the document is over the
+    limits whatever the spacing, 422 when a coarser spacing would do.
+    """
+    if hatch_stats is None:
+        hatch_stats = HatchStats()
+    with hatch_stats.stage("estimate"):
+        estimate = await run_in_threadpool(estimate_hatch, contents, params, cancel_token)
+    return admit_estimate(params, estimate, on_limit)
+
+def admit_estimate(params: HatchParams, estimate: HatchEstimate, on_limit: str):
+    """
+    Check the HatchEstimate of hatching with params against HATCH_LIMITS, answering as admit_hatch does
+    """
+    exceeded = estimate.exceeded(HATCH_LIMITS)
+    if not exceeded:
+        return params, None
+
+    spacing = estimate.coarsenedSpacing(HATCH_LIMITS)
+    if spacing is None:
+        return params, Response(
+            content=f"Document too large to hatch: {'; '.join(exceeded)}",
+            status_code=413,
+            media_type="text/plain"
+        )
+    if on_limit != "coarsen":
+        return params, Response(
+            content=f"Hatch spacing too fine: {'; '.join(exceeded)}. "
+                    f"A hatch spacing of at least {spacing:.3g}{params.unit} would be accepted.",
+            status_code=422,
+            media_type="text/plain"
+        )
+    return replace(params, hatch_spacing=spacing), None
+
+@app.post("/api/hatch-svg")
+async def hatch_svg(
+    request: Request,
+    file: UploadFile = File(...),
+    params: HatchParams = Depends(hatch_params),
+    on_limit: str = Query("reject", description="Over the admission limits: reject the request, or coarsen the hatch spacing until it fits"),
+    stats: bool = Query(False, description="Also return the stage timings and counters as JSON in the X-Hatch-Stats header"),
+    session: str = Query(None, description="Client session; a newer request of the same session cancels this one"),
+    deadline: float = Query(DEADLINE_SECONDS, description="Seconds after which hatching is abandoned"),
+    base: str = Query(None, description="X-Hatch-Result of an earlier request for an earlier version of the file"),
+    ids: str = Query("", description="Comma separated ids of the elements changed since base")
 ):
     """
     Hatch an SVG file using the Hatch_Fill class directly.
     This endpoint processes SVG files and adds hatching patterns to them.
+    The time spent in each stage of the hatching is reported in the Server-Timing header.
+    /api/hatch-svg-preview streams a preview of the hatches instead.
+    Requests estimated to go over the admission limits are refused with 413 or 422, see
+    /api/hatch-svg-estimate, or with on_limit=coarsen hatched at the finest spacing within them,
+    which is returned in the X-Hatch-Spacing header.
+    Hatching stops between elements once the client disconnects, the deadline passes or a newer
+    request of the same session arrives, see cancelled_response().
+    The X-Hatch-Result header is a handle on the hatches of the result. Sent back as base with an
+    edited file and the ids of the elements changed, only those elements and the elements new to
+    the file are hatched again, the others keeping their hatches from base; see hatch_document().
     """
-    # Save uploaded file to a temporary location
-    input_svg_path = await upload_file_to_temp(file, ".svg")
-    
+    contents = await file.read()
+    cancel_token = CancelToken(deadline)
+
+    session_scope = contextlib.ExitStack()
+    session_scope.enter_context(sessions.running(session_key(request, session), cancel_token))
     try:
-        # Create a temporary output file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as tmp_output:
-            output_svg_path = tmp_output.name
-        
-        # Set up sys.argv to simulate command line arguments for Hatch_Fill
-        original_argv = sys.argv.copy()
-        sys.argv = [
-            "hatch_fill.py",
-            "--output", output_svg_path,
-            "--hatchSpacing", str(hatch_spacing),
-            "--hatchAngle", str(hatch_angle),
-            "--holdBackSteps", str(hold_back_steps),
-            "--crossHatch", str(cross_hatch).lower(),
-            "--reducePenLifts", str(reduce_pen_lifts).lower(),
-            "--holdBackHatchFromEdges", str(hold_back_hatch_from_edges).lower(),
-            "--hatchScope", str(hatch_scope),
-            "--tolerance", str(tolerance),
-            "--unit", unit,
-            input_svg_path
-        ]
-        
-        try:
-            # Run the Hatch_Fill class directly
-            hatch_fill = Hatch_Fill()
-            hatch_fill.run()
-            
-            # Read the output SVG file
-            with open(output_svg_path, "r") as f:
-                svg_content = f.read()
-            
-            # Create a temporary file for the final output
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as tmp_final:
-                final_output_path = tmp_final.name
-            
-            try:
-                # Run vpype to remove fills and keep only strokes
-                import vpype_cli
-                new_doc = vpype_cli.execute(pipeline=f"read --attr stroke {output_svg_path}")
-
-                # Return SVG as XML
-                return document_to_svg_response(new_doc)
-                
-            except Exception as e:
-                # If vpype fails, return the original hatched SVG
-                print(f"Warning: vpype command failed: {str(e)}")
-                return Response(content=svg_content, media_type="image/svg+xml")
-            finally:
-                # Clean up the final output file
-                if os.path.exists(final_output_path):
-                    os.remove(final_output_path)
-            
-        finally:
-            # Restore original sys.argv
-            sys.argv = original_argv
-        
+        hatch_stats = HatchStats()
+        admitted, refusal = await admit_hatch(contents, params, on_limit, hatch_stats, cancel_token)
+        if refusal is not None:
+            return refusal
+        headers = {}
+        if admitted.hatch_spacing != params.hatch_spacing:
+            headers["X-Hatch-Spacing"] = f"{admitted.hatch_spacing:g}"
+
+        # Hatch on a worker thread straight into a vpype Document;
+        # all state is private to this call
+        changed_ids = [id_ for id_ in ids.split(",") if id_]
+        document = await run_cancellable(request, cancel_token, hatch_document, contents, admitted, None, hatch_stats, cancel_token,
+                                         base, changed_ids)
+        headers["X-Hatch-Result"] = result_handle(contents, admitted)
+
+        # Return SVG as XML
+        with hatch_stats.stage("serialize"):
+            response = document_to_svg_response(document)
+        response.headers.update(headers)
+        response.headers["Server-Timing"] = hatch_stats.server_timing()
+        if stats:
+            response.headers["X-Hatch-Stats"] = json.dumps(hatch_stats.as_dict())
+        return response
+
+    except Cancelled as e:
+        return cancelled_response(e)
+
     except Exception as e:
         # Return a proper error response
         return Response(
@@ -388,12 +515,160 @@ async def hatch_svg(
             status_code=500,
             media_type="text/plain"
         )
+
     finally:
-        # Clean up temporary files
-        if os.path.exists(input_svg_path):
-            os.remove(input_svg_path)
-        if os.path.exists(output_svg_path):
-            os.remove(output_svg_path)
+        session_scope.close()
+
+@app.post("/api/hatch-svg-preview")
+async def hatch_svg_preview(
+    request: Request,
+    file: UploadFile = File(...),
+    params: HatchParams = Depends(hatch_params),
+    on_limit: str = Query("reject", description="Over the admission limits: reject the request, or coarsen the hatch spacing until it fits"),
+    session: str = Query(None, description="Client session; a newer request of the same session cancels this one"),
+    deadline: float = Query(DEADLINE_SECONDS, description="Seconds after which hatching is abandoned")
+):
+    """
+    Stream a preview of the hatches of an SVG file while it is being hatched, see hatch_preview():
+    the SVG header at once, then a group with the flattened outline and the hatches of each element
+    as soon as it is hatched. The preview is a format of its own, not the /api/hatch-svg result:
+    it holds only the hatched elements, each hatched serially and on its own, so requests with
+    processes other than 1, join_same_colour or group_fills are refused with 422.
+    Admission and cancellation are those of /api/hatch-svg, but once the preview has started a
+    cancelled one ends with an <!-- hatch-preview truncated: reason --> comment before </svg>.
+    """
+    unsupported = [name for name, value in (("processes", params.processes != 1),
+                                           ("join_same_colour", params.join_same_colour),
+                                           ("group_fills", params.group_fills)) if value]
+    if unsupported:
+        return Response(
+            content=f"Not supported by the preview, which hatches each element serially and on its own: "
+                    f"{', '.join(unsupported)}. Use /api/hatch-svg instead.",
+            status_code=422,
+            media_type="text/plain"
+        )
+    contents = await file.read()
+    cancel_token = CancelToken(deadline)
+
+    session_scope = contextlib.ExitStack()
+    session_scope.enter_context(sessions.running(session_key(request, session), cancel_token))
+    try:
+        admitted, refusal = await admit_hatch(contents, params, on_limit, None, cancel_token)
+        if refusal is not None:
+            return refusal
+        headers = {}
+        if admitted.hatch_spacing != params.hatch_spacing:
+            headers["X-Hatch-Spacing"] = f"{admitted.hatch_spacing:g}"
+
+        # Parsed before the response starts, so that an unreadable file is still an error response
+        chunks = hatch_preview(contents, admitted, cancel_token)
+        header = await run_in_threadpool(next, chunks)
+        # Starlette iterates the generator on a worker thread; the stream keeps the session
+        chunks = session_stream(itertools.chain([header], chunks), session_scope.pop_all())
+        return StreamingResponse(chunks, media_type="image/svg+xml", headers=headers)
+
+    except Cancelled as e:
+        return cancelled_response(e)
+
+    except Exception as e:
+        # Return a proper error response
+        return Response(
+            content=f"Error processing SVG: {str(e)}",
+            status_code=500,
+            media_type="text/plain"
+        )
+
+    finally:
+        session_scope.close()
+
+@app.post("/api/hatch-svg-estimate")
+async def hatch_svg_estimate(
+    file: UploadFile = File(...),
+    params: HatchParams = Depends(hatch_params)
+):
+    """
+    Estimate the cost of /api/hatch-svg with the same parameters, without hatching.
+    Returns a JSON object with the estimated counts, output size and serial run time,
+    the admission limits, the limits the estimate is over and, when it is over any,
+    the finest hatch spacing within them (null when no spacing is).
+    """
+    contents = await file.read()
+
+    try:
+        estimate = await run_in_threadpool(estimate_hatch, contents, params)
+        exceeded = estimate.exceeded(HATCH_LIMITS)
+        return JSONResponse({
+            "estimate": estimate.as_dict(),
+            "limits": asdict(HATCH_LIMITS),
+            "exceeded": exceeded,
+            "hatch_spacing": estimate.coarsenedSpacing(HATCH_LIMITS) if exceeded else params.hatch_spacing,
+        })
+
+    except Exception as e:
+        # Return a proper error response
+        return Response(
+            content=f"Error processing SVG: {str(e)}",
+            status_code=500,
+            media_type="text/plain"
+        )
+
+@app.post("/api/hatch-svg-variants")
+async def hatch_svg_variants(
+    request: Request,
+    file: UploadFile = File(...),
+    variants: str = Form(..., description="JSON list of parameter sets, each using the /api/hatch-svg query parameter names"),
+    processes: int = Query(0, ge=0, description="Processes hatching the variants in parallel, 0 uses every core"),
+    session: str = Query(None, description="Client session; a newer request of the same session cancels this one"),
+    deadline: float = Query(DEADLINE_SECONDS, description="Seconds after which hatching is abandoned")
+):
+    """
+    Hatch an SVG file once for each of several parameter sets.
+    The file is parsed and flattened once, and the variants are hatched in parallel.
+    Returns a JSON object whose "variants" list holds the parameters and SVG of each variant, in order.
+    A variant estimated to go over the admission limits refuses the whole request, as /api/hatch-svg would,
+    and the request is cancelled as /api/hatch-svg is.
+    """
+    try:
+        variant_params = json.loads(variants)
+        params_list = [HatchParams(**params) for params in variant_params]
+    except (ValueError, TypeError) as e:
+        return Response(
+            content=f"Invalid variants: {str(e)}",
+            status_code=422,
+            media_type="text/plain"
+        )
+    contents = await file.read()
+    cancel_token = CancelToken(deadline)
+
+    try:
+        with sessions.running(session_key(request, session), cancel_token):
+            # Estimated on one parse of the file for all the variants
+            estimates = await run_in_threadpool(estimate_variants, contents, params_list, cancel_token)
+            for params, estimate in zip(params_list, estimates):
+                _, refusal = admit_estimate(params, estimate, "reject")
+                if refusal is not None:
+                    return refusal
+
+            documents = await run_cancellable(request, cancel_token, hatch_variants, contents, params_list, None, processes, cancel_token)
+
+            results = []
+            for params, document in zip(variant_params, documents):
+                cancel_token.check()
+                svg_io = io.StringIO()
+                vpype.write_svg(svg_io, document)
+                results.append({"params": params, "svg": svg_io.getvalue()})
+        return JSONResponse({"variants": results})
+
+    except Cancelled as e:
+        return cancelled_response(e)
+
+    except Exception as e:
+        # Return a proper error response
+        return Response(
+            content=f"Error processing SVG: {str(e)}",
+            status_code=500,
+            media_type="text/plain"
+        )
 
 @app.post("/api/move")
 async def move(file: UploadFile = File(...)):
@@ -463,15 +738,46 @@ async def clean_svg_endpoint(file: UploadFile = File(...)):
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
+def depth_lines_pipeline(image_path, mask_path, tmpdir, cancel_token: CancelToken):
+    """
+    Compute depth, extract isolines, clean the SVG and process it with vpype, checking
+    cancel_token between the stages.  Returns the vpype Document.
+    """
+    import uuid
+    # Output paths
+    depth_output_path = os.path.join(tmpdir, f"depth_output_{uuid.uuid4().hex}.png")
+    svg_output_path = os.path.join(tmpdir, f"isolines_{uuid.uuid4().hex}.svg")
+    # Run depth computation
+    get_depth_image(image_path, depth_output_path)
+    cancel_token.check()
+    # Run isolines extraction
+    get_isolines(mask_path if mask_path else image_path, depth_output_path, svg_output_path, cancel_token)
+    cancel_token.check()
+    # Clean the SVG
+    clean_svg(svg_output_path)
+    cancel_token.check()
+    # Run vpype pipeline
+    import vpype_cli
+    new_doc = vpype_cli.execute(
+        pipeline=f"read --simplify {svg_output_path} linesimplify filter --min-length 3mm linesort"
+    )
+    cancel_token.check()
+    return new_doc
+
 @app.post("/api/depth-lines")
 async def depth_lines(
+    request: Request,
     image: UploadFile = File(...),
-    mask: UploadFile = File(None)
+    mask: UploadFile = File(None),
+    session: str = Query(None, description="Client session; a newer request of the same session cancels this one"),
+    deadline: float = Query(DEADLINE_SECONDS, description="Seconds after which the request is abandoned")
 ):
     """
     Receives an image (for depth) and an optional mask image, computes depth, extracts isolines, cleans the SVG, processes it with vpype, and returns it.
+    The work is abandoned between stages as /api/hatch-svg's is.
     """
     import uuid
+    cancel_token = CancelToken(deadline)
     # Save uploaded files to temporary locations
     with tempfile.TemporaryDirectory() as tmpdir:
         # Save depth image
@@ -484,20 +790,11 @@ async def depth_lines(
             mask_path = os.path.join(tmpdir, f"mask_input_{uuid.uuid4().hex}.png")
             with open(mask_path, "wb") as f:
                 f.write(await mask.read())
-        # Output paths
-        depth_output_path = os.path.join(tmpdir, f"depth_output_{uuid.uuid4().hex}.png")
-        svg_output_path = os.path.join(tmpdir, f"isolines_{uuid.uuid4().hex}.svg")
-        # Run depth computation
-        get_depth_image(image_path, depth_output_path)
-        # Run isolines extraction
-        get_isolines(mask_path if mask_path else image_path, depth_output_path, svg_output_path)
-        # Clean the SVG
-        clean_svg(svg_output_path)
-        # Run vpype pipeline
-        import vpype_cli
-        new_doc = vpype_cli.execute(
-            pipeline=f"read --simplify {svg_output_path} linesimplify filter --min-length 3mm linesort"
-        )
+        try:
+            with sessions.running(session_key(request, session), cancel_token):
+                new_doc = await run_cancellable(request, cancel_token, depth_lines_pipeline, image_path, mask_path, tmpdir, cancel_token)
+        except Cancelled as e:
+            return cancelled_response(e)
         # Return SVG
         return document_to_svg_response(new_doc)
 
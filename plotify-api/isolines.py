@@ -5,7 +5,11 @@ import os
 from lxml import etree
 from skimage.transform import resize
 
-def get_isolines(filename_mask, filename_depth, output_filename):
+def get_isolines(filename_mask, filename_depth, output_filename, cancel_token=None):
+    """
+    Draw the isolines of the depth image, outside the transparent parts of the mask,
+    to output_filename.  When a CancelToken is given it is checked between the steps.
+    """
     # filename_mask = '/Users/simon/Library/Mobile Documents/com~apple~CloudDocs/Downloads/Adobe Express - file (2).png'
 
     # filename_depth = '/Users/simon/Library/Mobile Documents/com~apple~CloudDocs/Downloads/grey_max.png'
@@ -14,6 +18,8 @@ def get_isolines(filename_mask, filename_depth, output_filename):
     # Load image with alpha channel
     image_mask = io.imread(filename_mask, as_gray=False)
     image = io.imread(filename_depth, as_gray=True)  # Load image as grayscale
+    if cancel_token is not None:
+        cancel_token.check()
 
     # Resize mask if needed
     if image_mask.shape[:2] != image.shape[:2]:
@@ -39,6 +45,8 @@ def get_isolines(filename_mask, filename_depth, output_filename):
     image_masked = np.copy(image)
     image_masked = image_masked.astype(float)
     image_masked[transparent_mask] = np.nan
+    if cancel_token is not None:
+        cancel_token.check()
 
     contour_set = plt.contour(image_masked, levels=uniques_foreground, colors='black')
     plt.xlim(0, width)
@@ -46,6 +54,8 @@ def get_isolines(filename_mask, filename_depth, output_filename):
     plt.axis('off')
     plt.axis('equal')
     # plt.gca().invert_yaxis()
+    if cancel_token is not None:
+        cancel_token.check()
     plt.savefig(output_filename, bbox_inches='tight')
     # plt.show()
 
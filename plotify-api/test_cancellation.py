@@ -0,0 +1,48 @@
+"""
+Tests for cancellation.py, run from this directory with
+
+    python -m pytest test_cancellation.py
+"""
+
+import pytest
+
+import cancellation
+from cancellation import Cancelled, CancelToken, Sessions
+
+
+def test_deadline_cancels_once_it_has_passed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cancellation.time, "monotonic", lambda: now[0])
+    token = CancelToken(5.0)
+    token.check()
+
+    now[0] = 105.5
+    with pytest.raises(Cancelled) as e:
+        token.check()
+    assert e.value.reason == CancelToken.DEADLINE == token.reason
+
+
+def test_cancelling_keeps_the_first_reason():
+    token = CancelToken()
+    token.cancel(CancelToken.DISCONNECTED)
+    token.cancel(CancelToken.SUPERSEDED)
+    with pytest.raises(Cancelled) as e:
+        token.check()
+    assert e.value.reason == CancelToken.DISCONNECTED
+
+
+def test_newer_work_of_a_session_supersedes_the_running_one():
+    sessions = Sessions()
+    first, second, other = CancelToken(), CancelToken(), CancelToken()
+    with sessions.running(("/api/hatch-svg", "a"), first):
+        with sessions.running(("/api/hatch-svg", "b"), other), sessions.running(("/api/hatch-svg", "a"), second):
+            assert first.reason == CancelToken.SUPERSEDED
+            assert not second.cancelled and not other.cancelled
+    assert sessions.tokens == {}
+
+
+def test_work_without_a_session_is_never_superseded():
+    sessions = Sessions()
+    first, second = CancelToken(), CancelToken()
+    with sessions.running(None, first), sessions.running(None, second):
+        assert not first.cancelled
@@ -0,0 +1,443 @@
+"""
+Tests for hatch_fill.py, run from this directory with
+
+    python -m pytest test_hatch_fill.py
+"""
+
+import concurrent.futures
+import copy
+import os
+
+import inkex
+import numpy as np
+import pytest
+from inkex import bezier
+from lxml import etree
+
+import hatch_fill
+from hatch_fill import (F_ENGINE_TOLERANCE, HatchEstimate, HatchLimits, HatchParams, HatchStats, Hatch_Fill,
+                        N_MAX_PROCESSES, PathData, SegmentEndGrid, estimate_hatch, estimate_variants, flattenSuperpath,
+                        hatch, hatch_document, hatch_preview, hatch_variants, optionParser, processCount, processPool,
+                        result_handle, runHatchFill)
+from cancellation import CancelToken
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CORPUS = ["test.svg", "example.svg"]
+
+SVG_NS = "http://www.w3.org/2000/svg"
+
+# Three shapes with ids of their own, for re-hatching after an edit
+SHAPES_SVG = b"""<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="100mm" viewBox="0 0 100 100">
+<g id="layer">
+<path id="a" d="M 10,10 L 40,10 L 40,40 L 10,40 Z" fill="#ff0000"/>
+<path id="b" d="M 50,10 L 90,10 L 70,45 Z" fill="#0000ff"/>
+<circle id="c" cx="30" cy="70" r="18" fill="#ff0000"/>
+</g>
+</svg>"""
+
+
+def read(filename):
+    with open(os.path.join(HERE, filename), "rb") as f:
+        return f.read()
+
+
+def clearCaches():
+    for cache in (hatch_fill.flatten_cache, hatch_fill.grid_cache, hatch_fill.intersection_cache,
+                  hatch_fill.segment_cache, hatch_fill.path_cache, hatch_fill.emission_cache,
+                  hatch_fill.element_cache, hatch_fill.result_cache):
+        cache.entries.clear()
+        cache.n_bytes = 0
+
+
+def hatchPathData(svg):
+    """
+    The d attribute of every hatch <path> of a hatched SVG document
+    """
+
+    root = etree.fromstring(svg)
+    return [path.get("d") for path in root.iter("{%s}path" % SVG_NS) if "fill:none" in (path.get("style") or "")]
+
+
+def documentLines(document):
+    return {layer_id: [line.tolist() for line in layer.lines] for layer_id, layer in document.layers.items()}
+
+
+def segments(effect):
+    hatches = [np.asarray(segments).reshape(-1, 4) for segments in effect.hatches.values()]
+    return np.concatenate(hatches) if hatches else np.empty((0, 4))
+
+
+def penLifts(effect):
+    return sum(int(np.count_nonzero(path.codes[:path.n_codes] == PathData.MOVE)) for _, path, _ in effect.hatch_paths)
+
+
+def test_params_refuse_unknown_engine():
+    with pytest.raises(ValueError):
+        HatchParams(hatch_engine="foo")
+
+
+def test_params_refuse_unknown_hold_back_mode():
+    with pytest.raises(ValueError):
+        HatchParams(hold_back_mode="foo")
+
+
+def test_process_counts_are_clamped_to_the_pool():
+    assert processCount(0) == N_MAX_PROCESSES
+    assert processCount(1) == 1
+    assert processCount(N_MAX_PROCESSES + 1000) == N_MAX_PROCESSES
+    assert processCount(-3) == 1
+    with pytest.raises(ValueError):
+        HatchParams(processes=-3)
+
+
+def test_instances_share_one_parser():
+    assert Hatch_Fill().arg_parser is Hatch_Fill().arg_parser is optionParser()
+
+
+@pytest.mark.parametrize("filename", CORPUS)
+def test_concurrent_calls_match_serial_ones(filename):
+    svg = read(filename)
+    params = HatchParams(hatch_spacing=1.0, reduce_pen_lifts=True, cross_hatch=True)
+    serial_svg = hatchPathData(hatch(svg, params).svg)
+    serial_lines = documentLines(hatch_document(svg, params))
+    assert serial_svg
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        svgs = [pool.submit(hatch, svg, params) for _ in range(8)]
+        documents = [pool.submit(hatch_document, svg, params) for _ in range(8)]
+        for future in svgs:
+            assert hatchPathData(future.result().svg) == serial_svg
+        for future in documents:
+            assert documentLines(future.result()) == serial_lines
+
+
+@pytest.mark.parametrize("filename", CORPUS)
+@pytest.mark.parametrize("options", [{}, {"reduce_pen_lifts": True}, {"cross_hatch": True, "reduce_pen_lifts": True},
+                                     {"hold_back_hatch_from_edges": False}])
+def test_engines_agree(filename, options):
+    svg = read(filename)
+    effects = []
+    for engine in ("numpy", "python"):
+        clearCaches()
+        effects.append(runHatchFill(svg, HatchParams(hatch_spacing=1.0, hatch_engine=engine, **options), join_fills=False))
+    numpy_effect, python_effect = effects
+
+    assert segments(numpy_effect).shape == segments(python_effect).shape
+    np.testing.assert_allclose(segments(numpy_effect), segments(python_effect), rtol=0, atol=F_ENGINE_TOLERANCE)
+    assert penLifts(numpy_effect) == penLifts(python_effect)
+
+
+def test_cached_run_matches_cold_run():
+    svg = read("example.svg")
+    params = HatchParams(hatch_spacing=1.0, reduce_pen_lifts=True)
+    clearCaches()
+    cold_stats, warm_stats = HatchStats(), HatchStats()
+    cold = documentLines(hatch_document(svg, params, stats=cold_stats))
+    warm = documentLines(hatch_document(svg, params, stats=warm_stats))
+
+    assert warm == cold
+    assert warm_stats.counters["cached_segments"] > 0
+    for name in ("elements", "segments", "pen_lifts"):
+        assert warm_stats.counters[name] == cold_stats.counters[name]
+
+
+def test_incremental_rehatch_matches_full_rehatch():
+    params = HatchParams(hatch_spacing=1.0, reduce_pen_lifts=True)
+    hatch_document(SHAPES_SVG, params)
+    base = result_handle(SHAPES_SVG, params)
+
+    edited = SHAPES_SVG.replace(b'id="b" d="M 50,10', b'id="b" transform="translate(0,5)" d="M 50,10')
+    edited = edited.replace(b"</g>", b'<rect id="d" x="55" y="60" width="30" height="25" fill="#00a000"/></g>')
+    stats = HatchStats()
+    incremental = hatch_document(edited, params, stats=stats, base=base, changed_ids=["b"])
+    clearCaches()
+    full = hatch_document(edited, params)
+
+    assert stats.counters["reused_elements"] == 2
+    assert documentLines(incremental) == documentLines(full)
+
+
+def test_serial_variants_match_single_runs():
+    svg = read("example.svg")
+    params_list = [HatchParams(hatch_spacing=1.0), HatchParams(hatch_spacing=2.0, hatch_angle=30.0, reduce_pen_lifts=True),
+                   HatchParams(hatch_spacing=1.0, tolerance=5.0)]
+    documents = hatch_variants(svg, params_list, processes=1)
+
+    for params, document in zip(params_list, documents):
+        assert documentLines(document) == documentLines(hatch_document(svg, params))
+
+
+def test_variant_estimates_match_single_estimates():
+    svg = read("test.svg")
+    params_list = [HatchParams(hatch_spacing=1.0), HatchParams(hatch_spacing=0.5, cross_hatch=True)]
+    assert estimate_variants(svg, params_list) == [estimate_hatch(svg, params) for params in params_list]
+
+
+def test_joining_by_colour_does_not_add_pen_lifts(monkeypatch):
+    # A group, overlapping rects and clones, all of one colour
+    svg = b"""<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
+    width="200mm" height="150mm" viewBox="0 0 200 150">
+    <defs><path id="blob" d="M 0,0 L 30,0 L 35,20 L 10,28 Z" fill="#ff0000"/></defs>
+    <g fill="#ff0000">
+    <rect x="10" y="10" width="50" height="40"/>
+    <rect x="40" y="30" width="50" height="40"/>
+    <circle cx="140" cy="40" r="25"/>
+    </g>
+    <use xlink:href="#blob" x="20" y="90"/>
+    <use xlink:href="#blob" x="80" y="100"/>
+    <use xlink:href="#blob" x="140" y="95"/>
+    </svg>"""
+    joins = []
+    hatchPathData = Hatch_Fill.hatchPathData
+    monkeypatch.setattr(Hatch_Fill, "hatchPathData", lambda self, *args: joins.append(args) or hatchPathData(self, *args))
+    for spacing in (5.0, 2.0, 1.0):
+        by_element, by_colour = HatchStats(), HatchStats()
+        runHatchFill(svg, HatchParams(hatch_spacing=spacing, reduce_pen_lifts=True), join_fills=False, stats=by_element)
+        del joins[:]
+        effect = runHatchFill(svg, HatchParams(hatch_spacing=spacing, reduce_pen_lifts=True, join_same_colour=True),
+                              join_fills=False, stats=by_colour)
+
+        assert by_colour.counters["segments"] == by_element.counters["segments"]
+        assert by_colour.counters["pen_lifts"] <= by_element.counters["pen_lifts"]
+        # Joined once for each hatch path drawn
+        assert len(joins) == len(effect.hatch_paths)
+
+
+def test_joining_by_colour_links_touching_shapes():
+    svg = (b'<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="60mm" viewBox="0 0 100 60">'
+           b'<rect x="10" y="10" width="40" height="40" fill="#000000"/>'
+           b'<rect x="51" y="10" width="40" height="40" fill="#000000"/></svg>')
+    by_element, by_colour = HatchStats(), HatchStats()
+    runHatchFill(svg, HatchParams(hatch_spacing=1.0, hatch_angle=90.0, reduce_pen_lifts=True), join_fills=False,
+                 stats=by_element)
+    runHatchFill(svg, HatchParams(hatch_spacing=1.0, hatch_angle=90.0, reduce_pen_lifts=True, join_same_colour=True),
+                 join_fills=False, stats=by_colour)
+
+    assert by_element.counters["pen_lifts"] == 2
+    assert by_colour.counters["pen_lifts"] == 1
+
+
+def test_preview_is_a_whole_document():
+    svg = read("example.svg")
+    params = HatchParams(hatch_spacing=1.0)
+    preview = "".join(hatch_preview(svg, params))
+    groups = etree.fromstring(preview.encode()).findall("{%s}g" % SVG_NS)
+    assert len(groups) == len(runHatchFill(svg, params, join_fills=False).hatch_paths)
+
+    # Cancelled once the first element is in: what came so far, marked as truncated
+    token = CancelToken()
+    chunks = []
+    for chunk in hatch_preview(SHAPES_SVG, params, token):
+        chunks.append(chunk)
+        if "<g" in chunk:
+            token.cancel(CancelToken.DISCONNECTED)
+    root = etree.fromstring("".join(chunks).encode())
+    assert len(root.findall("{%s}g" % SVG_NS)) == 1
+    assert "hatch-preview truncated: disconnected" in "".join(chunks)
+
+
+def test_clones_match_inline_copies():
+    shape = '<path id="s" d="M 0,0 L 40,0 L 30,30 L 0,25 Z" fill="#ff0000"/>'
+    cloned = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+              'width="200" height="200"><defs>{0}</defs>'
+              '<use xlink:href="#s" x="10" y="10"/><use xlink:href="#s" transform="translate(90,70)"/></svg>').format(shape)
+    inline = ('<svg xmlns="http://www.w3.org/2000/svg" width="200" height="200">'
+              '<g transform="translate(10,10)">{0}</g><g transform="translate(90,70)">{0}</g></svg>').format(shape)
+    params = HatchParams(hatch_spacing=1.0, reduce_pen_lifts=True)
+    clearCaches()
+    effect = runHatchFill(cloned.encode(), params, join_fills=False)
+    clearCaches()
+    reference = runHatchFill(inline.encode(), params, join_fills=False)
+
+    assert effect.stats.counters["clones"] == 2
+    lines = [np.concatenate(effect.pathLines(path, 0.1)) for _, path, _ in effect.hatch_paths]
+    reference_lines = [np.concatenate(reference.pathLines(path, 0.1)) for _, path, _ in reference.hatch_paths]
+    assert len(lines) == len(reference_lines) == 2
+    for line, reference_line in zip(lines, reference_lines):
+        np.testing.assert_allclose(line, reference_line, rtol=0, atol=1e-9)
+
+
+def test_group_fills_match_one_compound_path():
+    fragments = ["M 10,10 L 30,10 L 30,30 Z", "M 40,12 L 60,12 L 50,35 Z", "M 15,50 L 35,50 L 35,70 L 15,70 Z"]
+    grouped = ('<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100"><g>' +
+               ''.join('<path d="{0}" fill="#ff0000"/>'.format(d) for d in fragments) + '</g></svg>')
+    merged = ('<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100"><g>'
+              '<path d="{0}" fill="#ff0000"/></g></svg>').format(' '.join(fragments))
+    params = HatchParams(hatch_spacing=1.0, reduce_pen_lifts=True, group_fills=True)
+    effect = runHatchFill(grouped.encode(), params, join_fills=False)
+    reference = runHatchFill(merged.encode(), params, join_fills=False)
+
+    assert effect.stats.counters["grouped_elements"] == 3
+    assert [str(path) for _, path, _ in effect.hatch_paths] == [str(path) for _, path, _ in reference.hatch_paths]
+
+
+def test_limits_reject_or_coarsen():
+    limits = HatchLimits(max_edges=1000, max_grid_lines=100)
+    # Over the grid line limit only: a coarser spacing fits, as a 422 suggests
+    estimate = HatchEstimate.fromCounts(10, 500, 400.0, 2000.0, False, 1.0, 1.0)
+    assert estimate.exceeded(limits)
+    assert estimate.coarsenedSpacing(limits) == pytest.approx(4.0)
+    # Over the edge limit, whatever the spacing: a 413
+    estimate = HatchEstimate.fromCounts(10, 5000, 50.0, 200.0, False, 1.0, 1.0)
+    assert estimate.exceeded(limits)
+    assert estimate.coarsenedSpacing(limits) is None
+
+
+@pytest.mark.parametrize("inner, attributes, b_hidden", [
+    # Drawn the same way as the outer square: no hole by SVG's default nonzero rule
+    ("M 35,35 L 65,35 L 65,65 L 35,65 Z", "", True),
+    ("M 35,35 L 65,35 L 65,65 L 35,65 Z", 'fill-rule="evenodd"', False),
+    ("M 35,35 L 65,35 L 65,65 L 35,65 Z", 'style="fill-rule:evenodd"', False),
+    # Drawn the other way: a hole either way
+    ("M 35,35 L 35,65 L 65,65 L 65,35 Z", "", False)])
+def test_occluders_follow_their_fill_rule(inner, attributes, b_hidden):
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100">'
+           '<rect id="under" x="30" y="30" width="40" height="40" fill="#0000ff"/>'
+           '<path id="over" d="M 10,10 L 90,10 L 90,90 L 10,90 Z {0}" fill="#ff0000" {1}/></svg>').format(inner, attributes)
+    effect = runHatchFill(svg.encode(), HatchParams(hatch_spacing=1.0, occlusion=True), join_fills=False)
+    hatched = {node.get("id") for node, segments in effect.hatches.items() if len(segments)}
+
+    assert "over" in hatched
+    assert ("under" not in hatched) == b_hidden
+
+
+def distancesToSegments(points, starts, ends):
+    """
+    The distance of each point to the nearest of the segments starts -> ends
+    """
+
+    direction = ends - starts
+    t = np.clip(((points[:, None, :] - starts) * direction).sum(-1) / (direction * direction).sum(-1), 0.0, 1.0)
+    return np.linalg.norm(points[:, None, :] - (starts + t[..., None] * direction), axis=-1).min(axis=1)
+
+
+@pytest.mark.parametrize("mode, b_held_back", [("inset", True), ("trim", False)])
+def test_inset_hold_back_clears_the_whole_outline(mode, b_held_back):
+    # An L whose inner corner a trimmed hatch passes closer than the hold back
+    outline = np.array([(10, 10), (90, 10), (90, 30), (40, 30), (40, 70), (10, 70)], dtype=float)
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="80mm" viewBox="0 0 100 80">'
+           '<path d="M {0} Z" fill="#000000"/></svg>').format(" L ".join("{0},{1}".format(x, y) for x, y in outline))
+    params = HatchParams(hatch_spacing=2.0, hatch_angle=30.0, hold_back_steps=1.5, hold_back_mode=mode)
+    hatches = segments(runHatchFill(svg.encode(), params, join_fills=False))
+    edges = outline, np.roll(outline, -1, axis=0)
+    # Hatches and edges never cross, so they are closest at an end of one of them
+    clearance = min(distancesToSegments(hatches.reshape(-1, 2), *edges).min(),
+                    distancesToSegments(outline, hatches[:, :2], hatches[:, 2:]).min())
+
+    assert len(hatches)
+    assert (clearance >= 1.5 - 1e-9) == b_held_back
+
+
+def test_segment_end_grid_finds_every_near_end():
+    rng = np.random.default_rng(3)
+    ends = rng.uniform(0.0, 50.0, (400, 4))
+    points = ends.reshape(-1, 2)
+    f_radius = 2.5
+    grid = SegmentEndGrid(ends, f_radius * f_radius)
+    ref_ends, near_ends = grid.pairs(np.arange(100, 300))
+
+    assert set(ref_ends.tolist()) == set(range(100, 300))
+    for n_ref_end in range(100, 300, 8):
+        near = {n_end for n_end in range(len(points)) if np.hypot(*(points[n_end] - points[n_ref_end])) < f_radius}
+        assert near <= set(near_ends[ref_ends == n_ref_end].tolist())
+
+
+def test_long_chains_are_one_stroke():
+    # 600 hatch lines: more joins than the recursive join allowed, 500
+    svg = (b'<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="100mm" viewBox="0 0 100 100">'
+           b'<rect x="10" y="10" width="60" height="60" fill="#000000"/></svg>')
+    stats = HatchStats()
+    runHatchFill(svg, HatchParams(hatch_spacing=0.1, hatch_angle=0.0, reduce_pen_lifts=True), join_fills=False, stats=stats)
+
+    assert stats.counters["segments"] == 600
+    assert stats.counters["pen_lifts"] == 1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # Two spawned workers, even on a single core
+    monkeypatch.setattr(hatch_fill, "N_MAX_PROCESSES", 2)
+    processPool.cache_clear()
+    yield processPool()
+    processPool().shutdown()
+    processPool.cache_clear()
+
+
+@pytest.mark.parametrize("filename", CORPUS + ["wimbledon_figma.svg"])
+@pytest.mark.parametrize("options", [{}, {"cross_hatch": True, "reduce_pen_lifts": True}])
+def test_pool_matches_serial(pool, filename, options):
+    svg = read(filename)
+    clearCaches()
+    serial = documentLines(hatch_document(svg, HatchParams(hatch_spacing=1.0, **options)))
+    clearCaches()
+    stats = HatchStats()
+    pooled = documentLines(hatch_document(svg, HatchParams(hatch_spacing=1.0, processes=2, **options), stats=stats))
+
+    assert "pool" in stats.timings
+    assert pooled == serial
+
+
+@pytest.mark.parametrize("options", [{}, {"cross_hatch": True, "reduce_pen_lifts": True}])
+def test_bands_match_serial(pool, monkeypatch, options):
+    # A 360-gon with a hole, over the lowered banding threshold
+    outline = " ".join("%f,%f" % (100 + 80 * np.cos(angle), 100 + 60 * np.sin(angle))
+                       for angle in np.linspace(0.0, 2 * np.pi, 360, endpoint=False))
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="200mm" height="200mm" viewBox="0 0 200 200">'
+           '<path d="M %s Z M 70,80 L 130,80 L 130,120 L 70,120 Z" fill="#000000" fill-rule="evenodd"/></svg>'
+           % outline).encode()
+    monkeypatch.setattr(hatch_fill, "N_MIN_BAND_VERTICES", 100)
+    n_bands = []
+    hatchBands = Hatch_Fill.hatchBands
+
+    def countingHatchBands(self, *args):
+        result = hatchBands(self, *args)
+        n_bands.append(len(result[2]))
+        return result
+
+    monkeypatch.setattr(Hatch_Fill, "hatchBands", countingHatchBands)
+    clearCaches()
+    serial = documentLines(hatch_document(svg, HatchParams(hatch_spacing=0.5, **options)))
+    clearCaches()
+    banded = documentLines(hatch_document(svg, HatchParams(hatch_spacing=0.5, processes=2, **options)))
+
+    assert n_bands and min(n_bands) > 1
+    assert banded == serial
+
+
+def test_repeated_requests_are_flattened_once(monkeypatch):
+    flattened = []
+    flattenPathVertices = Hatch_Fill.flattenPathVertices
+
+    def countingFlattenPathVertices(self, node, transform, tolerance):
+        flattened.append(node.get("id"))
+        return flattenPathVertices(self, node, transform, tolerance)
+
+    monkeypatch.setattr(Hatch_Fill, "flattenPathVertices", countingFlattenPathVertices)
+    clearCaches()
+    hatch_document(SHAPES_SVG, HatchParams(hatch_spacing=1.0))
+    assert sorted(flattened) == ["a", "b", "c"]
+
+    # Only the hatch settings changed: every polygon comes from the flatten_cache
+    del flattened[:]
+    hatch_document(SHAPES_SVG, HatchParams(hatch_spacing=2.0, hatch_angle=30.0, cross_hatch=True))
+    assert flattened == []
+
+    # The tolerance is part of the key
+    hatch_document(SHAPES_SVG, HatchParams(hatch_spacing=2.0, tolerance=5.0))
+    assert sorted(flattened) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("d", [
+    "M 10,50 C 10,10 90,10 90,50 C 90,90 10,90 10,50 Z",
+    "M 0,0 C 50,100 100,-100 150,0 S 250,80 300,0 L 300,60 Q 150,140 0,60 Z",
+    "M 20,20 A 30,15 30 1 1 80,40 A 30,15 30 0 0 20,20 Z M 40,30 L 60,30 L 50,35 Z",
+])
+@pytest.mark.parametrize("flat", [0.2, 0.002])
+def test_flattening_matches_cspsubdiv(d, flat):
+    csp = inkex.Path(d).to_superpath()
+    reference = copy.deepcopy(csp)
+    bezier.cspsubdiv(reference, flat)
+
+    assert flattenSuperpath(csp, flat) == [[list(point[1]) for point in sp] for sp in reference]
+
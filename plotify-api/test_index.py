@@ -0,0 +1,92 @@
+"""
+Tests for the hatch endpoints of index.py, run from this directory with
+
+    python -m pytest test_index.py
+
+index.py imports the dependencies of every endpoint, so these are skipped
+unless all of requirements.txt is installed.
+"""
+
+import json
+import os
+
+import pytest
+
+index = pytest.importorskip("index")
+from fastapi.testclient import TestClient  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+client = TestClient(index.app)
+
+
+def upload(filename="example.svg"):
+    with open(os.path.join(HERE, filename), "rb") as f:
+        return {"file": (filename, f.read(), "image/svg+xml")}
+
+
+@pytest.mark.parametrize("endpoint", ["/api/hatch-svg", "/api/hatch-svg-preview"])
+def test_unknown_engine_is_refused(endpoint):
+    assert client.post(endpoint, params={"hatch_engine": "foo"}, files=upload()).status_code == 422
+
+
+def test_unknown_engine_variant_is_refused():
+    variants = json.dumps([{"hatch_spacing": 2.0}, {"hatch_spacing": 2.0, "hatch_engine": "foo"}])
+    response = client.post("/api/hatch-svg-variants", data={"variants": variants}, files=upload())
+    assert response.status_code == 422
+    assert "hatch_engine" in response.text
+
+
+@pytest.mark.parametrize("endpoint", ["/api/hatch-svg", "/api/hatch-svg-preview"])
+def test_unknown_hold_back_mode_is_refused(endpoint):
+    assert client.post(endpoint, params={"hold_back_mode": "foo"}, files=upload()).status_code == 422
+
+
+def test_unknown_hold_back_mode_variant_is_refused():
+    variants = json.dumps([{"hatch_spacing": 2.0, "hold_back_mode": "foo"}])
+    response = client.post("/api/hatch-svg-variants", data={"variants": variants}, files=upload())
+    assert response.status_code == 422
+    assert "hold_back_mode" in response.text
+
+
+@pytest.mark.parametrize("endpoint", ["/api/hatch-svg", "/api/hatch-svg-preview", "/api/hatch-svg-variants"])
+def test_negative_processes_are_refused(endpoint):
+    response = client.post(endpoint, params={"processes": -3}, data={"variants": "[{}]"}, files=upload())
+    assert response.status_code == 422
+
+
+def test_negative_processes_variant_is_refused():
+    response = client.post("/api/hatch-svg-variants", data={"variants": json.dumps([{"processes": -3}])}, files=upload())
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("reason, status_code", [
+    (index.CancelToken.DEADLINE, 504), (index.CancelToken.SUPERSEDED, 409), (index.CancelToken.DISCONNECTED, 499)])
+def test_cancelled_work_maps_to_its_status(reason, status_code):
+    response = index.cancelled_response(index.Cancelled(reason))
+    assert response.status_code == status_code
+    assert reason in response.body.decode()
+
+
+@pytest.mark.parametrize("params", [{"processes": 2}, {"join_same_colour": True}, {"group_fills": True}])
+def test_preview_refuses_options_it_cannot_honour(params):
+    response = client.post("/api/hatch-svg-preview", params=params, files=upload())
+    assert response.status_code == 422
+    assert next(iter(params)) in response.text
+
+
+def test_stage_timings_are_reported():
+    response = client.post("/api/hatch-svg", params={"hatch_spacing": 2.0, "reduce_pen_lifts": True, "stats": True},
+                           files=upload())
+    assert response.status_code == 200
+
+    timings = {metric.split(";")[0].strip() for metric in response.headers["Server-Timing"].split(",")}
+    assert {"parse", "flatten", "interstices", "penlift", "vpype", "serialize"} <= timings
+    stats = json.loads(response.headers["X-Hatch-Stats"])
+    assert stats["counters"]["segments"] > 0
+    assert set(stats["timings_ms"]) <= timings
+
+    # Only asked for
+    response = client.post("/api/hatch-svg", params={"hatch_spacing": 2.0}, files=upload())
+    assert "Server-Timing" in response.headers
+    assert "X-Hatch-Stats" not in response.headers